@@ -0,0 +1,435 @@
+"""
+按内容寻址的中间结果缓存。每个阶段（prepared data、targets、各种features、各个模型）的输出，
+以产生它的代码版本、参数以及输入文件内容的哈希作为key 保存。
+key 不变时即使输入文件被touch 过也直接跳过；参数或代码改变时key 随之改变，不会读到旧文件。
+
+在Makefile 中的用法：
+    python3 src/data/artifact_cache.py run --stage NAME --input IN \
+        --output OUT --code SRC.py -- python3 SRC.py IN OUT
+"""
+import ast
+import hashlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import click
+
+CACHE_ROOT = 'data/cache'
+
+# 读取文件计算哈希时的块大小
+_CHUNK_SIZE = 1 << 20
+
+
+def _path_id(path: str):
+    """文件绝对路径的哈希，用作其记录文件的文件名"""
+    return hashlib.sha256(os.path.abspath(path).encode()).hexdigest()[:32]
+
+
+def _write_json(path: str, content: dict):
+    """先写入临时文件再替换，避免并行的make 读到写了一半的文件"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as tmp_file:
+        json.dump(content, tmp_file)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def file_digest(path: str, cache_root: str = CACHE_ROOT):
+    """
+    计算文件内容的sha256。按(大小, 修改时间) 记住上一次的结果，
+    文件只是被touch 过时会重新计算，但得到的哈希不变。
+
+    Parameters:
+    -----------
+    path:
+        str
+        文件路径
+
+    Return:
+    -------
+        str
+    """
+    stat = os.stat(path)
+    record_path = os.path.join(cache_root, 'digests', _path_id(path) + '.json')
+    record = _read_json(record_path)
+    if (record is not None and record['size'] == stat.st_size
+            and record['mtime_ns'] == stat.st_mtime_ns):
+        return record['digest']
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as data_file:
+        for chunk in iter(lambda: data_file.read(_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+    _write_json(record_path, {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'digest': digest
+    })
+    return digest
+
+
+def path_digest(path: str, cache_root: str = CACHE_ROOT):
+    """
+    计算文件或文件夹内容的sha256。文件夹的哈希由其中每个文件的相对路径和内容哈希计算
+
+    Parameters:
+    -----------
+    path:
+        str
+        文件或文件夹路径
+
+    Return:
+    -------
+        str
+    """
+    if not os.path.isdir(path):
+        return file_digest(path, cache_root)
+    entries = []
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for name in sorted(file_names):
+            file_path = os.path.join(dir_path, name)
+            entries.append((os.path.relpath(file_path, path),
+                            file_digest(file_path, cache_root)))
+    return hashlib.sha256(json.dumps(entries).encode()).hexdigest()
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _touch(path: str):
+    """更新文件（或文件夹中所有文件）的修改时间"""
+    if not os.path.isdir(path):
+        os.utime(path)
+        return
+    for dir_path, _, file_names in os.walk(path):
+        for name in file_names:
+            os.utime(os.path.join(dir_path, name))
+
+
+def code_digest(code, cache_root: str = CACHE_ROOT):
+    """
+    计算产生某个阶段的代码的哈希
+
+    Parameters:
+    -----------
+    code:
+        list of (str, function or module)
+        源代码文件路径，或函数、模块本身（使用其源代码）
+
+    Return:
+    -------
+        list of str
+    """
+    digests = []
+    for item in code:
+        if callable(item) or inspect.ismodule(item):
+            source = inspect.getsource(item)
+            digests.append(hashlib.sha256(source.encode()).hexdigest())
+        else:
+            digests.append(file_digest(item, cache_root))
+    return digests
+
+
+def _src_root(path: str):
+    """path 所在的src 包的上一级文件夹，不在src 中时返回None"""
+    parent = os.path.dirname(os.path.abspath(path))
+    while os.path.basename(parent) != 'src':
+        if os.path.dirname(parent) == parent:
+            return None
+        parent = os.path.dirname(parent)
+    return os.path.dirname(parent)
+
+
+def _module_file(root: str, module: str):
+    """src 中模块对应的文件，不存在时返回None"""
+    base = os.path.join(root, *module.split('.'))
+    for path in (base + '.py', os.path.join(base, '__init__.py')):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def code_closure(code: list):
+    """
+    源代码文件及其（直接或间接）导入的src 中的所有模块文件
+
+    Parameters:
+    -----------
+    code:
+        list of str
+        源代码文件路径
+
+    Return:
+    -------
+        list of str，code 在前，其导入的模块按路径排序在后
+    """
+    found = {os.path.abspath(path): path for path in code}
+    pending = [path for path in code if path.endswith('.py')]
+    while pending:
+        path = pending.pop()
+        root = _src_root(path)
+        if root is None:
+            continue
+        with open(path) as source_file:
+            tree = ast.parse(source_file.read(), filename=path)
+        modules = []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module:
+                # from src.models import hac 中hac 可能是模块
+                modules.append(node.module)
+                modules.extend(node.module + '.' + alias.name
+                               for alias in node.names)
+        for module in modules:
+            if module.split('.')[0] != 'src':
+                continue
+            module_path = _module_file(root, module)
+            if module_path is None or os.path.abspath(module_path) in found:
+                continue
+            module_path = os.path.relpath(module_path)
+            found[os.path.abspath(module_path)] = module_path
+            pending.append(module_path)
+    imported = sorted(path for key, path in found.items()
+                      if key not in {os.path.abspath(p) for p in code})
+    return list(code) + imported
+
+
+def object_digest(value):
+    """
+    计算内存中一个对象内容的sha256，pandas 对象按其值、index 和列名计算
+
+    Return:
+    -------
+        str
+    """
+    import pandas as pd
+
+    sha = hashlib.sha256()
+    if isinstance(value, (pd.Series, pd.DataFrame, pd.Index)):
+        sha.update(pd.util.hash_pandas_object(value).to_numpy().tobytes())
+        if isinstance(value, pd.DataFrame):
+            sha.update(json.dumps([str(col)
+                                   for col in value.columns]).encode())
+        else:
+            sha.update(str(value.name).encode())
+    else:
+        sha.update(pickle.dumps(value))
+    return sha.hexdigest()
+
+
+def stage_key(stage: str, code_digests: list, params, input_digests: list):
+    """
+    一个阶段输出的key：阶段名、代码版本、参数和输入哈希共同的sha256
+
+    Parameters:
+    -----------
+    stage:
+        str
+        阶段名
+    code_digests:
+        list of str
+        code_digest 的结果
+    params:
+        可以序列化为json 的参数，如dict 或命令行的list
+    input_digests:
+        list of str
+        所有输入的哈希
+
+    Return:
+    -------
+        str
+    """
+    content = json.dumps(
+        {
+            'stage': stage,
+            'code': list(code_digests),
+            'params': params,
+            'inputs': list(input_digests)
+        },
+        sort_keys=True,
+        default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class ArtifactCache(object):
+    """
+    保存各阶段输出的缓存。objects/<key>/ 下保存key 对应的输出文件，
+    manifest/ 下记录工作区中每个输出文件当前由哪个key 产生。
+    """
+    def __init__(self, cache_root: str = CACHE_ROOT):
+        self._root = cache_root
+
+    def _manifest_path(self, output: str):
+        return os.path.join(self._root, 'manifest',
+                            _path_id(output) + '.json')
+
+    def _object_path(self, key: str, output: str):
+        return os.path.join(self._root, 'objects', key,
+                            os.path.basename(output))
+
+    def is_current(self, key: str, outputs: list):
+        """工作区中的输出就是key 所产生的（且未被改动）"""
+        for output in outputs:
+            record = _read_json(self._manifest_path(output))
+            if (record is None or record['key'] != key
+                    or not os.path.exists(output)
+                    or path_digest(output, self._root) != record['digest']):
+                return False
+        return True
+
+    def has_objects(self, key: str, outputs: list):
+        """缓存中是否保存了key 对应的所有输出"""
+        return all(
+            os.path.exists(self._object_path(key, output))
+            for output in outputs)
+
+    @staticmethod
+    def _copy(source: str, target: str):
+        """
+        复制文件或文件夹：先复制为临时文件再替换target。
+        target 与缓存不共用inode，在run 之外改写输出不会损坏缓存；
+        复制得到的文件使用当前的修改时间，依赖修改时间的检查会认为其是新生成的
+        """
+        target_dir = os.path.dirname(target)
+        if target_dir:
+            os.makedirs(target_dir, exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(target, os.getpid())
+        _remove(tmp_path)
+        if os.path.isdir(source):
+            shutil.copytree(source, tmp_path, copy_function=shutil.copyfile)
+            _remove(target)
+        else:
+            shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, target)
+
+    def restore(self, key: str, outputs: list):
+        """从缓存中取出key 对应的输出放回工作区"""
+        for output in outputs:
+            self._copy(self._object_path(key, output), output)
+            self._record(key, output)
+
+    def store(self, key: str, outputs: list):
+        """将刚生成的输出保存到key 下，并记录到manifest 中"""
+        for output in outputs:
+            self._copy(output, self._object_path(key, output))
+            self._record(key, output)
+
+    def _record(self, key: str, output: str):
+        _write_json(self._manifest_path(output), {
+            'key': key,
+            'output': output,
+            'digest': path_digest(output, self._root)
+        })
+
+    def run(self,
+            stage: str,
+            command: list,
+            inputs: list,
+            outputs: list,
+            code: list,
+            params=None):
+        """
+        需要时运行command 生成outputs。key 未变时跳过，缓存中有key 对应的输出时直接取出。
+
+        Parameters:
+        -----------
+        stage:
+            str
+            阶段名
+        command:
+            list of str
+            生成outputs 的命令，其本身也作为参数参与key 的计算
+        inputs, outputs:
+            list of str
+            输入和输出文件（或文件夹）的路径
+        code:
+            list of str
+            产生outputs 的源代码文件，其导入的src 中的模块会自动加入
+        params:
+            default None
+            命令行之外的其他参数
+
+        Return:
+        -------
+            str, 'skipped', 'restored' 或'built'
+        """
+        key = stage_key(stage, code_digest(code_closure(code), self._root), {
+            'command': list(command),
+            'params': params
+        }, [path_digest(path, self._root) for path in inputs])
+
+        if self.is_current(key, outputs):
+            # 更新修改时间，使make 认为输出已经是最新的
+            for output in outputs:
+                _touch(output)
+            return 'skipped'
+
+        if self.has_objects(key, outputs):
+            self.restore(key, outputs)
+            return 'restored'
+
+        for output in outputs:
+            _remove(output)
+        subprocess.run(command, check=True)
+        self.store(key, outputs)
+        return 'built'
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--stage', required=True, help='name of the pipeline stage')
+@click.option('--input',
+              'inputs',
+              multiple=True,
+              type=click.Path(exists=True),
+              help='input file of the stage, may be repeated')
+@click.option('--output',
+              'outputs',
+              multiple=True,
+              required=True,
+              help='output file or directory of the stage, may be repeated')
+@click.option('--code',
+              multiple=True,
+              type=click.Path(exists=True),
+              help='source file producing the outputs, may be repeated')
+@click.option('--cache-root', default=CACHE_ROOT, show_default=True)
+@click.argument('command', nargs=-1, required=True)
+def run(stage, inputs, outputs, code, cache_root, command):
+    """Run COMMAND only if its outputs are not cached for the current key."""
+    cache = ArtifactCache(cache_root)
+    try:
+        status = cache.run(stage,
+                           list(command),
+                           inputs=list(inputs),
+                           outputs=list(outputs),
+                           code=list(code))
+    except subprocess.CalledProcessError as error:
+        sys.exit(error.returncode)
+    print('[{}] {}: {}'.format(status, stage, ', '.join(outputs)))
+
+
+if __name__ == "__main__":
+    cli()
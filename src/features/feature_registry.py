@@ -0,0 +1,513 @@
+"""
+声明式的features 注册表。每个feature 声明其依赖的输入、所需的参数（窗口长度）和计算函数，
+请求某个feature 时按依赖关系递归求解，只计算缺失的部分，并在内存和磁盘上缓存计算结果。
+磁盘缓存以计算函数的代码、参数和输入内容的哈希为key（见artifact_cache.py）。
+shared_resolver 为每个processed 文件夹提供一个共用的FeatureResolver，同一文件夹的所有回归
+只读取一次每个文件，并得到只读的features。
+"""
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+from src.data import artifact_cache as acache
+from src.features import process_data_api as proda
+from src.features import process_features as prof
+from src.features import feature_store as fstore
+from src.features.process_data_api import ProcessedType
+
+# 计算得到的features 在processed 文件夹中的缓存文件夹
+CACHE_DIR = fstore.CACHE_DIR
+
+# 默认的窗口参数，与Makefile 中data/processed/ 的窗口一致
+DEFAULT_PARAMS = {'backward_window': 60, 'forward_window': 5}
+
+
+class FeatureSpec(object):
+    """一个feature 的声明：名称、依赖的输入、所需的参数以及计算函数"""
+    __slots__ = ('name', 'inputs', 'params', 'compute', 'processed',
+                 'persist', 'code')
+
+    def __init__(self, name, inputs, params, compute, processed, persist,
+                 code):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.params = tuple(params)
+        self.compute = compute
+        self.processed = processed
+        self.persist = persist
+        self.code = (compute, ) + tuple(code)
+
+    def __repr__(self):
+        return 'FeatureSpec({}, inputs={}, params={})'.format(
+            self.name, list(self.inputs), list(self.params))
+
+
+class FeatureRegistry(object):
+    """保存所有FeatureSpec 的注册表"""
+    def __init__(self):
+        self._specs = {}
+
+    def register(self,
+                 name,
+                 inputs=(),
+                 params=(),
+                 processed: ProcessedType = None,
+                 persist=True,
+                 code=()):
+        """
+        注册一个feature 的装饰器，被装饰的函数按inputs 的顺序接收输入，按参数名接收params
+
+        Parameters:
+        -----------
+        name:
+            str
+            feature 的名称，与OLSFeatures 中使用的名称一致
+        inputs:
+            list of str
+            依赖的其他feature 名称
+        params:
+            list of str
+            计算时需要的参数名，如'backward_window'
+        processed:
+            ProcessedType, default None
+            该feature 在processed 文件夹中已经保存的类型。存在时优先从文件夹中读取
+        persist:
+            bool, default True
+            计算结果是否缓存到磁盘
+        code:
+            list of function or module, default ()
+            除被装饰的函数外，计算结果所依赖的代码。其改变时磁盘缓存失效
+        """
+        def decorator(func):
+            if name in self._specs:
+                raise ValueError(
+                    "Feature '{}' is already registered.".format(name))
+            self._specs[name] = FeatureSpec(name, inputs, params, func,
+                                            processed, persist, code)
+            return func
+
+        return decorator
+
+    def __contains__(self, name):
+        return name in self._specs
+
+    def __getitem__(self, name):
+        try:
+            return self._specs[name]
+        except KeyError:
+            raise KeyError("Unknown feature '{}'.".format(name))
+
+    @property
+    def names(self):
+        return list(self._specs)
+
+    def dependencies(self, names):
+        """
+        返回计算names 所需的所有feature，按依赖顺序排列（被依赖的在前）
+
+        Parameters:
+        -----------
+        names:
+            str or list of str
+
+        Return:
+        -------
+            list of str
+        """
+        if isinstance(names, str):
+            names = [names]
+        ordered, visiting = [], set()
+
+        def visit(name):
+            if name in ordered:
+                return
+            if name in visiting:
+                raise ValueError(
+                    "Circular dependency found at feature '{}'.".format(name))
+            visiting.add(name)
+            for input_name in self[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            ordered.append(name)
+
+        for name in names:
+            visit(name)
+        return ordered
+
+
+REGISTRY = FeatureRegistry()
+
+
+def windows_from_dir(processed_dir: str):
+    """
+    返回processed 文件夹中features 的向前和向后窗口长度。优先读取生成features 时记录的元数据
+    （process_features.WINDOWS_FILE）；没有时从形如data/robost/b40_f10 的文件夹名中解析，
+    都没有时使用默认值
+
+    Return:
+    -------
+        dict, {'backward_window': int, 'forward_window': int}
+    """
+    params = dict(DEFAULT_PARAMS)
+    meta_path = os.path.join(processed_dir, prof.WINDOWS_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            windows = json.load(meta_file)
+            params.update((key, int(value)) for key, value in windows.items()
+                          if key in params)
+        return params
+    matched = re.search(r'b(\d+)_f(\d+)', processed_dir)
+    if matched:
+        params['backward_window'] = int(matched.group(1))
+        params['forward_window'] = int(matched.group(2))
+    return params
+
+
+class FeatureResolver(object):
+    """
+    针对一个processed 文件夹和一组参数求解features。
+    求解顺序为：内存缓存 -> processed 文件夹中已保存的数据 -> 磁盘缓存 -> 按依赖计算。
+    processed 文件夹中已有的文件视为以该文件夹的窗口参数生成。
+    """
+    def __init__(self,
+                 processed_dir: str = 'data/processed/',
+                 params: dict = None,
+                 registry: FeatureRegistry = REGISTRY,
+                 read_only: bool = False):
+        """
+        Parameters:
+        -----------
+        processed_dir:
+            str
+            保存processed data 的文件夹
+        params:
+            dict, default None
+            计算features 时使用的参数，缺省的部分从文件夹名中解析
+        registry:
+            FeatureRegistry, default REGISTRY
+        read_only:
+            bool, default False
+            为True 时get 返回不可修改的view，多个使用者共用同一个FeatureResolver 时防止相互影响
+        """
+        if processed_dir[-1] != '/':
+            processed_dir = processed_dir + '/'
+        self._processed_dir = processed_dir
+        self._params = windows_from_dir(processed_dir)
+        if params is not None:
+            self._params.update(params)
+        self._registry = registry
+        self._read_only = read_only
+        self._memo = {}
+        self._digests = {}
+        self._files = {}
+        self._valid = {}
+
+    @property
+    def processed_dir(self):
+        return self._processed_dir
+
+    @property
+    def params(self):
+        return dict(self._params)
+
+    def _spec_params(self, spec: FeatureSpec):
+        try:
+            return {name: self._params[name] for name in spec.params}
+        except KeyError as error:
+            raise KeyError("Feature '{}' needs parameter {}.".format(
+                spec.name, error))
+
+    def _cache_path(self, spec: FeatureSpec):
+        """磁盘缓存的路径，文件名为其内容key，代码、参数或输入改变时不会读到旧的结果"""
+        return os.path.join(
+            self._processed_dir, CACHE_DIR,
+            '{}-{}.pickle'.format(spec.name, self.digest(spec.name)[:16]))
+
+    def digest(self, name):
+        """
+        feature 内容的哈希。processed 文件夹中已有的feature 由其所属文件内容的哈希得到，不需要读取文件；
+        需要计算的feature 则由其代码、参数和输入的哈希得到，不需要先算出它的值
+        """
+        return self._digest(name, visiting=set())
+
+    def _digest(self, name, visiting: set):
+        if name in self._digests:
+            return self._digests[name]
+        if name in visiting:
+            raise ValueError(
+                "Circular dependency found at feature '{}'.".format(name))
+        spec = self._registry[name]
+
+        digest = self._processed_digest(spec)
+        if digest is None:
+            visiting.add(name)
+            input_digests = [
+                self._digest(input_name, visiting)
+                for input_name in spec.inputs
+            ]
+            visiting.remove(name)
+            digest = acache.stage_key(name, acache.code_digest(spec.code),
+                                      self._spec_params(spec), input_digests)
+        self._digests[name] = digest
+        return digest
+
+    def _processed_digest(self, spec: FeatureSpec):
+        """
+        processed 文件夹中已保存的feature 的哈希，不存在时返回None。
+        pickle 与建库时相同时使用features 库中记录的哈希，否则计算pickle 的哈希（见fstore.source_digest）；
+        只有库中没有记录哈希时才读取其值计算
+        """
+        if spec.processed is None:
+            return None
+        file_key = spec.processed.value
+        meta = (fstore.read_meta(self._processed_dir)
+                if fstore.has_store(self._processed_dir) else None)
+        file_meta = None if meta is None else meta['files'].get(file_key)
+        file_digest = fstore.source_digest(self._processed_dir, file_key,
+                                           meta)
+        if file_digest is None and file_meta is not None:
+            file_digest = file_meta.get('digest') or acache.object_digest(
+                self._resolve(spec.name, visiting=set()))
+        if file_digest is None:
+            return None
+        return acache.stage_key(spec.name, [], spec.processed.name,
+                                [file_digest])
+
+    def _load_processed(self, spec: FeatureSpec):
+        """从processed 文件夹中读取已经保存的feature，不存在时返回None"""
+        if spec.processed is None:
+            return None
+        from_store = (fstore.has_store(self._processed_dir)
+                      and spec.processed.value in fstore.read_meta(
+                          self._processed_dir)['files'])
+        from_pickle = os.path.exists(self._processed_dir +
+                                     spec.processed.value + '.pickle')
+        if not (from_store or from_pickle):
+            return None
+        if from_store:
+            return proda.get_processed(spec.processed, self._processed_dir)
+
+        # 同一个pickle 文件中保存的多种ProcessedType 只读取一次该文件
+        file_key = spec.processed.value
+        if file_key not in self._files:
+            self._files[file_key] = pd.read_pickle(self._processed_dir +
+                                                   file_key + '.pickle')
+        return proda.select_processed(spec.processed, self._files[file_key])
+
+    def is_cached(self, name):
+        """name 是否已经在内存中"""
+        return name in self._memo
+
+    def preload(self, values: dict):
+        """
+        将已经求得的features 放入内存缓存，之后get 时直接返回，不再读取或计算
+
+        Parameters:
+        -----------
+        values:
+            dict
+            以feature 名称为key，feature 的值为value
+        """
+        self._memo.update(values)
+
+    def get(self, name):
+        """
+        求解一个feature，只计算尚未缓存、也未保存在文件夹中的部分
+
+        Parameters:
+        -----------
+        name:
+            str
+            feature 的名称
+
+        Return:
+        -------
+            feature 的值，通常为pd.Series 或pd.DataFrame
+        """
+        value = self._resolve(name, visiting=set())
+        return read_only_view(value) if self._read_only else value
+
+    def valid(self, name):
+        """
+        feature 的每一行是否所有列都不是NaN，按名称缓存，同一个feature 在不同的设定中只计算一次。
+        从features 库读取的feature 直接使用库中保存的有效位图
+
+        Parameters:
+        -----------
+        name:
+            str
+            feature 的名称
+
+        Return:
+        -------
+            np.ndarray, bool，与get(name) 的行一一对应
+        """
+        if name not in self._valid:
+            value = self._resolve(name, visiting=set())
+            spec = self._registry[name]
+            valid = None
+            if spec.processed is not None:
+                valid = proda.get_processed_valid(spec.processed,
+                                                  self._processed_dir)
+            if valid is None or len(valid) != len(value):
+                valid = fstore.finite_rows(value.to_numpy(dtype=float))
+            valid.flags.writeable = False
+            self._valid[name] = valid
+        return self._valid[name]
+
+    def get_many(self, names):
+        """依次求解多个feature，返回与names 对应的list"""
+        return [self.get(name) for name in names]
+
+    def _resolve(self, name, visiting: set):
+        if name in self._memo:
+            return self._memo[name]
+        if name in visiting:
+            raise ValueError(
+                "Circular dependency found at feature '{}'.".format(name))
+        spec = self._registry[name]
+
+        value = self._load_processed(spec)
+        cache_path = None
+        if value is None and spec.persist:
+            cache_path = self._cache_path(spec)
+            if os.path.exists(cache_path):
+                value = pd.read_pickle(cache_path)
+        if value is None:
+            visiting.add(name)
+            inputs = [
+                self._resolve(input_name, visiting)
+                for input_name in spec.inputs
+            ]
+            visiting.remove(name)
+            value = spec.compute(*inputs, **self._spec_params(spec))
+            if cache_path is not None:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                pd.to_pickle(value, cache_path)
+
+        self._memo[name] = value
+        return value
+
+
+def read_only_view(value):
+    """
+    返回与value 共用数据、但数据不可修改的Series 或DataFrame。
+    多种dtype 的DataFrame 和其他类型的值原样返回
+
+    Parameters:
+    -----------
+    value:
+        pd.Series, pd.DataFrame 或其他
+
+    Return:
+    -------
+        与value 类型相同
+    """
+    if isinstance(value, pd.Series):
+        values = value.to_numpy()
+    elif isinstance(value, pd.DataFrame) and value.dtypes.nunique() == 1:
+        values = value.to_numpy()
+    else:
+        return value
+    if not isinstance(values, np.ndarray):
+        return value
+    values = values.view()
+    values.flags.writeable = False
+    if isinstance(value, pd.Series):
+        return pd.Series(values,
+                         index=value.index,
+                         name=value.name,
+                         copy=False)
+    return pd.DataFrame(values,
+                        index=value.index,
+                        columns=value.columns,
+                        copy=False)
+
+
+# 以(processed 文件夹, 参数) 为key 的共用FeatureResolver
+_SHARED_RESOLVERS = {}
+
+
+def shared_resolver(processed_dir: str = 'data/processed/',
+                    params: dict = None):
+    """
+    返回processed 文件夹对应的共用FeatureResolver。同一个文件夹（和参数）的所有GroupedOLS
+    使用同一个FeatureResolver，每个文件只读取一次，得到的features 为只读的view
+
+    Parameters:
+    -----------
+    processed_dir:
+        str, default 'data/processed/'
+        保存processed data 的文件夹
+    params:
+        dict, default None
+        计算features 时使用的参数，见FeatureResolver
+
+    Return:
+    -------
+        FeatureResolver
+    """
+    # 以实际使用的参数为key，与文件夹名中解析出的窗口相同的参数不会另建一个FeatureResolver
+    full_params = windows_from_dir(processed_dir)
+    full_params.update(params or {})
+    key = (os.path.abspath(processed_dir), tuple(sorted(full_params.items())))
+    if key not in _SHARED_RESOLVERS:
+        _SHARED_RESOLVERS[key] = FeatureResolver(processed_dir=processed_dir,
+                                                 params=params,
+                                                 read_only=True)
+    return _SHARED_RESOLVERS[key]
+
+
+def clear_shared_resolvers():
+    """清空所有共用的FeatureResolver，processed 文件夹中的文件改变后调用"""
+    _SHARED_RESOLVERS.clear()
+
+
+# ============================= features 的声明 ============================= #
+
+
+@REGISTRY.register('targets', processed=ProcessedType.targets)
+def _targets():
+    raise FileNotFoundError(
+        'targets must be built by src/features/reverse_exc_ret.py first.')
+
+
+@REGISTRY.register('feature_index', inputs=['targets'], persist=False)
+def _feature_index(targets):
+    return proda.obtain_feature_index(targets)
+
+
+@REGISTRY.register('shared_inputs', params=['backward_window'], persist=False)
+def _shared_inputs(backward_window):
+    return prof.SharedInputs(backward_window=backward_window)
+
+
+def _register_features_file(file_key):
+    """将process_features.py 生成的一种features 文件注册为一个feature"""
+    @REGISTRY.register(file_key,
+                       inputs=['targets', 'feature_index', 'shared_inputs'],
+                       params=['backward_window', 'forward_window'],
+                       code=[prof.build_features, proda])
+    def _features_file(targets, feature_index, shared_inputs, backward_window,
+                       forward_window):
+        return prof.build_features(file_key, backward_window, forward_window,
+                                   targets, feature_index, shared_inputs)
+
+
+def _register_processed_type(which: ProcessedType):
+    """将一种ProcessedType 注册为从其所属features 文件中取出相应列的feature"""
+    @REGISTRY.register(which.name,
+                       inputs=[which.value],
+                       processed=which,
+                       code=[proda.select_processed, proda._processed_columns])
+    def _processed_type(features_file):
+        return proda.select_processed(which, features_file)
+
+
+for _file_key in prof.FEATURES_TYPES:
+    _register_features_file(_file_key)
+
+for _which in ProcessedType:
+    if _which != ProcessedType.targets:
+        _register_processed_type(_which)
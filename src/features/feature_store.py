@@ -0,0 +1,431 @@
+"""
+按列存储的features 库。processed 文件夹中的各个features pickle 被整理为两张表：
+以Trddt 为index 的日期表（date），和以(Trddt, cap_group, rev_group) 为index 的组合表（port）。
+每一列单独保存为一个.npy 文件，读取时只加载需要的列，并可以使用memory map。
+每一列同时保存一个按位压缩的有效位图（该行不是NaN），组装设计矩阵时合并位图即可得到需要删除的行。
+"""
+import json
+import os
+import re
+import numpy as np
+import pandas as pd
+import click
+from src.data import artifact_cache as acache
+
+STORE_DIR = 'feature_store'
+META_FILE = 'meta.json'
+STORE_VERSION = 4
+# processed 文件夹中保存缓存的文件夹，pickle 内容哈希的记录保存在其中
+CACHE_DIR = 'feature_cache'
+
+# 需要整理进库中的processed 文件，targets 放在最前面，组合表的行顺序以其为准
+PROCESSED_FILES = [
+    'targets', 'rm_features', 'std_features', 'turnover_features',
+    'amihud_features', 'ret_sign_features', '3_fac_features',
+    'multi_std_features', 'liquidity_features'
+]
+
+# 读取过的index 缓存，key 为(表所在文件夹, meta 的修改时间)
+_INDEX_CACHE = {}
+
+
+def store_path(processed_dir: str):
+    """返回processed_dir 中features 库所在的文件夹"""
+    return os.path.join(processed_dir, STORE_DIR)
+
+
+def has_store(processed_dir: str):
+    """processed_dir 中是否已经建好了features 库"""
+    return os.path.exists(os.path.join(store_path(processed_dir), META_FILE))
+
+
+def _hash_pickle(processed_dir: str, file_key: str):
+    """计算原processed pickle 内容的哈希，记录保存在processed_dir 中而不是当前文件夹"""
+    return acache.file_digest(os.path.join(processed_dir,
+                                           file_key + '.pickle'),
+                              cache_root=os.path.join(processed_dir,
+                                                      CACHE_DIR))
+
+
+def source_digest(processed_dir: str, file_key: str, meta: dict = None):
+    """
+    原processed pickle 内容的哈希，文件不存在时返回None。
+    大小和修改时间与建库时记录的相同时直接返回库中记录的哈希，不读取文件，也不写入任何记录；
+    不同时才计算哈希，并按(大小, 修改时间) 记在processed_dir 的CACHE_DIR 中
+
+    Parameters:
+    -----------
+    processed_dir:
+        str
+        保存processed data 的文件夹
+    file_key:
+        str
+        原processed 文件名（不含.pickle）
+    meta:
+        dict, default None
+        已经读取的meta 信息，为None 时若已建库则从文件读取
+    """
+    pickle_path = os.path.join(processed_dir, file_key + '.pickle')
+    try:
+        stat = os.stat(pickle_path)
+    except FileNotFoundError:
+        return None
+    if meta is None and has_store(processed_dir):
+        meta = read_meta(processed_dir)
+    file_meta = {} if meta is None else meta['files'].get(file_key, {})
+    if (file_meta.get('size') == stat.st_size
+            and file_meta.get('mtime_ns') == stat.st_mtime_ns):
+        return file_meta['digest']
+    return _hash_pickle(processed_dir, file_key)
+
+
+def is_stale(processed_dir: str, file_key: str, meta: dict = None):
+    """
+    原processed pickle 的内容是否与建库时不同（此时应读取pickle）。
+    先比较大小和修改时间，只有修改时间不同（如被touch 过或从缓存中取出）时才按内容的哈希比较
+
+    Parameters:
+    -----------
+    processed_dir:
+        str
+        保存processed data 的文件夹
+    file_key:
+        str
+        原processed 文件名（不含.pickle）
+    meta:
+        dict, default None
+        已经读取的meta 信息，为None 时从文件读取
+    """
+    pickle_path = os.path.join(processed_dir, file_key + '.pickle')
+    if not os.path.exists(pickle_path):
+        return False
+    if meta is None:
+        meta = read_meta(processed_dir)
+    file_meta = meta['files'].get(file_key)
+    if (file_meta is None
+            or os.path.getsize(pickle_path) != file_meta.get('size')):
+        return True
+    return source_digest(processed_dir, file_key,
+                         meta) != file_meta['digest']
+
+
+def finite_rows(values: np.ndarray):
+    """每一行是否所有列都是有限值，values 为一维时即为每个值是否有限"""
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        return np.isfinite(values)
+    return np.isfinite(values).all(axis=1)
+
+
+def _column_file(name, used: set):
+    """为一列生成不重复、可以作为文件名的文件名"""
+    stem = re.sub(r'[^0-9A-Za-z_.-]', '_', str(name))
+    file_name = stem + '.npy'
+    suffix = 1
+    while file_name in used:
+        file_name = '{}_{}.npy'.format(stem, suffix)
+        suffix += 1
+    used.add(file_name)
+    return file_name
+
+
+def _as_frame(data, file_key: str):
+    """将读取的Series 或DataFrame 统一为DataFrame，返回(frame, 是否为Series)"""
+    if isinstance(data, pd.Series):
+        name = data.name if data.name is not None else file_key
+        return data.to_frame(name), True
+    return data, False
+
+
+def _union_index(indexes: list):
+    """按出现的先后顺序合并多个index，保持第一个index 的行顺序"""
+    union = indexes[0]
+    for index in indexes[1:]:
+        union = union.append(index[~index.isin(union)])
+    return union
+
+
+def _write_table(table_dir: str, frames: dict, port: bool):
+    """
+    将属于同一张表的多个数据框按union 后的index 写入table_dir，每列一个.npy 文件
+
+    Return:
+    -------
+        dict, 该表的meta 信息，以及每个文件在表中所占的行（与表index 不同时）
+    """
+    os.makedirs(table_dir, exist_ok=True)
+    index = _union_index([frame.index for frame in frames.values()])
+    table_meta = {'nrows': len(index), 'columns': {}, 'valid': {}}
+    used_files = set()
+
+    # 保存index。组合表的每个level 保存为codes，level 的取值记在meta 或单独的文件中
+    if port:
+        index = index.remove_unused_levels()
+        table_meta['index_names'] = list(index.names)
+        table_meta['levels'] = {}
+        for name, level, codes in zip(index.names, index.levels,
+                                      index.codes):
+            np.save(os.path.join(table_dir, name + '.codes.npy'),
+                    np.asarray(codes))
+            if name == 'Trddt':
+                np.save(os.path.join(table_dir, name + '.levels.npy'),
+                        level.to_numpy())
+            else:
+                table_meta['levels'][name] = [str(lab) for lab in level]
+    else:
+        table_meta['index_names'] = [index.name]
+        np.save(os.path.join(table_dir, index.name + '.npy'),
+                index.to_numpy())
+
+    file_rows = {}
+    for file_key, frame in frames.items():
+        # 文件的行与表的行不一致时，记录该文件在表中所占的行
+        if len(frame.index) == len(index) and frame.index.equals(index):
+            aligned = frame
+            file_rows[file_key] = None
+        else:
+            rows_file = file_key + '.rows.npy'
+            np.save(os.path.join(table_dir, rows_file),
+                    index.isin(frame.index))
+            aligned = frame.reindex(index)
+            file_rows[file_key] = rows_file
+
+        for col in aligned.columns:
+            if str(col) in table_meta['columns']:
+                raise ValueError(
+                    "Column '{}' of {} already exists in the store.".format(
+                        col, file_key))
+            col_file = _column_file(col, used_files)
+            values = aligned[col].to_numpy(dtype=float)
+            np.save(os.path.join(table_dir, col_file), values)
+            table_meta['columns'][str(col)] = col_file
+            # 有效位图按位压缩保存，每8 行占1 个字节
+            valid_file = _column_file(str(col) + '.valid', used_files)
+            np.save(os.path.join(table_dir, valid_file),
+                    np.packbits(finite_rows(values)))
+            table_meta['valid'][str(col)] = valid_file
+
+    return table_meta, file_rows
+
+
+def write_store(processed_dir: str, files: list = None):
+    """
+    将processed_dir 中保存的各个features pickle 整理为按列存储的features 库
+
+    Parameters:
+    -----------
+    processed_dir:
+        str
+        保存processed data 的文件夹
+    files:
+        list of str, default None
+        需要整理的文件名（不含.pickle），为None 时使用PROCESSED_FILES 中存在的文件
+    """
+    if files is None:
+        files = [
+            key for key in PROCESSED_FILES if os.path.exists(
+                os.path.join(processed_dir, key + '.pickle'))
+        ]
+
+    # 按index 的层数将文件分到日期表和组合表中
+    tables = {'date': {}, 'port': {}}
+    meta = {'version': STORE_VERSION, 'tables': {}, 'files': {}}
+    for file_key in files:
+        data = pd.read_pickle(
+            os.path.join(processed_dir, file_key + '.pickle'))
+        frame, is_series = _as_frame(data, file_key)
+        table = 'port' if isinstance(frame.index, pd.MultiIndex) else 'date'
+        tables[table][file_key] = frame
+        stat = os.stat(os.path.join(processed_dir, file_key + '.pickle'))
+        meta['files'][file_key] = {
+            'table': table,
+            'columns': [str(col) for col in frame.columns],
+            'series': is_series,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'digest': _hash_pickle(processed_dir, file_key)
+        }
+
+    root = store_path(processed_dir)
+    for table, frames in tables.items():
+        if len(frames) == 0:
+            continue
+        table_meta, file_rows = _write_table(os.path.join(root, table),
+                                             frames,
+                                             port=(table == 'port'))
+        meta['tables'][table] = table_meta
+        for file_key, rows_file in file_rows.items():
+            meta['files'][file_key]['rows'] = rows_file
+
+    # 最后写入meta，meta 存在即表示库已经完整
+    with open(os.path.join(root, META_FILE), 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+
+
+def read_meta(processed_dir: str):
+    """读取features 库的meta 信息"""
+    with open(os.path.join(store_path(processed_dir), META_FILE)) as meta_file:
+        return json.load(meta_file)
+
+
+def _read_index(table_dir: str, table_meta: dict, port: bool, mmap: bool):
+    """读取一张表的index，同一个库的index 只构建一次"""
+    cache_key = (os.path.abspath(table_dir),
+                 os.path.getmtime(os.path.join(table_dir, '..', META_FILE)))
+    if cache_key in _INDEX_CACHE:
+        return _INDEX_CACHE[cache_key]
+
+    mmap_mode = 'r' if mmap else None
+    if port:
+        levels, codes = [], []
+        for name in table_meta['index_names']:
+            codes.append(
+                np.load(os.path.join(table_dir, name + '.codes.npy'),
+                        mmap_mode=mmap_mode))
+            if name == 'Trddt':
+                levels.append(
+                    pd.Index(np.load(
+                        os.path.join(table_dir, name + '.levels.npy')),
+                             name=name))
+            else:
+                levels.append(pd.Index(table_meta['levels'][name], name=name))
+        index = pd.MultiIndex(levels=levels,
+                              codes=codes,
+                              names=table_meta['index_names'],
+                              verify_integrity=False)
+    else:
+        name = table_meta['index_names'][0]
+        index = pd.Index(np.load(os.path.join(table_dir, name + '.npy')),
+                         name=name)
+
+    _INDEX_CACHE[cache_key] = index
+    return index
+
+
+def read_columns(processed_dir: str,
+                 file_key: str,
+                 columns: list = None,
+                 mmap: bool = True,
+                 meta: dict = None):
+    """
+    从features 库中读取某个原processed 文件的若干列，只加载需要的列
+
+    Parameters:
+    -----------
+    processed_dir:
+        str
+        保存processed data 的文件夹
+    file_key:
+        str
+        原processed 文件名（不含.pickle），如'std_features'
+    columns:
+        list of str, default None
+        需要读取的列，为None 时读取该文件的所有列
+    mmap:
+        bool, default True
+        是否以memory map 的方式读取列。结果中的列直接引用memory map 的数组（只读），
+        只有该文件在表中所占的行不连续时才会复制
+    meta:
+        dict, default None
+        已经读取的meta 信息，为None 时从文件读取
+
+    Return:
+    -------
+        pd.DataFrame，原文件为Series 且读取全部列时返回pd.Series
+    """
+    if meta is None:
+        meta = read_meta(processed_dir)
+    file_meta = meta['files'][file_key]
+    table = file_meta['table']
+    table_meta = meta['tables'][table]
+    table_dir = os.path.join(store_path(processed_dir), table)
+    mmap_mode = 'r' if mmap else None
+
+    index = _read_index(table_dir, table_meta, table == 'port', mmap)
+    rows = None
+    if file_meta.get('rows') is not None:
+        rows = _row_selector(
+            np.load(os.path.join(table_dir, file_meta['rows'])))
+        index = index[rows]
+
+    squeeze = columns is None and file_meta['series']
+    if columns is None:
+        columns = file_meta['columns']
+    data = {}
+    for col in columns:
+        values = np.load(os.path.join(table_dir, table_meta['columns'][col]),
+                         mmap_mode=mmap_mode)
+        data[col] = values if rows is None else values[rows]
+
+    # copy=False 时各列不会被合并为一个新的二维数组，仍然引用（memory map 的）原数组
+    if squeeze:
+        col = columns[0]
+        name = None if col == file_key else col
+        return pd.Series(data[col], index=index, name=name, copy=False)
+    return pd.DataFrame(data, index=index, columns=columns, copy=False)
+
+
+def _row_selector(rows: np.ndarray):
+    """
+    文件在表中所占的行。这些行连续时返回slice，取出的列仍是原数组的view；
+    否则只能按位置取出（会复制数据）
+    """
+    positions = np.flatnonzero(rows)
+    if len(positions) == 0:
+        return slice(0, 0)
+    if positions[-1] - positions[0] + 1 == len(positions):
+        return slice(int(positions[0]), int(positions[-1]) + 1)
+    return positions
+
+
+def read_valid(processed_dir: str,
+               file_key: str,
+               columns: list = None,
+               meta: dict = None):
+    """
+    从features 库中读取某个原processed 文件若干列的有效位图，返回每一行是否所有列都不是NaN。
+    行的顺序与read_columns 的结果相同。库中没有保存位图时由列的值计算
+
+    Parameters:
+    -----------
+    processed_dir, file_key, columns, meta:
+        见read_columns
+
+    Return:
+    -------
+        np.ndarray, bool
+    """
+    if meta is None:
+        meta = read_meta(processed_dir)
+    file_meta = meta['files'][file_key]
+    table_meta = meta['tables'][file_meta['table']]
+    table_dir = os.path.join(store_path(processed_dir), file_meta['table'])
+    if columns is None:
+        columns = file_meta['columns']
+
+    valid = np.ones(table_meta['nrows'], dtype=bool)
+    valid_files = table_meta.get('valid', {})
+    for col in columns:
+        if col in valid_files:
+            bits = np.load(os.path.join(table_dir, valid_files[col]))
+            valid &= np.unpackbits(bits,
+                                   count=table_meta['nrows']).astype(bool)
+        else:
+            valid &= finite_rows(
+                np.load(os.path.join(table_dir, table_meta['columns'][col]),
+                        mmap_mode='r'))
+    if file_meta.get('rows') is not None:
+        valid = valid[np.load(os.path.join(table_dir, file_meta['rows']))]
+    return valid
+
+
+@click.command()
+@click.argument('processed_dir',
+                type=click.Path(exists=True, file_okay=False, writable=True))
+def main(processed_dir):
+    # 将processed_dir 中的features pickle 整理为按列存储的features 库
+    write_store(processed_dir)
+
+
+if __name__ == "__main__":
+    main()
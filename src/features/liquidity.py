@@ -0,0 +1,296 @@
+"""
+组合的流动性指标：Roll 有效价差、Amivest 流动性比率、零收益天数占比和Pastor-Stambaugh 反转系数gamma。
+先将prepared data 整理为(日期 x 股票) 的稠密面板，用编译的滚动窗口函数计算每只股票的指标，
+再与amihud 相同，由rpt.weighted_average_by_group 以当日成交金额为权重，
+在每天的(cap_group, rev_group) 组合内加权平均。
+"""
+import numba
+import numpy as np
+import pandas as pd
+from src.data import preparing_data as predata
+from src.features import process_data_api as proda
+from src.features import reverse_port_ret as rpt
+
+LIQUIDITY_MEASURES = ['roll_spread', 'amivest', 'zero_ret', 'ps_gamma']
+
+# Pastor-Stambaugh 回归中成交金额的单位（百万）
+_PS_VOLUME_SCALE = 1e-6
+
+
+def _dense_positions(index: pd.MultiIndex):
+    """
+    返回以(Stkcd, Trddt) 为index 的每一行在稠密面板中的位置
+
+    Return:
+    -------
+        tuple, (日期index, 股票index, 行位置, 列位置)
+    """
+    dates = index.get_level_values('Trddt')
+    stocks = index.get_level_values('Stkcd')
+    date_index = pd.Index(dates.unique()).sort_values()
+    stock_index = pd.Index(stocks.unique()).sort_values()
+    return (date_index, stock_index, date_index.get_indexer(dates),
+            stock_index.get_indexer(stocks))
+
+
+def _to_dense(values: np.ndarray, rows: np.ndarray, cols: np.ndarray,
+              shape: tuple):
+    """将一列长数据放入(日期 x 股票) 的稠密面板，缺失的位置为NaN。按列存储，方便逐只股票滚动"""
+    dense = np.full(shape, np.nan, order='F')
+    dense[rows, cols] = values
+    return dense
+
+
+@numba.jit(nopython=True, parallel=True)
+def _roll_spread_kernel(ret, window, min_periods):
+    """
+    Roll 有效价差：2 * sqrt(-cov(r_t, r_{t-1}))，自协方差为正时记为0。
+    t 期的窗口包含(t-window, t] 内前后两天收益率都存在的配对。
+    窗口移动时加入新的配对、减去离开窗口的配对，每只股票只遍历一次
+    """
+    n_dates, n_stocks = ret.shape
+    result = np.full((n_dates, n_stocks), np.nan)
+    for j in numba.prange(n_stocks):
+        count, sum_x, sum_y, sum_xy = 0, 0.0, 0.0, 0.0
+        for t in range(n_dates):
+            # s 期的配对为(r_s, r_{s-1})，加入t 期的配对，减去t-window 期的配对
+            for s, sign in ((t, 1), (t - window, -1)):
+                if s < 1:
+                    continue
+                x, y = ret[s, j], ret[s - 1, j]
+                if np.isnan(x) or np.isnan(y):
+                    continue
+                count += sign
+                sum_x += sign * x
+                sum_y += sign * y
+                sum_xy += sign * x * y
+            if count < max(min_periods, 2):
+                continue
+            cov = (sum_xy - sum_x * sum_y / count) / (count - 1)
+            result[t, j] = 2.0 * np.sqrt(-cov) if cov < 0 else 0.0
+    return result
+
+
+@numba.jit(nopython=True, parallel=True)
+def _amivest_kernel(ret, dollar_volume, window, min_periods):
+    """Amivest 流动性比率：窗口内非零收益日的成交金额之和 / 收益率绝对值之和，窗口内的和滚动更新"""
+    n_dates, n_stocks = ret.shape
+    result = np.full((n_dates, n_stocks), np.nan)
+    for j in numba.prange(n_stocks):
+        count, nonzero, sum_volume, sum_abs_ret = 0, 0, 0.0, 0.0
+        for t in range(n_dates):
+            for s, sign in ((t, 1), (t - window, -1)):
+                if s < 0:
+                    continue
+                r, v = ret[s, j], dollar_volume[s, j]
+                if np.isnan(r) or np.isnan(v):
+                    continue
+                count += sign
+                if r != 0:
+                    nonzero += sign
+                    sum_volume += sign * v
+                    sum_abs_ret += sign * abs(r)
+            # 没有非零收益日时和为0，避免相减留下的舍入误差
+            if count >= min_periods and nonzero > 0 and sum_abs_ret > 0:
+                result[t, j] = sum_volume / sum_abs_ret
+    return result
+
+
+@numba.jit(nopython=True, parallel=True)
+def _zero_ret_kernel(ret, window, min_periods):
+    """窗口内收益率为零的交易日占有交易日的比例，窗口内的计数滚动更新"""
+    n_dates, n_stocks = ret.shape
+    result = np.full((n_dates, n_stocks), np.nan)
+    for j in numba.prange(n_stocks):
+        count, zeros = 0, 0
+        for t in range(n_dates):
+            for s, sign in ((t, 1), (t - window, -1)):
+                if s < 0:
+                    continue
+                r = ret[s, j]
+                if np.isnan(r):
+                    continue
+                count += sign
+                if r == 0:
+                    zeros += sign
+            if count >= min_periods and count > 0:
+                result[t, j] = zeros / count
+    return result
+
+
+@numba.jit(nopython=True)
+def _det3(mat):
+    """3 x 3 矩阵的行列式"""
+    return (mat[0, 0] * (mat[1, 1] * mat[2, 2] - mat[1, 2] * mat[2, 1]) -
+            mat[0, 1] * (mat[1, 0] * mat[2, 2] - mat[1, 2] * mat[2, 0]) +
+            mat[0, 2] * (mat[1, 0] * mat[2, 1] - mat[1, 1] * mat[2, 0]))
+
+
+@numba.jit(nopython=True, parallel=True)
+def _ps_gamma_kernel(ret, ret_exc, dollar_volume, window, min_periods):
+    """
+    Pastor-Stambaugh gamma：窗口内回归
+    r^e_s = theta + phi * r_{s-1} + gamma * sign(r^e_{s-1}) * v_{s-1}，返回gamma。
+    只使用窗口内已经实现的收益，不包含未来的信息。
+    窗口内的X'X、X'y 随窗口移动加入新的一行、减去离开窗口的一行
+    """
+    n_dates, n_stocks = ret.shape
+    result = np.full((n_dates, n_stocks), np.nan)
+    for j in numba.prange(n_stocks):
+        xtx = np.zeros((3, 3))
+        xty = np.zeros(3)
+        solve = np.empty((3, 3))
+        count = 0
+        for t in range(n_dates):
+            for s, sign in ((t, 1.0), (t - window, -1.0)):
+                if s < 1:
+                    continue
+                y, r_lag = ret_exc[s, j], ret[s - 1, j]
+                exc_lag, v_lag = ret_exc[s - 1, j], dollar_volume[s - 1, j]
+                if (np.isnan(y) or np.isnan(r_lag) or np.isnan(exc_lag)
+                        or np.isnan(v_lag)):
+                    continue
+                count += int(sign)
+                x1 = r_lag
+                x2 = np.sign(exc_lag) * v_lag
+                xtx[0, 0] += sign
+                xtx[0, 1] += sign * x1
+                xtx[0, 2] += sign * x2
+                xtx[1, 1] += sign * x1 * x1
+                xtx[1, 2] += sign * x1 * x2
+                xtx[2, 2] += sign * x2 * x2
+                xty[0] += sign * y
+                xty[1] += sign * x1 * y
+                xty[2] += sign * x2 * y
+            if count < max(min_periods, 4):
+                continue
+            solve[:, :] = xtx
+            solve[1, 0], solve[2, 0], solve[2, 1] = xtx[0, 1], xtx[0, 2], xtx[
+                1, 2]
+            # 以Cramer 法则求gamma，设计矩阵退化时保留NaN
+            det = _det3(solve)
+            if abs(det) <= 1e-12 * abs(solve[0, 0] * solve[1, 1] *
+                                       solve[2, 2]):
+                continue
+            solve[:, 2] = xty
+            result[t, j] = _det3(solve) / det
+    return result
+
+
+def stock_liquidity(prepared_data: pd.DataFrame,
+                    window: int,
+                    market_ret: pd.Series = None,
+                    min_periods: int = None):
+    """
+    计算每只股票在过去window 个交易日内的各项流动性指标
+
+    Parameters:
+    -----------
+    prepared_data:
+        pd.DataFrame
+        以(Stkcd, Trddt) 为index，含有Dretwd、Clsprc 和Dnshrtrd 列的prepared data
+    window:
+        int
+        滚动窗口长度，按所有股票共同的交易日计
+    market_ret:
+        pd.Series, default None
+        以时间为index 的市场收益率，用于计算gamma 中的超额收益，为None 时从原始数据读取
+    min_periods:
+        int, default None
+        窗口内至少需要的有效观测数，为None 时取window 的一半
+
+    Return:
+    -------
+        pd.DataFrame，index 与prepared_data 相同，列为LIQUIDITY_MEASURES
+    """
+    if market_ret is None:
+        market_ret = predata.read_rm_data()
+    if min_periods is None:
+        min_periods = window // 2
+
+    date_index, stock_index, rows, cols = _dense_positions(
+        prepared_data.index)
+    shape = (len(date_index), len(stock_index))
+
+    ret_long = prepared_data['Dretwd'].to_numpy(dtype=float)
+    dollar_volume_long = (prepared_data['Clsprc'] *
+                          prepared_data['Dnshrtrd']).to_numpy(dtype=float)
+    market_long = market_ret.reindex(date_index).to_numpy(dtype=float)[rows]
+
+    ret = _to_dense(ret_long, rows, cols, shape)
+    dollar_volume = _to_dense(dollar_volume_long, rows, cols, shape)
+    ret_exc = _to_dense(ret_long - market_long, rows, cols, shape)
+
+    dense_measures = {
+        'roll_spread':
+        _roll_spread_kernel(ret, window, min_periods),
+        'amivest':
+        _amivest_kernel(ret, dollar_volume, window, min_periods),
+        'zero_ret':
+        _zero_ret_kernel(ret, window, min_periods),
+        'ps_gamma':
+        _ps_gamma_kernel(ret, ret_exc, dollar_volume * _PS_VOLUME_SCALE,
+                         window, min_periods)
+    }
+    return pd.DataFrame(
+        {name: dense[rows, cols]
+         for name, dense in dense_measures.items()},
+        index=prepared_data.index,
+        columns=LIQUIDITY_MEASURES)
+
+
+def calculate_liquidity(backward_window: int,
+                        prepared_data: pd.DataFrame = None,
+                        norm_ret: pd.Series = None,
+                        market_ret: pd.Series = None,
+                        min_periods: int = None):
+    """
+    计算反转组合排序期内的流动性指标，组合内的权重与amihud 相同，为当日的成交金额
+
+    Parameters:
+    -----------
+    backward_window:
+        int
+        排序期的长度，也是计算每只股票流动性指标的窗口长度
+    prepared_data:
+        pd.DataFrame, default None
+        已经读取的prepared data，为None 时从文件读取。传入的数据框不会被修改
+    norm_ret:
+        pd.Series, default None
+        calculate_norm_ret 计算好的标准化收益率，为None 时重新计算
+    market_ret:
+        pd.Series, default None
+        以时间为index 的市场收益率，为None 时从原始数据读取
+    min_periods:
+        int, default None
+        见stock_liquidity
+
+    Return:
+    -------
+        pd.DataFrame，以(Trddt, cap_group, rev_group) 为index，列为LIQUIDITY_MEASURES
+    """
+    if prepared_data is None:
+        prepared_data = predata.read_prepared_data()
+    if norm_ret is None:
+        norm_ret = proda.calculate_norm_ret(prepared_data, backward_window)
+
+    measures = stock_liquidity(prepared_data,
+                               backward_window,
+                               market_ret=market_ret,
+                               min_periods=min_periods)
+
+    # 先分组再加入流动性指标，避免指标中的NaN 影响分组时删除的行
+    grouped = proda.assign_portfolio_groups(prepared_data.copy(), norm_ret)
+    grouped = grouped.join(measures)
+    grouped['dollar_volume_today'] = grouped['Clsprc'] * grouped['Dnshrtrd']
+
+    port_liquidity = rpt.weighted_average_by_group(
+        grouped,
+        groupby_columns=['Trddt', 'cap_group', 'rev_group'],
+        calcu_column=LIQUIDITY_MEASURES,
+        weights_column='dollar_volume_today')
+    port_liquidity.index.names = ['Trddt', 'cap_group', 'rev_group']
+    return port_liquidity.reindex(['Small', '2', '3', '4', 'Big'],
+                                  level=1).reindex(
+                                      ['Lo-Hi', '2-9', '3-8', '4-7', '5-6'],
+                                      level=2)
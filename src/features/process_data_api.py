@@ -6,6 +6,7 @@ import pandas as pd
 import numpy as np
 from src.data import preparing_data as predata
 from src.features import reverse_port_ret as rpt
+from src.features import feature_store as fstore
 from aenum import Enum, NoAlias
 
 
@@ -43,7 +44,9 @@ def calcualte_market_exc_ret():
     return rm_exc
 
 
-def calculate_stds(std_roll_window: int = 20, forward_window: int = 5):
+def calculate_stds(std_roll_window: int = 20,
+                   forward_window: int = 5,
+                   market_index: pd.Series = None):
     """
     计算以过去std_roll_window 天滚动得到的市场历史波动率的对数值，以及相邻两天波动率的变动量、
     相邻forward_window 天波动率的变动量。
@@ -55,6 +58,9 @@ def calculate_stds(std_roll_window: int = 20, forward_window: int = 5):
     forward_window:
         int
         计算未来某些天的波动率的变动量所有的天数
+    market_index:
+        pd.Series, default None
+        市场指数序列，为None 时从原始数据文件读取
     Results:
     --------
     tuple:
@@ -63,7 +69,8 @@ def calculate_stds(std_roll_window: int = 20, forward_window: int = 5):
     """
 
     # 读取市场指数文件
-    market_index: pd.Series = predata.read_market_index_data()
+    if market_index is None:
+        market_index: pd.Series = predata.read_market_index_data()
 
     # 计算历史滚动波动率，以及其差分值（变动情况）
     rolling_std: pd.Series = market_index.rolling(window=std_roll_window).std()
@@ -74,52 +81,130 @@ def calculate_stds(std_roll_window: int = 20, forward_window: int = 5):
     return (rolling_std_log, delta_std_1day, delta_std_full_forward)
 
 
-def calculate_turnover(backward_window, forward_window):
+def _rolling_std_cumsum(values: np.ndarray, windows: list):
     """
-    根据输入的向前和向后窗口，计算组合的turnover。
+    使用累积和一次计算多个窗口的滚动（样本）标准差。
+    先减去均值再累加，以减小指数点位较大时平方和相减带来的精度损失。
 
-    Parameters：
+    Return:
+    -------
+        np.ndarray, (len(values), len(windows))，每个窗口前(window - 1) 行为NaN
+    """
+    n_obs = len(values)
+    stds = np.full((n_obs, len(windows)), np.nan)
+    if n_obs == 0:
+        return stds
+
+    centered = values - values.mean()
+    cum_sum = np.concatenate(([0.0], np.cumsum(centered)))
+    cum_sq_sum = np.concatenate(([0.0], np.cumsum(centered * centered)))
+    for col, window in enumerate(windows):
+        if window < 2 or window > n_obs:
+            continue
+        window_sum = cum_sum[window:] - cum_sum[:-window]
+        window_sq_sum = cum_sq_sum[window:] - cum_sq_sum[:-window]
+        variance = (window_sq_sum - window_sum * window_sum / window) / (
+            window - 1)
+        stds[window - 1:, col] = np.sqrt(np.maximum(variance, 0.0))
+    return stds
+
+
+def calculate_multi_window_stds(windows: list = (20, 40, 60, 120),
+                                diff_horizons: list = (1, 5),
+                                method: str = 'level',
+                                market_index: pd.Series = None):
+    """
+    一次计算多个滚动窗口下的市场波动率，以及其对数值和多个间隔的变动量，用于波动率窗口的稳健性检验。
+
+    Parameters:
     -----------
-    backward_window, forward_window:
-        int, 向前和向后计算组合的窗口长度
+    windows:
+        list of int, default (20, 40, 60, 120)
+        滚动计算标准差的窗口长度
+    diff_horizons:
+        list of int, default (1, 5)
+        计算波动率变动量时的间隔天数（与calculate_stds 中的1 和forward_window 对应）
+    method:
+        str, 'level' or 'return', default 'level'
+        'level' 与calculate_stds 相同，对市场指数点位计算标准差；
+        'return' 对市场指数的对数收益率计算标准差，即realized volatility
+    market_index:
+        pd.Series, default None
+        市场指数序列，为None 时从原始数据文件读取
+
+    Results:
+    --------
+    pd.DataFrame
+        与market_index 同index 的数据框。method='level' 时列名为std_w{window}、
+        std_log_w{window}、delta_std_w{window}_d{horizon}；
+        method='return' 时将其中的std 换为rv
     """
-    prepared_data: pd.DataFrame = predata.read_prepared_data()
-    turnover_df: pd.DataFrame = predata.read_turnover_data()
-    turnover_merged: pd.DataFrame = prepared_data.join(turnover_df,
-                                                       on=['Stkcd', 'Trddt'])
+    if method not in {'level', 'return'}:
+        raise ValueError("method must be 'level' or 'return'.")
 
-    rev_port_turnover: pd.Series = rpt.reverse_port_ret_quick(
-        turnover_merged,
-        backward_window=backward_window,
-        forward_window=forward_window,
-        backward_method=rpt._normalize_last,
-        forward_method=sum,
-        col_for_backward_looking='log_ret',
-        col_for_forward_looking='turnOver',
-        average_in='reverse_group').rename('turnover')
+    if market_index is None:
+        market_index: pd.Series = predata.read_market_index_data()
 
-    return rev_port_turnover
+    if method == 'level':
+        base: pd.Series = market_index
+        prefix = 'std'
+    else:
+        base: pd.Series = np.log(market_index).diff()
+        prefix = 'rv'
+
+    # 去掉空值后计算，最后再按原index 放回
+    base = base.dropna()
+    stds = _rolling_std_cumsum(base.to_numpy(dtype=float), list(windows))
+
+    columns = {}
+    for col, window in enumerate(windows):
+        std_values = stds[:, col]
+        columns['{}_w{}'.format(prefix, window)] = std_values
+        with np.errstate(divide='ignore'):
+            columns['{}_log_w{}'.format(prefix, window)] = np.log(std_values)
+        for horizon in diff_horizons:
+            delta = np.full(len(std_values), np.nan)
+            delta[horizon:] = std_values[horizon:] - std_values[:-horizon]
+            columns['delta_{}_w{}_d{}'.format(prefix, window, horizon)] = delta
 
+    multi_stds = pd.DataFrame(columns, index=base.index)
+    return multi_stds.reindex(market_index.index)
 
-def calculate_amihud(backward_window, forward_window):
+
+def calculate_norm_ret(prepared_data: pd.DataFrame, backward_window: int):
     """
-    以backward_window 和forward_window 为参数计算组合的amihud 指标。
+    计算每只股票过去backward_window 天标准化后的对数收益率，即反转组合排序所依据的列。
+    turnover 与amihud 的排序期相同，一起构建features 时可以共用该结果。
 
     Return:
     -------
-        list, 两个结果分别为amihud_backward 和amihud_forward，排序期和持有期平均的组合amihud
+        pd.Series，index 与prepared_data 相同
     """
-    # 计算amihud 指标的主函数
-    prepared_data: pd.DataFrame = predata.read_prepared_data()
+    return rpt.backward_rolling_apply(df=prepared_data,
+                                      window=backward_window,
+                                      method=rpt._normalize_last,
+                                      calcu_column='log_ret')
 
-    # 前一部分和计算反转组合收益的步骤一样
-    # add a column for nomolized return for each stock
-    prepared_data["norm_ret"] = rpt.backward_rolling_apply(
-        df=prepared_data,
-        window=backward_window,
-        method=rpt._normalize_last,
-        calcu_column="log_ret",
-    )
+
+def assign_portfolio_groups(prepared_data: pd.DataFrame, norm_ret: pd.Series):
+    """
+    与计算反转组合收益时相同，为每只股票每天标记所属的规模组、收益组和反转组合组别。
+    会修改并返回prepared_data，其中含有NaN 的行被删除。
+
+    Parameters:
+    -----------
+    prepared_data:
+        pd.DataFrame
+        以(Stkcd, Trddt) 为index 的prepared data
+    norm_ret:
+        pd.Series
+        calculate_norm_ret 计算的标准化收益率
+
+    Return:
+    -------
+        pd.DataFrame，增加了norm_ret、cap_group、ret_group 和rev_group 列
+    """
+    prepared_data["norm_ret"] = norm_ret
 
     # drop na values
     prepared_data.dropna(inplace=True)
@@ -145,6 +230,80 @@ def calculate_amihud(backward_window, forward_window):
     # 加入一组表示反转组合组别的代号
     prepared_data["rev_group"] = prepared_data["ret_group"].apply(
         rpt._creat_rev_group)
+    return prepared_data
+
+
+def calculate_turnover(backward_window,
+                       forward_window,
+                       prepared_data: pd.DataFrame = None,
+                       norm_ret: pd.Series = None):
+    """
+    根据输入的向前和向后窗口，计算组合的turnover。
+
+    Parameters：
+    -----------
+    backward_window, forward_window:
+        int, 向前和向后计算组合的窗口长度
+    prepared_data:
+        pd.DataFrame, default None
+        已经读取的prepared data，为None 时从文件读取
+    norm_ret:
+        pd.Series, default None
+        calculate_norm_ret 计算好的标准化收益率，为None 时重新计算
+    """
+    if prepared_data is None:
+        prepared_data = predata.read_prepared_data()
+    turnover_df: pd.DataFrame = predata.read_turnover_data()
+    turnover_merged: pd.DataFrame = prepared_data.join(turnover_df,
+                                                       on=['Stkcd', 'Trddt'])
+
+    rev_port_turnover: pd.Series = rpt.reverse_port_ret_quick(
+        turnover_merged,
+        backward_window=backward_window,
+        forward_window=forward_window,
+        backward_method=rpt._normalize_last,
+        forward_method=sum,
+        col_for_backward_looking='log_ret',
+        col_for_forward_looking='turnOver',
+        average_in='reverse_group',
+        norm_ret=norm_ret).rename('turnover')
+
+    return rev_port_turnover
+
+
+def calculate_amihud(backward_window,
+                     forward_window,
+                     prepared_data: pd.DataFrame = None,
+                     norm_ret: pd.Series = None):
+    """
+    以backward_window 和forward_window 为参数计算组合的amihud 指标。
+
+    Parameters：
+    -----------
+    backward_window, forward_window:
+        int, 向前和向后计算组合的窗口长度
+    prepared_data:
+        pd.DataFrame, default None
+        已经读取的prepared data，为None 时从文件读取。传入的数据框不会被修改
+    norm_ret:
+        pd.Series, default None
+        calculate_norm_ret 计算好的标准化收益率，为None 时重新计算
+
+    Return:
+    -------
+        list, 两个结果分别为amihud_backward 和amihud_forward，排序期和持有期平均的组合amihud
+    """
+    # 计算amihud 指标的主函数
+    if prepared_data is None:
+        prepared_data = predata.read_prepared_data()
+    else:
+        prepared_data = prepared_data.copy()
+
+    # 前一部分和计算反转组合收益的步骤一样
+    # add a column for nomolized return for each stock
+    if norm_ret is None:
+        norm_ret = calculate_norm_ret(prepared_data, backward_window)
+    prepared_data = assign_portfolio_groups(prepared_data, norm_ret)
 
     # %%
     # 计算每天的Amihud 指标
@@ -204,7 +363,67 @@ def calculate_ret_sign(port_ret: pd.Series):
     return port_ret.gt(0).astype(float).rename('ret_sign')
 
 
-def features_mul_dummy(features, dummy, broadcast_level='Trddt'):
+class DummyInteraction(object):
+    """
+    features 与dummy 交互项的惰性表示。只保存(features, dummy) 这一对变量，
+    直到组装OLS 的设计矩阵时才按行相乘，并直接写入预先分配好的数组中。
+    """
+    __slots__ = ('features', 'dummy', 'broadcast_level')
+
+    def __init__(self, features, dummy, broadcast_level='Trddt'):
+        """
+        Parameters:
+        -----------
+        features:
+            pd.Series or pd.DataFrame
+            需要与dummy 相乘的features 变量数据
+        dummy:
+            pd.Series
+            与features 进行相乘的dummy
+        broadcast_level:
+            str, default 'Trddt'
+            二者相乘时进行broadcast 依据的index 名
+        """
+        if not isinstance(features, (pd.Series, pd.DataFrame)):
+            raise TypeError('features must be pd.Series or pd.DataFrame!')
+        if not isinstance(dummy, pd.Series):
+            raise TypeError('dummy must be pd.Series!')
+        self.features = features
+        self.dummy = dummy
+        self.broadcast_level = broadcast_level
+
+    @property
+    def name(self):
+        """与features_mul_dummy 返回的Series 同名；features 为DataFrame 时与其一样没有name"""
+        if isinstance(self.features, pd.DataFrame):
+            raise AttributeError(
+                "'DummyInteraction' of a DataFrame has no attribute 'name'")
+        return self.features.name + '_' + self.dummy.name
+
+    @property
+    def columns(self):
+        """交互项在设计矩阵中占据的列名list"""
+        if isinstance(self.features, pd.Series):
+            return [self.name]
+        return [col + '_' + self.dummy.name for col in self.features.columns]
+
+    def realize(self):
+        """
+        按照features_mul_dummy 的方式实际计算出交互项，仅用于查看或对比。
+
+        Return:
+        -------
+            pd.Series or pd.DataFrame
+        """
+        return features_mul_dummy(self.features,
+                                  self.dummy,
+                                  broadcast_level=self.broadcast_level)
+
+    def __repr__(self):
+        return 'DummyInteraction({})'.format(', '.join(self.columns))
+
+
+def features_mul_dummy(features, dummy, broadcast_level='Trddt', lazy=False):
     """
     输入一个features 与一个dummy 变量，返回一个按照index 使二者相乘后得到的变量
 
@@ -219,13 +438,20 @@ def features_mul_dummy(features, dummy, broadcast_level='Trddt'):
     broadcast_level:
         str or list, default 'Trddt'
         二者相乘时进行broadcast 依据的column 或index 名
+    lazy:
+        bool, default False
+        为True 时不进行相乘，返回一个DummyInteraction，在组装设计矩阵时才计算
 
     Return:
     -------
         pd.Series or pd.DataFrame
         dummy 与features 相乘后的变量。其类型与features 一致，长度应该和二者最长的相等
+        lazy 为True 时返回DummyInteraction
     """
 
+    if lazy:
+        return DummyInteraction(features, dummy, broadcast_level)
+
     features_with_dummy = features.mul(dummy, axis=0, level=broadcast_level)
     if isinstance(features_with_dummy, pd.Series):
         s_name = features.name + '_' + dummy.name
@@ -291,11 +517,49 @@ class ProcessedType(Enum):
     amihud_for = 'amihud_features'
     ret_sign = 'ret_sign_features'
     three_fac = '3_fac_features'
+    roll_spread = 'liquidity_features'
+    amivest = 'liquidity_features'
+    zero_ret = 'liquidity_features'
+    ps_gamma = 'liquidity_features'
+
+
+def _processed_columns(which: ProcessedType, columns: list):
+    """
+    返回某种ProcessedType 在其所属文件中需要读取的列
+
+    Parameters:
+    -----------
+    which:
+        ProcessedType
+    columns:
+        list
+        所属文件中的所有列名
+
+    Returns:
+        tuple, (需要读取的列名list, 是否以Series 返回)。读取整个文件时为(None, None)
+    """
+    # 同框保存了多种数据，按照col name 读取相应列
+    if which in (ProcessedType.rolling_std_log, ProcessedType.delta_std_full,
+                 ProcessedType.amihud_back, ProcessedType.amihud_for,
+                 ProcessedType.roll_spread, ProcessedType.amivest,
+                 ProcessedType.zero_ret, ProcessedType.ps_gamma):
+        return [which.name], True
+    # 同框保存了多种数据，需要的数据为多列时
+    elif which == ProcessedType.delta_std:
+        delta_std_col = [
+            col for col in columns if col.startswith('delta_std_t')
+        ]
+        return delta_std_col, False
+    # 单个的数据框即保存了所需的数据，直接读取
+    else:
+        return None, None
 
 
 def get_processed(which: ProcessedType, from_dir: str = 'data/processed/'):
     """
-    读取某一种保存过的processed data
+    读取某一种保存过的processed data。
+    如果from_dir 中已经建好了按列存储的features 库（见feature_store.py），则只读取所需的列，
+    否则读取整个pickle 文件。
 
     Parameters:
     -----------
@@ -313,23 +577,77 @@ def get_processed(which: ProcessedType, from_dir: str = 'data/processed/'):
     if from_dir[-1] != '/':
         from_dir = from_dir + '/'
 
+    # 优先从features 库中只读取需要的列
+    if fstore.has_store(from_dir):
+        meta = fstore.read_meta(from_dir)
+        if (which.value in meta['files']
+                and not fstore.is_stale(from_dir, which.value, meta)):
+            columns, as_series = _processed_columns(
+                which, meta['files'][which.value]['columns'])
+            feature_frame = fstore.read_columns(from_dir,
+                                                which.value,
+                                                columns=columns,
+                                                meta=meta)
+            return feature_frame.iloc[:, 0] if as_series else feature_frame
+
     # 拼接出整个的文件路径，然后将保存的数据框读取出来。
     feature_path = from_dir + which.value + '.pickle'
     feature_frame = pd.read_pickle(feature_path)
+    return select_processed(which, feature_frame)
 
-    # 同框保存了多种数据，按照col name 读取相应列
-    if which in (ProcessedType.rolling_std_log, ProcessedType.delta_std_full,
-                 ProcessedType.amihud_back, ProcessedType.amihud_for):
-        return feature_frame[which.name]
-    # 同框保存了多种数据，需要的数据为多列时
-    elif which == ProcessedType.delta_std:
-        delta_std_col = [
-            col for col in feature_frame if col.startswith('delta_std_t')
-        ]
-        return feature_frame[delta_std_col]
-    # 单个的数据框即保存了所需的数据，直接读取
-    else:
+
+def get_processed_valid(which: ProcessedType,
+                        from_dir: str = 'data/processed/'):
+    """
+    从features 库中读取某一种processed data 的有效位图，即get_processed 结果的每一行是否没有NaN。
+    from_dir 中没有建好features 库、或库中的数据已经过期时返回None
+
+    Parameters:
+    -----------
+    which:
+        ProcessedType
+    from_dir:
+        str
+        保存process 过后数据的文件夹名
+
+    Returns:
+        np.ndarray of bool or None
+    """
+    if from_dir[-1] != '/':
+        from_dir = from_dir + '/'
+    if not fstore.has_store(from_dir):
+        return None
+    meta = fstore.read_meta(from_dir)
+    if (which.value not in meta['files']
+            or fstore.is_stale(from_dir, which.value, meta)):
+        return None
+    columns, _ = _processed_columns(which,
+                                    meta['files'][which.value]['columns'])
+    return fstore.read_valid(from_dir, which.value, columns=columns, meta=meta)
+
+
+def select_processed(which: ProcessedType, feature_frame):
+    """
+    从某种ProcessedType 所属的整个文件的数据中，取出该类型的数据
+
+    Parameters:
+    -----------
+    which:
+        ProcessedType
+    feature_frame:
+        pd.DataFrame or pd.Series
+        which.value 对应文件中保存的数据
+
+    Returns:
+        pd.DataFrame or pd.Series，与get_processed 的结果相同
+    """
+    columns, as_series = _processed_columns(
+        which, getattr(feature_frame, 'columns', []))
+    if columns is None:
         return feature_frame
+    elif as_series:
+        return feature_frame[columns[0]]
+    return feature_frame[columns]
 
 
 def get_rm_features(file='data/processed/rm_features.pickle'):
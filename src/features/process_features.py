@@ -1,33 +1,104 @@
+import json
+import os
+import time
 import pandas as pd
 import click
 from src.features import process_data_api as proda
+from src.features import liquidity as liq
 from src.data import preparing_data as preda
 
+FEATURES_TYPES = [
+    'rm_features', 'std_features', 'turnover_features', 'amihud_features',
+    'ret_sign_features', '3_fac_features', 'multi_std_features',
+    'liquidity_features'
+]
 
-@click.command()
-@click.option('--which',
-              help='the type of ols features data frame to generate',
-              type=click.Choice(choices=[
-                  'rm_features', 'std_features', 'turnover_features',
-                  'amihud_features', 'ret_sign_features', '3_fac_features'
-              ]))
-@click.option(
-    '--windows',
-    help='Backward and forward window length to calculate some features.',
-    nargs=2,
-    type=int)
-@click.argument('input_file', type=click.Path(exists=True, readable=True))
-@click.argument('output_file', type=click.Path(writable=True))
-def main(which, windows, input_file, output_file):
+# 多窗口波动率features 使用的滚动窗口
+MULTI_STD_WINDOWS = (20, 40, 60, 120)
 
-    # 读取使用**超额收益率** 计算的反转组合收益数据框，并取出时间index
-    reverse_ret_dframe: pd.Series = proda.get_targets(input_file)
-    year_index: pd.Series = proda.obtain_feature_index(reverse_ret_dframe)
+# 记录文件夹中features 所用窗口长度的元数据文件
+WINDOWS_FILE = 'windows.json'
 
-    # 取出过去和未来的窗口长度
-    if len(windows) != 0:
-        backward, forward = windows
 
+def write_windows(features_dir: str, backward: int, forward: int):
+    """
+    在保存features 的文件夹中记录生成features 时的向后和向前窗口长度，
+    回归时从这里读取持有期长度，不再依赖文件夹的名称（见feature_registry.windows_from_dir）
+    """
+    with open(os.path.join(features_dir, WINDOWS_FILE), 'w') as meta_file:
+        json.dump({
+            'backward_window': backward,
+            'forward_window': forward
+        },
+                  meta_file,
+                  indent=2)
+
+
+class SharedInputs(object):
+    """
+    一次构建多种features 时共用的输入。prepared data 和排序期的标准化收益率只在第一次用到时计算，
+    之后turnover、amihud 和流动性指标直接复用。
+    """
+    def __init__(self, backward_window):
+        self._backward_window = backward_window
+        self._prepared_data = None
+        self._norm_ret = None
+        self._market_index = None
+        self._market_ret = None
+
+    @property
+    def market_ret(self):
+        if self._market_ret is None:
+            self._market_ret = preda.read_rm_data()
+        return self._market_ret
+
+    @property
+    def market_index(self):
+        if self._market_index is None:
+            self._market_index = preda.read_market_index_data()
+        return self._market_index
+
+    @property
+    def prepared_data(self):
+        if self._prepared_data is None:
+            self._prepared_data = preda.read_prepared_data()
+        return self._prepared_data
+
+    @property
+    def norm_ret(self):
+        if self._norm_ret is None:
+            self._norm_ret = proda.calculate_norm_ret(self.prepared_data,
+                                                      self._backward_window)
+        return self._norm_ret
+
+
+def build_features(which, backward, forward, reverse_ret_dframe, year_index,
+                   shared: SharedInputs = None):
+    """
+    计算一种features 数据框
+
+    Parameters:
+    -----------
+    which:
+        str
+        FEATURES_TYPES 中的一种
+    backward, forward:
+        int
+        向前和向后的窗口长度
+    reverse_ret_dframe:
+        pd.Series
+        作为targets 的反转组合收益
+    year_index:
+        pd.Index
+        features 使用的时间index
+    shared:
+        SharedInputs, default None
+        多种features 共用的输入，为None 时turnover 和amihud 各自读取数据
+
+    Return:
+    -------
+        pd.Series or pd.DataFrame
+    """
     if which == 'rm_features':
         # 使用市场超额收益率，错位算出未来t+1,...t+forward 期的列，作为一个features 保存
         market_ret_exc: pd.Series = proda.calcualte_market_exc_ret()
@@ -40,7 +111,8 @@ def main(which, windows, input_file, output_file):
         # 使用波动率的差值，错位计算出未来t+1,...,t+forward 期的列，同时加上一列波动率本身的值，
         # 一列整个区间上的波动率变动的值，作为features 保存
         rolling_std_log, delta_std, delta_std_forward = proda.calculate_stds(
-            forward_window=forward)
+            forward_window=forward,
+            market_index=None if shared is None else shared.market_index)
         std_features: pd.DataFrame = proda.shift_leading_gradually(
             delta_std.reindex(year_index),
             col_name_prefix='delta_std',
@@ -51,13 +123,19 @@ def main(which, windows, input_file, output_file):
     elif which == 'turnover_features':
         # 计算组合的turnover，依赖向前和向后的窗口长度
         turnover_series: pd.Series = proda.calculate_turnover(
-            backward, forward)
+            backward,
+            forward,
+            prepared_data=None if shared is None else shared.prepared_data,
+            norm_ret=None if shared is None else shared.norm_ret)
         features_df: pd.Series = turnover_series.reindex(year_index,
                                                          level='Trddt')
     elif which == 'amihud_features':
         # 计算组合的Amihud 指标，依赖向前和向后的窗口长度
         amihud_backward, amihud_forward = proda.calculate_amihud(
-            backward, forward)
+            backward,
+            forward,
+            prepared_data=None if shared is None else shared.prepared_data,
+            norm_ret=None if shared is None else shared.norm_ret)
         features_df = pd.concat([amihud_backward, amihud_forward], axis=1)
         features_df: pd.DataFrame = features_df.reindex(
             year_index, level='Trddt').reindex(
@@ -65,6 +143,33 @@ def main(which, windows, input_file, output_file):
                 level=1).reindex(['Lo-Hi', '2-9', '3-8', '4-7', '5-6'],
                                  level=2)
 
+    elif which == 'multi_std_features':
+        # 一次计算多个窗口下基于指数点位和基于收益率的波动率，变动量错位为未来horizon 天内的变动
+        market_index = (preda.read_market_index_data()
+                        if shared is None else shared.market_index)
+        horizons = sorted({1, forward})
+        multi_std_list = [
+            proda.calculate_multi_window_stds(windows=MULTI_STD_WINDOWS,
+                                              diff_horizons=horizons,
+                                              method=method,
+                                              market_index=market_index)
+            for method in ('level', 'return')
+        ]
+        multi_std: pd.DataFrame = pd.concat(multi_std_list, axis=1)
+        for col in multi_std.columns:
+            if col.startswith('delta_'):
+                horizon = int(col.rsplit('_d', 1)[1])
+                multi_std[col] = multi_std[col].shift(-horizon)
+        features_df: pd.DataFrame = multi_std.reindex(year_index)
+    elif which == 'liquidity_features':
+        # 计算排序期内组合的Roll 价差、Amivest、零收益天数占比和Pastor-Stambaugh gamma
+        liquidity_df: pd.DataFrame = liq.calculate_liquidity(
+            backward,
+            prepared_data=None if shared is None else shared.prepared_data,
+            norm_ret=None if shared is None else shared.norm_ret,
+            market_ret=None if shared is None else shared.market_ret)
+        features_df: pd.DataFrame = liquidity_df.reindex(year_index,
+                                                         level='Trddt')
     elif which == 'ret_sign_features':
         # 计算表示组合收益正负的虚拟变量
         features_df: pd.Series = proda.calculate_ret_sign(reverse_ret_dframe)
@@ -72,9 +177,54 @@ def main(which, windows, input_file, output_file):
         # 取出三因子
         features_df = preda.read_three_factors().reindex(year_index)
     else:
-        print('Wrong type of features data frame uncaught.')
+        raise ValueError('Wrong type of features data frame: {}'.format(which))
+
+    return features_df
+
+
+@click.command()
+@click.option('--which',
+              help='the type of ols features data frame to generate, '
+              "'all' to generate every type into the OUTPUT_FILE directory",
+              type=click.Choice(choices=FEATURES_TYPES + ['all']))
+@click.option(
+    '--windows',
+    help='Backward and forward window length to calculate some features.',
+    nargs=2,
+    type=int)
+@click.argument('input_file', type=click.Path(exists=True, readable=True))
+@click.argument('output_file', type=click.Path(writable=True))
+def main(which, windows, input_file, output_file):
+
+    # 读取使用**超额收益率** 计算的反转组合收益数据框，并取出时间index
+    reverse_ret_dframe: pd.Series = proda.get_targets(input_file)
+    year_index: pd.Series = proda.obtain_feature_index(reverse_ret_dframe)
+
+    # 取出过去和未来的窗口长度
+    backward, forward = windows if windows else (None, None)
+
+    if which != 'all':
+        features_df = build_features(which, backward, forward,
+                                     reverse_ret_dframe, year_index)
+        features_df.to_pickle(output_file)
+        if windows:
+            write_windows(os.path.dirname(output_file) or '.', backward,
+                          forward)
+        return
 
-    features_df.to_pickle(output_file)
+    # 在同一个进程中计算所有features，共用targets、prepared data 和排序期的标准化收益率，
+    # output_file 此时为保存所有features 的文件夹
+    shared = SharedInputs(backward_window=backward)
+    for features_type in FEATURES_TYPES:
+        start = time.time()
+        features_df = build_features(features_type, backward, forward,
+                                     reverse_ret_dframe, year_index, shared)
+        features_df.to_pickle(
+            os.path.join(output_file, features_type + '.pickle'))
+        print('Built {} in {:.2f}s.'.format(features_type,
+                                           time.time() - start))
+    if windows:
+        write_windows(output_file, backward, forward)
 
 
 if __name__ == "__main__":
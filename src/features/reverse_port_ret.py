@@ -144,7 +144,7 @@ def creat_group_signs(df: pd.Series, column_to_cut: str, groupby_column: str,
 def weighted_average_by_group(
         df: pd.DataFrame,
         groupby_columns: list = ['Trddt', 'cap_group', 'ret_group'],
-        calcu_column: str = 'cum_ret',
+        calcu_column='cum_ret',
         weights_column: str = 'dollar_volume'):
     """
     输入一个数据框，计算每天、每个规模组、每个收益组的加权平均回报率。
@@ -159,8 +159,8 @@ def weighted_average_by_group(
         list of str, Default ['Trddt', 'cap_group', 'ret_group']
         用于分组的列名。默认为时间、规模组、收益组
     calcu_columns:
-        str, Default 'cum_ret'
-        用于计算加权平均值的列名
+        str or list of str, Default 'cum_ret'
+        用于计算加权平均值的列名。为list 时一次计算多列，每列只使用其自身非NaN 的行
     weights_column:
         str, Default 'dollar_volume'
         计算加权平均时的权重
@@ -168,11 +168,26 @@ def weighted_average_by_group(
     Returns:
     --------
     pandas.Series
-        以分组变量为MutipleIndex 的一列pandas.Series
+        以分组变量为MutipleIndex 的一列pandas.Series。
+        calcu_column 为list 时返回以其为列的pd.DataFrame
     """
 
     print('Calculating the weighted average return for mini group...')
 
+    if isinstance(calcu_column, list):
+        values = df[calcu_column]
+        weights = df[weights_column]
+        # 每列的权重只在该列有值的行上计入
+        valid_weights = values.notna().mul(weights, axis=0)
+        keys = [
+            df[col] if col in df.columns else df.index.get_level_values(col)
+            for col in groupby_columns
+        ]
+        weighted_sum = values.mul(weights, axis=0).groupby(
+            keys, observed=True).sum()
+        weights_sum = valid_weights.groupby(keys, observed=True).sum()
+        return weighted_sum / weights_sum.where(weights_sum > 0)
+
     @numba.jit(nopython=True, parallel=True)
     def _weighted_mean(data_col, weights_col):
         return (data_col * weights_col).sum() / weights_col.sum()
@@ -298,7 +313,8 @@ def reverse_port_ret_quick(dframe: pd.DataFrame,
                            col_for_backward_looking: str = 'log_ret',
                            col_for_forward_looking: str = 'Dretwd',
                            average_in: str = 'return_group',
-                           combine_style='sub'):
+                           combine_style='sub',
+                           norm_ret: pd.Series = None):
     """
     将如上计算反转组合收益率的步骤组合在一起，
     快速计算一个按前backward_window 排序，持有forward_window 的反转组合收益时间序列。
@@ -337,6 +353,11 @@ def reverse_port_ret_quick(dframe: pd.DataFrame,
         str
         用于指定形成反转组合的方式，'sub' 为low - high，'sum' 为low + high
 
+    norm_ret:
+        pd.Series, default None
+        已经按backward_window 计算好的标准化收益率，index 需与dframe 相同。
+        传入时不再重复进行向后滚动的计算
+
 
     Rerurns:
     --------
@@ -344,11 +365,13 @@ def reverse_port_ret_quick(dframe: pd.DataFrame,
         一个按时间和市值组别为index，反转组合标示（如Lo-Hi）为column 的数据框
     """
     # add a column for normaliezed return
-    dframe['norm_ret'] = backward_rolling_apply(
-        df=dframe,
-        window=backward_window,
-        method=backward_method,
-        calcu_column=col_for_backward_looking)
+    if norm_ret is None:
+        norm_ret = backward_rolling_apply(
+            df=dframe,
+            window=backward_window,
+            method=backward_method,
+            calcu_column=col_for_backward_looking)
+    dframe['norm_ret'] = norm_ret
 
     # add a column for cumulative return for each stosk
     dframe['forward_cum_col'] = forward_rolling_apply(
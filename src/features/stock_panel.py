@@ -0,0 +1,108 @@
+"""
+个股层面的面板，用于Fama-MacBeth 回归（见fama_macbeth.py）。每只股票每个交易日一行，
+含有与targets 相同方式计算的持有期累积超额收益，以及排序期的标准化收益率、平均换手率、
+平均amihud 和对数市值。
+"""
+import numpy as np
+import pandas as pd
+import click
+from src.data import preparing_data as predata
+from src.features import process_data_api as proda
+from src.features import reverse_port_ret as rpt
+from src.features import reverse_exc_ret as rer
+
+# 截面回归中使用的个股特征
+CHARACTERISTICS = ['norm_ret', 'turnover', 'amihud', 'size']
+
+
+def _backward_mean(dframe: pd.DataFrame, column: str, window: int):
+    """每只股票column 列在过去window 天的均值，窗口内至少需要一半的有效值"""
+    rolled = dframe[column].groupby(level='Stkcd').rolling(
+        window, min_periods=window // 2).mean()
+    # groupby().rolling() 会在index 前加入一层分组的level
+    if rolled.index.nlevels > dframe.index.nlevels:
+        rolled = rolled.droplevel(0)
+    return rolled.reindex(dframe.index)
+
+
+def build_stock_panel(backward_window: int,
+                      forward_window: int,
+                      prepared_data: pd.DataFrame = None,
+                      norm_ret: pd.Series = None,
+                      rf_series: pd.Series = None,
+                      turnover_df: pd.DataFrame = None):
+    """
+    计算个股面板
+
+    Parameters:
+    -----------
+    backward_window, forward_window:
+        int
+        排序期和持有期的长度
+    prepared_data:
+        pd.DataFrame, default None
+        已经读取的prepared data，为None 时从文件读取。传入的数据框不会被修改
+    norm_ret:
+        pd.Series, default None
+        calculate_norm_ret 计算好的标准化收益率，为None 时重新计算
+    rf_series:
+        pd.Series, default None
+        无风险收益率，为None 时从原始数据读取
+    turnover_df:
+        pd.DataFrame, default None
+        含有turnOver 列的换手率数据，为None 时从原始数据读取
+
+    Return:
+    -------
+        pd.DataFrame
+        以(Stkcd, Trddt) 为index，列为forward_ret 和CHARACTERISTICS。
+        forward_ret 为t + 1 期开始持有forward_window 天的累积超额收益，其余列为t 期及之前的值
+    """
+    if prepared_data is None:
+        prepared_data = predata.read_prepared_data()
+    if rf_series is None:
+        rf_series = predata.read_rf_data()
+    if turnover_df is None:
+        turnover_df = predata.read_turnover_data()
+    if norm_ret is None:
+        norm_ret = proda.calculate_norm_ret(prepared_data, backward_window)
+
+    dframe = rer.add_exc_ret_column(prepared_data, rf_series=rf_series)
+    dframe = dframe.join(turnover_df, on=['Stkcd', 'Trddt'])
+    dframe['amihud'] = dframe['Dretwd'].abs() / (dframe['Clsprc'] *
+                                                 dframe['Dnshrtrd'])
+    dframe['amihud'] = dframe['amihud'].replace([np.inf, -np.inf], np.nan)
+
+    # 与targets 相同，持有期从排序后的下一天开始
+    forward_ret = rpt.forward_rolling_apply(df=dframe,
+                                            window=forward_window,
+                                            method=rpt._cumulative_ret,
+                                            calcu_column='exc_ret')
+
+    panel = pd.DataFrame(
+        {
+            'forward_ret': forward_ret,
+            'norm_ret': norm_ret,
+            'turnover': _backward_mean(dframe, 'turnOver', backward_window),
+            'amihud': _backward_mean(dframe, 'amihud', backward_window),
+            'size': np.log(dframe['Dsmvosd'].where(dframe['Dsmvosd'] > 0))
+        },
+        index=dframe.index)
+    return panel[['forward_ret'] + CHARACTERISTICS]
+
+
+@click.command()
+@click.option(
+    '--windows',
+    help='Backward and forward window length to calculate some features.',
+    nargs=2,
+    type=int)
+@click.argument('output_file', type=click.Path(writable=True))
+def main(windows, output_file):
+    backward, forward = windows
+    panel = build_stock_panel(backward, forward)
+    panel.to_pickle(output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,618 @@
+"""
+批量求解分组OLS 的引擎。所有组的设计矩阵按组堆叠为一个三维数组，一次批量求伪逆，
+得到各组的系数、HAC 标准误、t 值、p 值和R²，结果与逐组使用statsmodels 拟合时一致。
+结果保存在以数组为底的BatchedOLSResults 中，可以写入一个小的列式文件（.npz），
+读取时不需要反序列化statsmodels 对象，需要时再还原为statsmodels 的结果。
+"""
+import json
+import numpy as np
+import pandas as pd
+from patsy import DesignInfo
+from scipy import stats
+from statsmodels import api as sm
+from statsmodels.regression.linear_model import (RegressionResults,
+                                                 RegressionResultsWrapper)
+from statsmodels.stats.contrast import ContrastResults
+from src.models import contrast
+from src.models import hac
+
+# 与statsmodels 求伪逆时相同的截断阈值
+_RCOND = 1e-15
+
+
+def _has_const(group_design: np.ndarray):
+    """与sm.add_constant 相同，组内已有非零的常数列时不再加入常数项"""
+    with np.errstate(invalid='ignore'):
+        constant_cols = (np.ptp(group_design, axis=0) == 0) & np.any(
+            group_design != 0, axis=0)
+    return not constant_cols.any()
+
+
+def stack_groups(endog: np.ndarray,
+                 design: np.ndarray,
+                 group_rows: dict,
+                 valid: np.ndarray = None):
+    """
+    将每组的targets 和设计矩阵堆叠为三维数组，并在最前面加入常数项。
+    与statsmodels 的missing='drop' 相同，删除含NaN 的行后将剩余的行依次排在前面，其余位置补0。
+    与sm.add_constant 相同，若组内已经有非零的常数列，则该组不再加入常数项（常数列记为0）。
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, k) 的设计矩阵，不含常数项
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+    valid:
+        np.ndarray, default None
+        每一行是否没有NaN（见design_matrix.assemble_valid），为None 时检查endog 和design
+
+    Return:
+    -------
+    tuple:
+        (y, X, nobs, has_const)。y 为(G, m)，X 为(G, m, k + 1)，
+        nobs 和has_const 的长度为G
+    """
+    n_groups = len(group_rows)
+    valid_rows, has_const = [], np.ones(n_groups, dtype=bool)
+    for pos, rows in enumerate(group_rows.values()):
+        group_design = design[rows]
+        has_const[pos] = _has_const(group_design)
+        if valid is None:
+            group_valid = np.isfinite(endog[rows]) & np.isfinite(
+                group_design).all(axis=1)
+        else:
+            group_valid = valid[rows]
+        valid_rows.append(rows[group_valid])
+
+    nobs = np.array([len(rows) for rows in valid_rows])
+    max_rows = nobs.max() if n_groups > 0 else 0
+    y = np.zeros((n_groups, max_rows))
+    X = np.zeros((n_groups, max_rows, design.shape[1] + 1))
+    for pos, rows in enumerate(valid_rows):
+        y[pos, :len(rows)] = endog[rows]
+        X[pos, :len(rows), 0] = float(has_const[pos])
+        X[pos, :len(rows), 1:] = design[rows]
+    return y, X, nobs, has_const
+
+
+class BatchedOLSResults(object):
+    """
+    批量OLS 的结果，每个属性都是第一维为组别的数组。
+    只保存系数、协方差矩阵、观测数和R²，不保存各组的endog、exog 和残差
+    """
+    __slots__ = ('groups', 'names', 'params', 'cov_params', 'nobs',
+                 'rsquared', 'has_const', 'group_names')
+
+    def __init__(self,
+                 groups,
+                 names,
+                 params,
+                 cov_params,
+                 nobs,
+                 rsquared,
+                 has_const,
+                 group_names=None):
+        self.groups = list(groups)
+        self.names = list(names)
+        self.params = params
+        self.cov_params = cov_params
+        self.nobs = nobs
+        self.rsquared = rsquared
+        self.has_const = has_const
+        self.group_names = None if group_names is None else list(group_names)
+
+    @property
+    def bse(self):
+        return np.sqrt(np.diagonal(self.cov_params, axis1=1, axis2=2))
+
+    @property
+    def tvalues(self):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        # 与statsmodels 使用稳健协方差时相同，p 值基于正态分布
+        return 2 * stats.norm.sf(np.abs(self.tvalues))
+
+    def __len__(self):
+        return len(self.groups)
+
+    def group_result(self, pos: int):
+        """返回第pos 组的结果"""
+        return GroupOLSResult(self, pos)
+
+    def _group_index(self):
+        index = pd.Index(self.groups, tupleize_cols=True)
+        if self.group_names is not None:
+            index.names = self.group_names
+        return index
+
+    def _restriction(self, restriction):
+        """约束矩阵，以及约束涉及常数项、而该组没有常数项时为False 的组别mask"""
+        r_mat, q = contrast.restriction_matrix(self.names, restriction)
+        valid = self.has_const | (r_mat[:, 0] == 0).all()
+        return r_mat, q, valid
+
+    def t_test(self, restriction):
+        """
+        对所有组一次进行线性约束的t 检验
+
+        Parameters:
+        -----------
+        restriction:
+            str, list of str, dict or np.ndarray
+            见contrast.restriction_matrix，如'delta_std_t_1 + delta_std_t_2 = 0'
+
+        Return:
+        -------
+        pd.DataFrame
+            以组别为index，列为effect、sd、tvalue 和pvalue。
+            有多个约束时index 的最后一层为约束的序号restriction
+        """
+        r_mat, q, valid = self._restriction(restriction)
+        results = np.full((4, len(self), r_mat.shape[0]), np.nan)
+        results[:, valid] = contrast.t_contrast(self.params[valid],
+                                                self.cov_params[valid], r_mat,
+                                                q)
+        columns = ['effect', 'sd', 'tvalue', 'pvalue']
+        if r_mat.shape[0] == 1:
+            return pd.DataFrame(results[:, :, 0].T,
+                                index=self._group_index(),
+                                columns=columns)
+        groups = [
+            group if isinstance(group, tuple) else (group, )
+            for group in self.groups
+        ]
+        index = pd.MultiIndex.from_tuples(
+            [group + (i, ) for group in groups for i in range(len(q))],
+            names=list(self._group_index().names) + ['restriction'])
+        return pd.DataFrame(results.reshape(4, -1).T,
+                            index=index,
+                            columns=columns)
+
+    def wald_test(self, restriction, use_f: bool = False):
+        """
+        对所有组一次进行所有约束同时成立的联合检验
+
+        Parameters:
+        -----------
+        restriction:
+            str, list of str, dict or np.ndarray
+            见contrast.restriction_matrix，
+            如'delta_std_t_1 = 0, delta_std_t_2 = 0'
+        use_f:
+            bool, default False
+            为True 时进行F 检验，否则为与statsmodels 稳健协方差下相同的卡方检验
+
+        Return:
+        -------
+        pd.DataFrame
+            以组别为index，列为statistic、df_num 和pvalue
+        """
+        r_mat, q, valid = self._restriction(restriction)
+        df_denom = None
+        if use_f:
+            n_params = len(self.names) - (~self.has_const).astype(int)
+            df_denom = (self.nobs - n_params)[valid]
+        statistic, pvalue = np.full(len(self), np.nan), np.full(
+            len(self), np.nan)
+        statistic[valid], pvalue[valid] = contrast.wald_contrast(
+            self.params[valid],
+            self.cov_params[valid],
+            r_mat,
+            q,
+            df_denom=df_denom)
+        return pd.DataFrame(
+            {
+                'statistic': statistic,
+                'df_num': r_mat.shape[0],
+                'pvalue': pvalue
+            },
+            index=self._group_index())
+
+    def to_series(self):
+        """以组别为index，每组的结果为值的pd.Series"""
+        index = self._group_index()
+        return pd.Series([self.group_result(pos) for pos in range(len(self))],
+                         index=index)
+
+    @classmethod
+    def from_results(cls, results: pd.Series):
+        """
+        将以组别为index 的一列OLS 结果（statsmodels 的OLSResults 或GroupOLSResult）
+        转为BatchedOLSResults。没有常数项的组，其常数项的系数和协方差记为0
+
+        Parameters:
+        -----------
+        results:
+            pd.Series or pd.DataFrame
+            为DataFrame 时（如GroupedOLS.ols_dframe）先stack 为Series
+
+        Return:
+        -------
+            BatchedOLSResults
+        """
+        if isinstance(results, pd.DataFrame):
+            results = results.stack()
+        names = max((list(result.params.index) for result in results),
+                    key=len)
+        if names[0] != 'const':
+            names = ['const'] + names
+
+        n_groups, n_names = len(results), len(names)
+        params = np.zeros((n_groups, n_names))
+        cov_params = np.zeros((n_groups, n_names, n_names))
+        has_const = np.ones(n_groups, dtype=bool)
+        for pos, result in enumerate(results):
+            result_names = list(result.params.index)
+            has_const[pos] = result_names[0] == 'const'
+            keep = slice(0, None) if has_const[pos] else slice(1, None)
+            if result_names != names[keep]:
+                raise ValueError(
+                    'All groups must have the same features, got {} and {}.'.
+                    format(names, result_names))
+            params[pos, keep] = np.asarray(result.params)
+            cov_params[pos, keep, keep] = np.asarray(result.cov_params())
+
+        group_names = results.index.names
+        if all(name is None for name in group_names):
+            group_names = None
+        return cls(results.index,
+                   names,
+                   params,
+                   cov_params,
+                   np.array([result.nobs for result in results], dtype=int),
+                   np.array([result.rsquared for result in results]),
+                   has_const,
+                   group_names=group_names)
+
+    def save(self, path: str):
+        """
+        将结果保存为一个未压缩的.npz 文件，每个属性为其中的一列数组
+
+        Parameters:
+        -----------
+        path:
+            str
+            文件路径
+        """
+        groups = [
+            group if isinstance(group, tuple) else (group, )
+            for group in self.groups
+        ]
+        meta = {
+            'group_names': self.group_names,
+            'group_is_tuple': bool(self.groups)
+            and isinstance(self.groups[0], tuple)
+        }
+        # 传入文件对象，np.savez 不会为路径加上.npz 后缀
+        with open(path, 'wb') as npz_file:
+            np.savez(npz_file,
+                     groups=np.array(groups, dtype=str),
+                     names=np.array(self.names, dtype=str),
+                     params=self.params,
+                     cov_params=self.cov_params,
+                     nobs=self.nobs,
+                     rsquared=self.rsquared,
+                     has_const=self.has_const,
+                     meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        读取save 保存的文件，组别读取后为str
+
+        Return:
+        -------
+            BatchedOLSResults
+        """
+        with np.load(path, allow_pickle=False) as npz_file:
+            meta = json.loads(npz_file['meta'].item())
+            groups = [tuple(group) for group in npz_file['groups'].tolist()]
+            if not meta['group_is_tuple']:
+                groups = [group[0] for group in groups]
+            return cls(groups,
+                       npz_file['names'].tolist(),
+                       npz_file['params'],
+                       npz_file['cov_params'],
+                       npz_file['nobs'],
+                       npz_file['rsquared'],
+                       npz_file['has_const'],
+                       group_names=meta['group_names'])
+
+
+class GroupOLSResult(object):
+    """
+    BatchedOLSResults 中某一组的结果，提供与statsmodels 的OLSResults 相同的常用接口，
+    如params、bse、tvalues、pvalues、rsquared、nobs、cov_params() 和t_test()
+    """
+    __slots__ = ('_batch', '_pos')
+
+    def __init__(self, batch: BatchedOLSResults, pos: int):
+        self._batch = batch
+        self._pos = pos
+
+    @property
+    def _keep(self):
+        """该组没有加入常数项时去掉常数列"""
+        return slice(0, None) if self._batch.has_const[self._pos] else slice(
+            1, None)
+
+    @property
+    def _names(self):
+        return self._batch.names[self._keep]
+
+    def _series(self, values):
+        return pd.Series(values[self._pos, self._keep], index=self._names)
+
+    @property
+    def params(self):
+        return self._series(self._batch.params)
+
+    @property
+    def bse(self):
+        return self._series(self._batch.bse)
+
+    @property
+    def tvalues(self):
+        return self._series(self._batch.tvalues)
+
+    @property
+    def pvalues(self):
+        return self._series(self._batch.pvalues)
+
+    @property
+    def rsquared(self):
+        return self._batch.rsquared[self._pos]
+
+    @property
+    def nobs(self):
+        return float(self._batch.nobs[self._pos])
+
+    @property
+    def df_resid(self):
+        return self.nobs - len(self._names)
+
+    def cov_params(self):
+        cov = self._batch.cov_params[self._pos][self._keep, self._keep]
+        return pd.DataFrame(cov, index=self._names, columns=self._names)
+
+    def t_test(self, r_matrix):
+        """
+        线性约束的t 检验，r_matrix 可以是如'const = 0' 的str，或约束矩阵
+
+        Return:
+        -------
+            statsmodels.stats.contrast.ContrastResults
+        """
+        constraint = DesignInfo(self._names).linear_constraint(r_matrix)
+        r_mat, q_mat = constraint.coefs, constraint.constants.squeeze(axis=1)
+        effect = r_mat @ self.params.to_numpy()
+        sd = np.sqrt(np.diag(r_mat @ self.cov_params().to_numpy() @ r_mat.T))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            statistic = (effect - q_mat) / sd
+        return ContrastResults(effect=effect,
+                               statistic=statistic,
+                               sd=sd,
+                               df_denom=self.df_resid,
+                               distribution='norm')
+
+    def to_statsmodels(self):
+        """
+        还原为statsmodels 的OLSResults，params、bse、pvalues、t_test()、wald_test() 等
+        与原来的结果一致。由于不保存数据，resid、fittedvalues 等依赖数据的属性不可用
+
+        Return:
+        -------
+            statsmodels.regression.linear_model.RegressionResultsWrapper
+        """
+        names = self._names
+        n_names = len(names)
+        cov = self.cov_params().to_numpy()
+        # 只用于保存列名的占位模型，观测数和自由度按保存的结果设定
+        model = sm.OLS(np.zeros(n_names),
+                       pd.DataFrame(np.eye(n_names), columns=names))
+        model.nobs = self.nobs
+        model.df_resid = self.df_resid
+        model.df_model = float(n_names - int(names[0] == 'const'))
+
+        result = RegressionResults(model,
+                                   self.params.to_numpy(),
+                                   normalized_cov_params=cov,
+                                   scale=1.,
+                                   use_t=False)
+        result.cov_type = 'HAC'
+        result.cov_params_default = cov
+        # 较新的statsmodels 中nobs 和rsquared 都是只读的缓存属性
+        try:
+            result.nobs = self.nobs
+        except AttributeError:
+            result._cache['nobs'] = self.nobs
+        result._cache['rsquared'] = self.rsquared
+        return RegressionResultsWrapper(result)
+
+
+def _rsquared(y: np.ndarray, resid: np.ndarray, nobs: np.ndarray):
+    """与statsmodels 相同，有常数项时R² 基于去均值后的总平方和；补0 的行不计入"""
+    filled = np.arange(y.shape[1])[None, :] < nobs[:, None]
+    y_mean = y.sum(axis=1) / nobs
+    centered_tss = (np.where(filled, y - y_mean[:, None], 0)**2).sum(axis=1)
+    return 1 - (resid**2).sum(axis=1) / centered_tss
+
+
+def fit_batched(endog: np.ndarray,
+                design: np.ndarray,
+                group_rows: dict,
+                names: list,
+                maxlags,
+                kernel: str = 'bartlett',
+                valid: np.ndarray = None):
+    """
+    批量拟合所有组的OLS，使用HAC 协方差
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, k) 的设计矩阵，不含常数项
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+    names:
+        list of str
+        设计矩阵每一列的列名
+    maxlags:
+        int or array like of int
+        HAC 的最大滞后阶数，为array like 时与group_rows 的组一一对应
+    kernel:
+        str, default 'bartlett'
+        HAC 的核函数，见hac.KERNELS
+    valid:
+        np.ndarray, default None
+        每一行是否没有NaN，见stack_groups
+
+    Return:
+    -------
+        BatchedOLSResults
+    """
+    y, X, nobs, has_const = stack_groups(endog, design, group_rows, valid)
+    pinv = np.linalg.pinv(X, rcond=_RCOND)
+    params = (pinv @ y[:, :, None])[:, :, 0]
+
+    resid = y - (X @ params[:, :, None])[:, :, 0]
+    cov_params = hac.hac_covariance(X, resid, pinv, maxlags, kernel=kernel)
+
+    return BatchedOLSResults(group_rows.keys(), ['const'] + list(names),
+                             params, cov_params, nobs,
+                             _rsquared(y, resid, nobs), has_const)
+
+
+def fit_shared_design(endog: np.ndarray,
+                      date_design: np.ndarray,
+                      date_codes: np.ndarray,
+                      group_rows: dict,
+                      names: list,
+                      maxlags,
+                      kernel: str = 'bartlett',
+                      valid: np.ndarray = None):
+    """
+    features 只随日期变化时的批量OLS。删除缺失值后使用的日期（及顺序）相同的组共用同一个设计矩阵，
+    只求一次伪逆，作为一个多因变量的回归一次求解；使用的日期与其他组都不同的组按fit_batched 求解。
+    结果与fit_batched 一致
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    date_design:
+        np.ndarray
+        (m, k) 的日期设计矩阵，不含常数项，见design_matrix.assemble_date_design
+    date_codes:
+        np.ndarray
+        长度为n，targets 每一行在date_design 中的行号
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+    names:
+        list of str
+        设计矩阵每一列的列名
+    maxlags:
+        int or array like of int
+        HAC 的最大滞后阶数，为array like 时与group_rows 的组一一对应
+    kernel:
+        str, default 'bartlett'
+        HAC 的核函数，见hac.KERNELS
+    valid:
+        np.ndarray, default None
+        targets 每一行是否没有NaN（见design_matrix.assemble_valid），
+        为None 时检查endog 和date_design
+
+    Return:
+    -------
+        BatchedOLSResults
+    """
+    groups = list(group_rows.keys())
+    n_groups, n_names = len(groups), date_design.shape[1] + 1
+    lags = np.broadcast_to(np.asarray(maxlags), (n_groups, ))
+    valid_dates = np.isfinite(date_design).all(axis=1)
+
+    # 按(是否加入常数项, 删除缺失值后使用的日期) 将各组分类
+    patterns, used_endog = {}, []
+    for pos, rows in enumerate(group_rows.values()):
+        codes = date_codes[rows]
+        used = (np.isfinite(endog[rows]) & valid_dates[codes]
+                if valid is None else valid[rows])
+        used_endog.append(endog[rows][used])
+        key = (_has_const(date_design[codes]), codes[used].tobytes())
+        patterns.setdefault(key, (codes[used], []))[1].append(pos)
+
+    params = np.zeros((n_groups, n_names))
+    cov_params = np.zeros((n_groups, n_names, n_names))
+    nobs = np.zeros(n_groups, dtype=int)
+    rsquared = np.zeros(n_groups)
+    has_const = np.ones(n_groups, dtype=bool)
+
+    other = []
+    for (shared_const, _), (used, shared) in patterns.items():
+        if len(shared) < 2:
+            other.extend(shared)
+            continue
+        # 同一类的组只求一次伪逆，各组的targets 作为多个因变量
+        X = np.empty((len(used), n_names))
+        X[:, 0] = float(shared_const)
+        X[:, 1:] = date_design[used]
+        pinv = np.linalg.pinv(X, rcond=_RCOND)
+
+        y = np.stack([used_endog[pos] for pos in shared])
+        shared_params = y @ pinv.T
+        resid = y - shared_params @ X.T
+        n_shared = len(shared)
+        shared_nobs = np.full(n_shared, len(used))
+        params[shared] = shared_params
+        cov_params[shared] = hac.hac_covariance(
+            np.broadcast_to(X, (n_shared, ) + X.shape),
+            resid,
+            np.broadcast_to(pinv, (n_shared, ) + pinv.shape),
+            lags[shared],
+            kernel=kernel)
+        nobs[shared] = shared_nobs
+        rsquared[shared] = _rsquared(y, resid, shared_nobs)
+        has_const[shared] = shared_const
+
+    if other:
+        # 使用的日期与其他组都不同的组，按行取出设计矩阵后逐组求解
+        other.sort()
+        rows = [group_rows[groups[pos]] for pos in other]
+        offsets = np.cumsum([0] + [len(group) for group in rows])
+        other_rows = {
+            groups[pos]: np.arange(offsets[i], offsets[i + 1])
+            for i, pos in enumerate(other)
+        }
+        rows = np.concatenate(rows)
+        other_result = fit_batched(endog[rows],
+                                   date_design[date_codes[rows]],
+                                   other_rows,
+                                   names,
+                                   maxlags=lags[other],
+                                   kernel=kernel,
+                                   valid=(None if valid is None else
+                                          valid[rows]))
+        params[other] = other_result.params
+        cov_params[other] = other_result.cov_params
+        nobs[other] = other_result.nobs
+        rsquared[other] = other_result.rsquared
+        has_const[other] = other_result.has_const
+
+    return BatchedOLSResults(groups, ['const'] + list(names), params,
+                             cov_params, nobs, rsquared, has_const)
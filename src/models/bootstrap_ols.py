@@ -0,0 +1,330 @@
+"""
+分组OLS 系数的块自助法（block bootstrap）推断。所有组共用同一组重抽样的日期，
+保留各组合之间的截面相关；块长度一般取持有期，保留重叠收益带来的序列相关。
+OLS 的系数只取决于每个日期被抽到的次数，因此每个日期的X'X、X'y 预先算好，
+一次重抽样的X'X、X'y 即为以抽到次数为权重的和，所有组、一批重抽样通过一次矩阵乘法和批量求解得到。
+重抽样按固定大小分批，每批使用由seed 派生的独立随机数，分配到多个工作进程计算，结果与进程数无关。
+"""
+import multiprocessing as mp
+import os
+import numpy as np
+import pandas as pd
+from src.models import batched_ols as bols
+
+METHODS = ('moving', 'stationary')
+
+# 每批重抽样的次数，随机数按批派生，结果不随工作进程数变化
+_CHUNK = 250
+
+# 工作进程中由_init_worker 设定的每个日期的X'X 和X'y
+_WORKER_STATE = {}
+
+# 与parallel_ols 相同，numba 的并行核函数启动线程后再fork 会死锁，因此使用spawn
+_MP_CONTEXT = mp.get_context('spawn')
+
+
+def block_indices(rng: np.random.Generator, n_reps: int, n_dates: int,
+                  block_length: int, method: str = 'stationary'):
+    """
+    生成块自助法重抽样的日期位置
+
+    Parameters:
+    -----------
+    rng:
+        np.random.Generator
+    n_reps:
+        int
+        重抽样次数
+    n_dates:
+        int
+        日期数
+    block_length:
+        int
+        块长度，'stationary' 时为块长度的期望
+    method:
+        str, default 'stationary'
+        'moving' 为固定长度的移动块；'stationary' 为Politis-Romano 的平稳自助法，
+        块长度服从几何分布，超过最后一个日期时从第一个日期接续
+
+    Return:
+    -------
+        np.ndarray, (n_reps, n_dates)
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of {}, got {}.'.format(
+            METHODS, method))
+    block_length = int(min(max(block_length, 1), n_dates))
+    if method == 'moving':
+        n_blocks = -(-n_dates // block_length)
+        starts = rng.integers(0, n_dates - block_length + 1,
+                              (n_reps, n_blocks))
+        indices = starts[:, :, None] + np.arange(block_length)
+        return indices.reshape(n_reps, -1)[:, :n_dates]
+
+    steps = np.arange(n_dates)
+    new_block = rng.random((n_reps, n_dates)) < 1.0 / block_length
+    new_block[:, 0] = True
+    starts = rng.integers(0, n_dates, (n_reps, n_dates))
+    # 每个位置所在块的起点位置
+    block_start = np.maximum.accumulate(np.where(new_block, steps, 0), axis=1)
+    return (np.take_along_axis(starts, block_start, axis=1) + steps -
+            block_start) % n_dates
+
+
+def date_counts(indices: np.ndarray, n_dates: int):
+    """每次重抽样中每个日期被抽到的次数，(n_reps, n_dates)"""
+    n_reps = len(indices)
+    offsets = (np.arange(n_reps) * n_dates)[:, None]
+    return np.bincount((indices + offsets).ravel(),
+                       minlength=n_reps * n_dates).reshape(n_reps, n_dates)
+
+
+def date_moments(endog: np.ndarray, design: np.ndarray, date_codes: np.ndarray,
+                 n_dates: int, group_rows: dict):
+    """
+    计算每组每个日期的x·x' 和x·y，删除含NaN 的行，并与sm.add_constant 相同地加入常数项
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, k) 的设计矩阵，不含常数项
+    date_codes:
+        np.ndarray
+        长度为n，targets 每一行的日期编码（0, ..., n_dates - 1）
+    n_dates:
+        int
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+
+    Return:
+    -------
+    tuple:
+        (xx, xy, has_const)，分别为(n_dates, G, k + 1, k + 1)、
+        (n_dates, G, k + 1) 和(G, )
+    """
+    n_groups, n_cols = len(group_rows), design.shape[1] + 1
+    xx = np.zeros((n_dates, n_groups, n_cols, n_cols))
+    xy = np.zeros((n_dates, n_groups, n_cols))
+    has_const = np.ones(n_groups, dtype=bool)
+    for pos, rows in enumerate(group_rows.values()):
+        has_const[pos] = bols._has_const(design[rows])
+        valid = np.isfinite(endog[rows]) & np.isfinite(design[rows]).all(
+            axis=1)
+        rows = rows[valid]
+        exog = np.column_stack(
+            [np.full(len(rows), float(has_const[pos])), design[rows]])
+        np.add.at(xx[:, pos], date_codes[rows],
+                  exog[:, :, None] * exog[:, None, :])
+        np.add.at(xy[:, pos], date_codes[rows], exog * endog[rows, None])
+    return xx, xy, has_const
+
+
+def solve_weighted(counts: np.ndarray, xx: np.ndarray, xy: np.ndarray,
+                   has_const: np.ndarray):
+    """
+    以每个日期被抽到的次数为权重，批量求解所有重抽样、所有组的OLS 系数
+
+    Parameters:
+    -----------
+    counts:
+        np.ndarray, (R, n_dates)
+    xx, xy, has_const:
+        见date_moments
+
+    Return:
+    -------
+        np.ndarray, (R, G, k + 1)。没有常数项的组，常数项的系数为NaN
+    """
+    n_dates, n_groups, n_cols = xy.shape
+    counts = np.asarray(counts, dtype=float)
+    xtx = (counts @ xx.reshape(n_dates, -1)).reshape(-1, n_groups, n_cols,
+                                                     n_cols)
+    xty = (counts @ xy.reshape(n_dates, -1)).reshape(-1, n_groups, n_cols)
+    # 没有常数项的组，常数列全为0，在对角线上补1 使X'X 可逆，其系数为0
+    xtx[:, ~has_const, 0, 0] = 1.0
+    try:
+        params = np.linalg.solve(xtx, xty[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        params = (np.linalg.pinv(xtx, rcond=bols._RCOND) @ xty[...,
+                                                                 None])[..., 0]
+    params[:, ~has_const, 0] = np.nan
+    return params
+
+
+def _init_worker(xx, xy, has_const):
+    _WORKER_STATE.update(xx=xx, xy=xy, has_const=has_const)
+
+
+def _bootstrap_chunk(seed_seq, n_reps, block_length, method):
+    """在工作进程中计算一批重抽样的系数"""
+    xx, xy = _WORKER_STATE['xx'], _WORKER_STATE['xy']
+    rng = np.random.default_rng(seed_seq)
+    indices = block_indices(rng, n_reps, len(xx), block_length, method)
+    return solve_weighted(date_counts(indices, len(xx)), xx, xy,
+                          _WORKER_STATE['has_const'])
+
+
+class BootstrapResults(object):
+    """
+    块自助法的结果。params 为全样本的系数，draws 为每次重抽样的系数，
+    都是第一维（draws 为第二维）为组别的数组
+    """
+    __slots__ = ('groups', 'names', 'params', 'draws', 'group_names',
+                 'block_length', 'method')
+
+    def __init__(self,
+                 groups,
+                 names,
+                 params,
+                 draws,
+                 group_names=None,
+                 block_length=None,
+                 method=None):
+        self.groups = list(groups)
+        self.names = list(names)
+        self.params = params
+        self.draws = draws
+        self.group_names = None if group_names is None else list(group_names)
+        self.block_length = block_length
+        self.method = method
+
+    @property
+    def n_reps(self):
+        return len(self.draws)
+
+    def _group_index(self):
+        index = pd.Index(self.groups, tupleize_cols=True)
+        if self.group_names is not None:
+            index.names = self.group_names
+        return index
+
+    def _frame(self, values):
+        return pd.DataFrame(values,
+                            index=self._group_index(),
+                            columns=self.names)
+
+    def params_frame(self):
+        """全样本的系数，以组别为index、系数名为列"""
+        return self._frame(self.params)
+
+    def bse(self):
+        """自助法标准误，以组别为index、系数名为列"""
+        return self._frame(np.nanstd(self.draws, axis=0, ddof=1))
+
+    def conf_int(self, alpha: float = 0.05):
+        """
+        百分位数置信区间
+
+        Parameters:
+        -----------
+        alpha:
+            float, default 0.05
+            置信区间为1 - alpha
+
+        Return:
+        -------
+            pd.DataFrame
+            以组别为index，(系数名, 'lower' / 'upper') 为列
+        """
+        lower, upper = np.nanpercentile(
+            self.draws, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        frame = pd.concat([self._frame(lower), self._frame(upper)],
+                          axis=1,
+                          keys=['lower', 'upper'])
+        return frame.swaplevel(axis=1).reindex(columns=self.names, level=0)
+
+    def pvalues(self):
+        """
+        系数为0 的双侧自助法p 值：重抽样的系数减去全样本系数后，绝对值不小于全样本系数的比例
+        """
+        centered = np.abs(self.draws - self.params)
+        return self._frame(np.mean(centered >= np.abs(self.params), axis=0))
+
+
+def block_bootstrap(endog: np.ndarray,
+                    design: np.ndarray,
+                    names: list,
+                    date_codes: np.ndarray,
+                    group_rows: dict,
+                    n_reps: int = 1000,
+                    block_length: int = 5,
+                    method: str = 'stationary',
+                    seed=None,
+                    workers: int = None,
+                    group_names=None):
+    """
+    对所有组同时进行块自助法，所有组在每次重抽样中使用相同的日期
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, k) 的设计矩阵，不含常数项
+    names:
+        list of str
+        design 各列的名称
+    date_codes:
+        np.ndarray
+        长度为n，targets 每一行的日期编码
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+    n_reps:
+        int, default 1000
+        重抽样次数
+    block_length:
+        int, default 5
+        块长度（'stationary' 时为其期望）
+    method:
+        str, default 'stationary'
+        见block_indices
+    seed:
+        int, default None
+        随机数种子，相同的种子得到相同的结果，与workers 无关
+    workers:
+        int, default None
+        工作进程数，为None 时使用CPU 核数；为1 时在当前进程中计算
+    group_names:
+        list of str, default None
+        组别的名称，如['cap_group', 'rev_group']
+
+    Return:
+    -------
+        BootstrapResults
+    """
+    n_dates = int(date_codes.max()) + 1 if len(date_codes) else 0
+    xx, xy, has_const = date_moments(endog, design, date_codes, n_dates,
+                                     group_rows)
+    params = solve_weighted(np.ones((1, n_dates)), xx, xy, has_const)[0]
+
+    sizes = [min(_CHUNK, n_reps - start) for start in range(0, n_reps, _CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(seed_seq, size, block_length, method)
+             for seed_seq, size in zip(seeds, sizes)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        _init_worker(xx, xy, has_const)
+        chunks = [_bootstrap_chunk(*task) for task in tasks]
+    else:
+        with _MP_CONTEXT.Pool(processes=min(workers, len(tasks)),
+                              initializer=_init_worker,
+                              initargs=(xx, xy, has_const)) as pool:
+            chunks = pool.starmap(_bootstrap_chunk, tasks)
+
+    draws = (np.concatenate(chunks) if chunks else np.empty(
+        (0, ) + params.shape))
+    return BootstrapResults(list(group_rows), ['const'] + list(names),
+                            params,
+                            draws,
+                            group_names=group_names,
+                            block_length=block_length,
+                            method=method)
@@ -0,0 +1,320 @@
+"""
+所有拟合结果的系数表，只追加、按列存储。每一行为一个(run_id, processed_dir, spec, cap_group,
+rev_group, term) 的coef、se、t、p、nobs 和r2。每次追加写入一个新的segment 文件夹，
+字符串列以manifest 中只增不减的词表编码为整数，每列一个.npy 文件；最后替换manifest，
+manifest 中记录的segment 即为完整写入的数据。
+segment 内的行按(spec, term) 排序，并保存按(term, spec) 排序的行号，
+按spec 或term 查询时二分查找即可，读取时不需要反序列化任何结果对象。
+"""
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import click
+from src.models import parallel_ols
+from src.models.grouped_ols import OLSFeatures
+from src.models.robust_grid import coefficient_frame
+
+MANIFEST_FILE = 'manifest.json'
+STORE_VERSION = 1
+
+# 以词表编码的字符串列，和数值列（及其在coefficient_frame 中的列名）
+KEY_COLUMNS = ['processed_dir', 'spec', 'cap_group', 'rev_group', 'term']
+VALUE_COLUMNS = {
+    'coef': 'params',
+    'se': 'bse',
+    't': 'tvalues',
+    'p': 'pvalues',
+    'nobs': 'nobs',
+    'r2': 'rsquared'
+}
+
+# 查询结果的index
+INDEX_NAMES = ['run_id'] + KEY_COLUMNS
+
+
+def _write_json(path: str, content: dict):
+    """先写入临时文件再替换，读取时不会看到写了一半的manifest"""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as tmp_file:
+        json.dump(content, tmp_file, indent=2)
+    os.replace(tmp_path, path)
+
+
+class CoefStore(object):
+    """
+    一个系数表文件夹。append 追加一次拟合的结果，query 按spec、term 等条件查询
+    """
+    def __init__(self, store_dir: str = 'models/coef_store'):
+        """
+        Parameters:
+        -----------
+        store_dir:
+            str, default 'models/coef_store'
+            系数表所在的文件夹，不存在时在第一次追加时创建
+        """
+        self._store_dir = store_dir
+        self._manifest = None
+        self._mtime = None
+        self._segments = {}
+
+    @property
+    def store_dir(self):
+        return self._store_dir
+
+    def manifest(self):
+        """读取manifest，文件改变（其他进程追加了数据）时重新读取"""
+        path = os.path.join(self._store_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {
+                'version': STORE_VERSION,
+                'segments': [],
+                'vocab': {col: []
+                          for col in KEY_COLUMNS}
+            }
+        mtime = os.stat(path).st_mtime_ns
+        if self._manifest is None or mtime != self._mtime:
+            with open(path) as manifest_file:
+                self._manifest = json.load(manifest_file)
+            self._mtime = mtime
+        return self._manifest
+
+    @property
+    def run_ids(self):
+        return [segment['run_id'] for segment in self.manifest()['segments']]
+
+    def __len__(self):
+        return sum(segment['nrows']
+                   for segment in self.manifest()['segments'])
+
+    def append(self,
+               results: pd.Series,
+               processed_dir: str,
+               run_id: str = None):
+        """
+        追加一次拟合的结果
+
+        Parameters:
+        -----------
+        results:
+            pd.Series or pd.DataFrame
+            parallel_ols.fit_all 的结果，或robust_grid.coefficient_frame 的结果
+        processed_dir:
+            str
+            拟合所用的processed 文件夹
+        run_id:
+            str, default None
+            本次拟合的标识，不能与已有的重复。为None 时使用当前时间
+
+        Return:
+        -------
+            str, run_id
+        """
+        frame = (results if isinstance(results, pd.DataFrame) else
+                 coefficient_frame(results))
+        manifest = self.manifest()
+        if run_id is None:
+            base = run_id = time.strftime('%Y%m%d-%H%M%S')
+            suffix = 1
+            while run_id in self.run_ids:
+                run_id = '{}-{}'.format(base, suffix)
+                suffix += 1
+        elif run_id in self.run_ids:
+            raise ValueError('Run {} already exists in the store.'.format(
+                run_id))
+
+        # 字符串列编码为词表中的位置，新的取值追加到词表末尾
+        vocab = {
+            col: list(values)
+            for col, values in manifest['vocab'].items()
+        }
+        keys = frame.index.to_frame(index=False)
+        keys['processed_dir'] = processed_dir
+        codes = {}
+        for col in KEY_COLUMNS:
+            positions = {value: pos for pos, value in enumerate(vocab[col])}
+            for value in pd.unique(keys[col].astype(str)):
+                if value not in positions:
+                    positions[value] = len(vocab[col])
+                    vocab[col].append(value)
+            codes[col] = keys[col].astype(str).map(positions).to_numpy(
+                dtype=np.int32)
+
+        # 行按(spec, term) 排序，另存按(term, spec) 排序的行号
+        order = np.lexsort((codes['term'], codes['spec']))
+        name = 'segment-{:06d}'.format(len(manifest['segments']))
+        segment_dir = os.path.join(self._store_dir, name)
+        # 已有的segment 不会被覆盖
+        os.makedirs(segment_dir)
+        for col in KEY_COLUMNS:
+            np.save(os.path.join(segment_dir, col + '.npy'), codes[col][order])
+        for col, source in VALUE_COLUMNS.items():
+            np.save(os.path.join(segment_dir, col + '.npy'),
+                    frame[source].to_numpy(dtype=float)[order])
+        sorted_codes = {col: codes[col][order] for col in ('spec', 'term')}
+        np.save(os.path.join(segment_dir, 'term_order.npy'),
+                np.lexsort((sorted_codes['spec'], sorted_codes['term'])))
+
+        manifest = {
+            'version': STORE_VERSION,
+            'segments': manifest['segments'] + [{
+                'name': name,
+                'run_id': run_id,
+                'nrows': len(frame)
+            }],
+            'vocab': vocab
+        }
+        _write_json(os.path.join(self._store_dir, MANIFEST_FILE), manifest)
+        return run_id
+
+    def _segment(self, name: str):
+        """读取一个segment 的所有列（memory map），segment 写入后不会改变，只读取一次"""
+        if name not in self._segments:
+            segment_dir = os.path.join(self._store_dir, name)
+            self._segments[name] = {
+                col: np.load(os.path.join(segment_dir, col + '.npy'),
+                             mmap_mode='r')
+                for col in KEY_COLUMNS + list(VALUE_COLUMNS) + ['term_order']
+            }
+        return self._segments[name]
+
+    @staticmethod
+    def _rows(segment: dict, spec_codes, term_codes):
+        """用(spec, term) 的排序找出满足条件的行，返回行号"""
+        def ranges(sorted_col, codes):
+            starts = np.searchsorted(sorted_col, codes, side='left')
+            ends = np.searchsorted(sorted_col, codes, side='right')
+            return np.concatenate([np.arange(start, end, dtype=np.intp)
+                                   for start, end in zip(starts, ends)] +
+                                  [np.empty(0, dtype=np.intp)])
+
+        if spec_codes is not None:
+            rows = ranges(segment['spec'], spec_codes)
+            if term_codes is not None:
+                rows = rows[np.isin(segment['term'][rows], term_codes)]
+            return rows
+        if term_codes is not None:
+            term_order = segment['term_order']
+            return np.sort(
+                term_order[ranges(segment['term'][term_order], term_codes)])
+        return np.arange(len(segment['spec']))
+
+    def query(self,
+              spec=None,
+              term=None,
+              processed_dir=None,
+              run_id=None,
+              cap_group=None,
+              rev_group=None,
+              columns: list = None):
+        """
+        查询系数表，如所有设定、所有窗口中rolling_std_log 的t 值：
+        store.query(term='rolling_std_log', columns=['t'])
+
+        Parameters:
+        -----------
+        spec, term, processed_dir, run_id, cap_group, rev_group:
+            str or list of str, default None
+            筛选的条件，为None 时不筛选
+        columns:
+            list of str, default None
+            返回的数值列，为None 时返回VALUE_COLUMNS 中的所有列
+
+        Return:
+        -------
+            pd.DataFrame
+            以(run_id, processed_dir, spec, cap_group, rev_group, term) 为index
+        """
+        def as_list(value):
+            return None if value is None else ([value] if isinstance(
+                value, str) else list(value))
+
+        manifest = self.manifest()
+        vocab = manifest['vocab']
+        columns = list(VALUE_COLUMNS) if columns is None else list(columns)
+        conditions = {
+            'processed_dir': as_list(processed_dir),
+            'spec': as_list(spec),
+            'term': as_list(term),
+            'cap_group': as_list(cap_group),
+            'rev_group': as_list(rev_group)
+        }
+        codes = {
+            col: None if values is None else np.array(
+                [vocab[col].index(value) for value in values
+                 if value in vocab[col]],
+                dtype=np.int32)
+            for col, values in conditions.items()
+        }
+        run_ids = as_list(run_id)
+
+        parts = []
+        for segment_meta in manifest['segments']:
+            if run_ids is not None and segment_meta['run_id'] not in run_ids:
+                continue
+            segment = self._segment(segment_meta['name'])
+            rows = self._rows(segment, codes['spec'], codes['term'])
+            for col in ('processed_dir', 'cap_group', 'rev_group'):
+                if codes[col] is not None:
+                    rows = rows[np.isin(segment[col][rows], codes[col])]
+            parts.append((segment_meta['run_id'], segment, rows))
+
+        def gather(col, dtype):
+            return np.concatenate([segment[col][rows]
+                                   for _, segment, rows in parts] +
+                                  [np.empty(0, dtype=dtype)])
+
+        # index 直接由词表和编码构建，不需要生成字符串数组
+        runs = [run for run, _, _ in parts]
+        run_codes = np.concatenate(
+            [np.full(len(rows), pos)
+             for pos, (_, _, rows) in enumerate(parts)] +
+            [np.empty(0, dtype=int)])
+        index = pd.MultiIndex(
+            levels=[runs] + [vocab[col] for col in KEY_COLUMNS],
+            codes=[run_codes] + [gather(col, np.int32) for col in KEY_COLUMNS],
+            names=INDEX_NAMES,
+            verify_integrity=False)
+        data = {col: gather(col, float) for col in columns}
+        return pd.DataFrame(data, index=index, columns=columns)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--run-id', default=None, help='Identifier of this run.')
+@click.option('--workers', type=int, default=None, help='Worker processes.')
+@click.argument('processed_dir', type=click.Path(exists=True,
+                                                 file_okay=False))
+@click.argument('store_dir', type=click.Path())
+def append(run_id, workers, processed_dir, store_dir):
+    """拟合processed_dir 中的所有设定，并追加到系数表中"""
+    if processed_dir[-1] != '/':
+        processed_dir = processed_dir + '/'
+    results = parallel_ols.fit_all(list(OLSFeatures),
+                                   processed_dir=processed_dir,
+                                   workers=workers,
+                                   backend='batched')
+    run_id = CoefStore(store_dir).append(results, processed_dir, run_id)
+    print('Appended run {}.'.format(run_id))
+
+
+@cli.command()
+@click.option('--spec', multiple=True, help='Spec names to select.')
+@click.option('--term', multiple=True, help='Terms to select.')
+@click.option('--column', multiple=True, help='Value columns to show.')
+@click.argument('store_dir', type=click.Path(exists=True, file_okay=False))
+def query(spec, term, column, store_dir):
+    """打印满足条件的系数"""
+    frame = CoefStore(store_dir).query(spec=list(spec) or None,
+                                       term=list(term) or None,
+                                       columns=list(column) or None)
+    print(frame.to_string())
+
+
+if __name__ == "__main__":
+    cli()
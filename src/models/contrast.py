@@ -0,0 +1,120 @@
+"""
+对多组OLS 结果一次计算线性约束的检验。约束矩阵R 可以由系数名称、约束公式（如'a + b = 0, c = 0'）
+或权重给出，所有组的Rβ、R·V·Rᵀ、t 值和p 值通过一次批量运算得到，也可以进行联合的Wald / F 检验。
+与statsmodels 使用稳健协方差时相同，t 检验和Wald 检验的p 值分别基于正态分布和卡方分布。
+"""
+import numpy as np
+from patsy import DesignInfo
+from scipy import stats
+
+
+def restriction_matrix(names: list, restriction):
+    """
+    由约束的描述生成约束矩阵R 和常数q，约束为R·β = q
+
+    Parameters:
+    -----------
+    names:
+        list of str
+        系数的名称
+    restriction:
+        str, list of str, dict or np.ndarray
+        str 时为约束公式，如'delta_std_t_1 + delta_std_t_2 = 0'，多个约束以逗号分隔；
+        list of str 时检验这些系数之和为0；dict 时以系数名称为key、权重为value，检验加权和为0；
+        np.ndarray 时直接作为R（q 为0）
+
+    Return:
+    -------
+    tuple:
+        (R, q)。R 为(r, k) 的ndarray，q 为长度r 的ndarray
+    """
+    names = list(names)
+    if restriction is None:
+        raise ValueError('restriction must not be None.')
+    if isinstance(restriction, str):
+        constraint = DesignInfo(names).linear_constraint(restriction)
+        return constraint.coefs, constraint.constants[:, 0]
+
+    if isinstance(restriction, (list, tuple)):
+        restriction = dict.fromkeys(restriction, 1.0)
+    if isinstance(restriction, dict):
+        r_mat = np.zeros((1, len(names)))
+        for name, weight in restriction.items():
+            if name not in names:
+                raise ValueError("Unknown coefficient '{}'.".format(name))
+            r_mat[0, names.index(name)] = weight
+    else:
+        r_mat = np.atleast_2d(np.asarray(restriction, dtype=float))
+        if r_mat.shape[1] != len(names):
+            raise ValueError(
+                'restriction matrix must have {} columns, got {}.'.format(
+                    len(names), r_mat.shape[1]))
+    return r_mat, np.zeros(r_mat.shape[0])
+
+
+def t_contrast(params: np.ndarray, cov_params: np.ndarray, r_mat: np.ndarray,
+               q: np.ndarray):
+    """
+    对所有组一次计算每个约束的t 检验
+
+    Parameters:
+    -----------
+    params:
+        np.ndarray, (G, k)
+    cov_params:
+        np.ndarray, (G, k, k)
+    r_mat:
+        np.ndarray, (r, k)
+    q:
+        np.ndarray, (r, )
+
+    Return:
+    -------
+    tuple:
+        (effect, sd, tvalue, pvalue)，均为(G, r) 的ndarray
+    """
+    effect = params @ r_mat.T
+    variance = np.einsum('ik,gkl,il->gi', r_mat, cov_params, r_mat)
+    sd = np.sqrt(variance)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tvalue = (effect - q) / sd
+    return effect, sd, tvalue, 2 * stats.norm.sf(np.abs(tvalue))
+
+
+def wald_contrast(params: np.ndarray,
+                  cov_params: np.ndarray,
+                  r_mat: np.ndarray,
+                  q: np.ndarray,
+                  df_denom: np.ndarray = None):
+    """
+    对所有组一次计算所有约束同时成立的Wald 检验
+
+    Parameters:
+    -----------
+    params:
+        np.ndarray, (G, k)
+    cov_params:
+        np.ndarray, (G, k, k)
+    r_mat:
+        np.ndarray, (r, k)
+    q:
+        np.ndarray, (r, )
+    df_denom:
+        np.ndarray, default None
+        各组的残差自由度。提供时返回F 检验（统计量为Wald 统计量除以r），否则为卡方检验
+
+    Return:
+    -------
+    tuple:
+        (statistic, pvalue)，均为长度G 的ndarray
+    """
+    diff = params @ r_mat.T - q
+    variance = r_mat @ cov_params @ r_mat.T
+    statistic = np.einsum('gi,gi->g', diff,
+                          np.linalg.solve(variance, diff[:, :, None])[:, :,
+                                                                       0])
+    n_restrictions = r_mat.shape[0]
+    if df_denom is None:
+        return statistic, stats.chi2.sf(statistic, n_restrictions)
+    statistic = statistic / n_restrictions
+    return statistic, stats.f.sf(statistic, n_restrictions, df_denom)
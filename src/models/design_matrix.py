@@ -0,0 +1,532 @@
+"""
+组装分组OLS 所需的设计矩阵。features 按照与targets 对齐后的行位置直接写入一个预先分配好的数组，
+dummy 交互项（DummyInteraction）也在这里才相乘，不再生成中间的Series 或DataFrame。
+对齐时targets 和features 的每个index level 都编码为整数（交易日编码、规模和反转组合编码），
+features 每一行对应targets 哪一行的位置数组按processed 文件夹缓存。
+需要删除的行由各feature 的有效位图按对齐位置合并得到（assemble_valid），不需要再检查设计矩阵中的NaN。
+"""
+import os
+import numpy as np
+import pandas as pd
+from src.features.feature_store import finite_rows
+from src.features.process_data_api import DummyInteraction
+
+
+def feature_columns(feature):
+    """
+    返回一个feature 在设计矩阵中占据的列名list
+
+    Parameters:
+    -----------
+    feature:
+        pd.Series, pd.DataFrame or DummyInteraction
+
+    Return:
+    -------
+        list of str
+    """
+    if isinstance(feature, DummyInteraction):
+        return feature.columns
+    elif isinstance(feature, pd.DataFrame):
+        return list(feature.columns)
+    elif isinstance(feature, pd.Series):
+        return [feature.name if feature.name is not None else 0]
+    raise TypeError(
+        'feature must be pd.Series, pd.DataFrame or DummyInteraction.')
+
+
+def _as_2d_values(feature):
+    """将Series 或DataFrame 的值取为float 的二维ndarray（不复制已是float 的数据）"""
+    values = feature.to_numpy()
+    if values.ndim == 1:
+        values = values.reshape(-1, 1)
+    return values.astype(float, copy=False)
+
+
+def _merge_keys(feature_index: pd.Index, merge_on=None):
+    """确定合并时依据的index level 名，缺省时使用feature 的index 名"""
+    if merge_on is None:
+        merge_on = [name for name in feature_index.names if name is not None]
+    elif isinstance(merge_on, str):
+        merge_on = [merge_on]
+    return list(merge_on)
+
+
+class TargetCodes(object):
+    """
+    targets 的index 编码为整数：每个level（如Trddt、cap_group、rev_group）的取值和每行的编码
+    """
+    __slots__ = ('index', 'names', 'level_values', 'level_codes')
+
+    def __init__(self, target_index: pd.Index):
+        self.index = target_index
+        self.names = list(target_index.names)
+        if isinstance(target_index, pd.MultiIndex):
+            self.level_values = list(target_index.levels)
+            self.level_codes = [
+                np.asarray(codes) for codes in target_index.codes
+            ]
+        else:
+            codes, uniques = pd.factorize(target_index)
+            self.level_values, self.level_codes = [pd.Index(uniques)], [codes]
+
+    def _level(self, key):
+        try:
+            return self.names.index(key)
+        except ValueError:
+            raise KeyError('Level {} not found in targets.'.format(key))
+
+    def positions(self, feature_index: pd.Index, keys: list):
+        """
+        targets 每一行对应feature 的哪一行，找不到时为-1
+
+        Parameters:
+        -----------
+        feature_index:
+            pd.Index
+            feature 的index，需要无重复
+        keys:
+            list of str
+            合并依据的level 名，均为targets index 的level
+
+        Return:
+        -------
+            np.ndarray
+        """
+        levels = [self._level(key) for key in keys]
+        sizes = [len(self.level_values[level]) for level in levels]
+
+        # feature 各level 的编码：只对各level 的不同取值做一次查找，再按整数编码取值
+        feature_codes = []
+        for key, level in zip(keys, levels):
+            if isinstance(feature_index, pd.MultiIndex):
+                fea_level = feature_index.names.index(key)
+                code_map = self.level_values[level].get_indexer(
+                    feature_index.levels[fea_level])
+                fea_codes = np.asarray(feature_index.codes[fea_level])
+                codes = np.where(fea_codes >= 0,
+                                 code_map[np.maximum(fea_codes, 0)], -1)
+            else:
+                codes = self.level_values[level].get_indexer(feature_index)
+            feature_codes.append(codes)
+
+        # 以各level 编码组合成的整数为key，建立从targets 的key 到feature 行号的查找表
+        found = np.logical_and.reduce([codes >= 0 for codes in feature_codes])
+        feature_keys = np.ravel_multi_index(
+            [codes[found] for codes in feature_codes], sizes)
+        lookup = np.full(int(np.prod(sizes)), -1, dtype=np.intp)
+        lookup[feature_keys] = np.flatnonzero(found)
+
+        target_codes = [self.level_codes[level] for level in levels]
+        target_found = np.logical_and.reduce(
+            [codes >= 0 for codes in target_codes])
+        target_keys = np.ravel_multi_index(
+            [np.maximum(codes, 0) for codes in target_codes], sizes)
+        return np.where(target_found, lookup[target_keys], -1)
+
+
+def align_positions(feature_index: pd.Index,
+                    target_index,
+                    merge_on=None):
+    """
+    计算targets 的每一行对应feature 的哪一行，
+    相当于targets.join(feature, how='left', on=merge_on) 时的行位置。
+
+    Parameters:
+    -----------
+    feature_index:
+        pd.Index
+        feature 的index，需要无重复
+    target_index:
+        pd.Index, pd.MultiIndex or TargetCodes
+        targets 的index，或其整数编码
+    merge_on:
+        str, list of str, default None
+        合并依据的index level 名。为None 时使用feature_index 的名字
+
+    Return:
+    -------
+        np.ndarray
+        长度为len(target_index) 的位置数组，找不到对应行的位置为-1
+    """
+    if not isinstance(target_index, TargetCodes):
+        target_index = TargetCodes(target_index)
+    return target_index.positions(feature_index,
+                                  _merge_keys(feature_index, merge_on))
+
+
+class AlignmentCache(object):
+    """
+    一个processed 文件夹中targets 的整数编码，以及各feature 与targets 对齐的位置数组。
+    index 与缓存中的相同（同一个对象或值相等）时直接使用缓存的结果
+    """
+    def __init__(self):
+        self._target_codes = None
+        self._positions = []
+
+    def target_codes(self, target_index: pd.Index):
+        """targets index 的整数编码，targets 改变时重新编码"""
+        cached = self._target_codes
+        if cached is None or not _same_index(cached.index, target_index):
+            self._target_codes = TargetCodes(target_index)
+            self._positions = []
+        return self._target_codes
+
+    def positions(self, feature_index: pd.Index, target_index: pd.Index,
+                  merge_on=None):
+        """与align_positions 相同，结果按feature 的index 和合并依据缓存"""
+        codes = self.target_codes(target_index)
+        keys = _merge_keys(feature_index, merge_on)
+        for cached_index, cached_keys, positions in self._positions:
+            if cached_keys == keys and _same_index(cached_index,
+                                                   feature_index):
+                return positions
+        positions = codes.positions(feature_index, keys)
+        self._positions.append((feature_index, keys, positions))
+        return positions
+
+
+def _same_index(cached: pd.Index, index: pd.Index):
+    """比较两个index 是否相同，不需要对index 求哈希"""
+    return cached is index or (len(cached) == len(index)
+                               and cached.names == index.names
+                               and cached.equals(index))
+
+
+# 以processed 文件夹为key 的AlignmentCache
+_ALIGNMENT_CACHES = {}
+
+
+def alignment_cache(processed_dir: str):
+    """
+    返回processed 文件夹对应的AlignmentCache，同一个文件夹的多次回归共用
+
+    Parameters:
+    -----------
+    processed_dir:
+        str
+        保存processed data 的文件夹
+
+    Return:
+    -------
+        AlignmentCache
+    """
+    key = os.path.abspath(processed_dir)
+    if key not in _ALIGNMENT_CACHES:
+        _ALIGNMENT_CACHES[key] = AlignmentCache()
+    return _ALIGNMENT_CACHES[key]
+
+
+def _gather_into(out: np.ndarray, values: np.ndarray, positions: np.ndarray,
+                 missing: np.ndarray):
+    """按照positions 从values 中取值写入out，找不到的位置写为NaN"""
+    np.take(values, positions, out=out, mode='clip')
+    out[missing] = np.nan
+
+
+def _position_finder(target_index: pd.Index, cache: AlignmentCache = None):
+    """
+    返回按(index, 合并依据) 求对齐位置的函数，结果为(positions, 找不到对应行的mask)。
+    同一个index 只计算一次对齐位置（比如多个交互项共用同一个dummy）
+    """
+    position_cache = {}
+    target_codes = (TargetCodes(target_index)
+                    if cache is None else cache.target_codes(target_index))
+
+    def positions_of(index, on):
+        keys = None if on is None else tuple(_merge_keys(index, on))
+        key = (id(index), keys)
+        if key not in position_cache:
+            if cache is None:
+                positions = align_positions(index, target_codes, on)
+            else:
+                positions = cache.positions(index, target_index, on)
+            position_cache[key] = (positions, positions < 0)
+        return position_cache[key]
+
+    return positions_of
+
+
+def _interaction_keys(fea: DummyInteraction, on):
+    """
+    交互项中features 和dummy 各自与targets 对齐的依据，与features_mul_dummy 直接相乘时相同：
+    一方的index 只有一个level、另一方为MultiIndex 时，前者按broadcast_level 对应到后者的行，
+    乘积的index 与后者相同，on 为后者的合并依据
+
+    Return:
+    -------
+    tuple:
+        (features 的合并依据, dummy 的合并依据)
+    """
+    fea_multi = isinstance(fea.features.index, pd.MultiIndex)
+    dum_multi = isinstance(fea.dummy.index, pd.MultiIndex)
+    if dum_multi and not fea_multi:
+        return [fea.broadcast_level], on
+    if fea_multi and not dum_multi:
+        return on, [fea.broadcast_level]
+    return on, None
+
+
+def assemble_design(targets,
+                    features: list,
+                    merge_on: list = None,
+                    cache: AlignmentCache = None):
+    """
+    按照targets 的行顺序，将一组features 组装为一个预先分配好的设计矩阵。
+    Series 和DataFrame 按照合并依据的index 对齐后直接写入，DummyInteraction 则在写入时才与dummy 相乘。
+
+    Parameters:
+    -----------
+    targets:
+        pd.Series or pd.DataFrame
+        OLS 的targets，若为DataFrame 则只使用第一列
+    features:
+        list of pd.Series, pd.DataFrame or DummyInteraction
+        OLS 的features
+    merge_on:
+        list, default None
+        与features 一一对应的合并依据（index level 名）。为None 时使用各feature 的index 名
+    cache:
+        AlignmentCache, default None
+        对齐结果的缓存，见alignment_cache。为None 时每次重新对齐
+
+    Return:
+    -------
+    tuple:
+        (y, X, names)。y 为长度n 的ndarray，X 为(n, k) 的Fortran 顺序ndarray，
+        names 为X 每一列的列名
+    """
+    if isinstance(targets, pd.DataFrame):
+        targets = targets.iloc[:, 0]
+    if merge_on is None:
+        merge_on = [None] * len(features)
+
+    target_index = targets.index
+    n_rows = len(target_index)
+    names = [col for fea in features for col in feature_columns(fea)]
+    design = np.empty((n_rows, len(names)), dtype=float, order='F')
+    positions_of = _position_finder(target_index, cache)
+
+    col = 0
+    for fea, on in zip(features, merge_on):
+        if isinstance(fea, DummyInteraction):
+            fea_on, dum_on = _interaction_keys(fea, on)
+            fea_pos, fea_missing = positions_of(fea.features.index, fea_on)
+            dum_pos, dum_missing = positions_of(fea.dummy.index, dum_on)
+            dummy_values = fea.dummy.to_numpy().astype(float, copy=False)
+            dummy_col = np.take(dummy_values, dum_pos, mode='clip')
+            dummy_col[dum_missing] = np.nan
+            values = _as_2d_values(fea.features)
+            for j in range(values.shape[1]):
+                _gather_into(design[:, col], values[:, j], fea_pos,
+                             fea_missing)
+                np.multiply(design[:, col], dummy_col, out=design[:, col])
+                col += 1
+        else:
+            fea_pos, fea_missing = positions_of(fea.index, on)
+            values = _as_2d_values(fea)
+            for j in range(values.shape[1]):
+                _gather_into(design[:, col], values[:, j], fea_pos,
+                             fea_missing)
+                col += 1
+
+    return target_values(targets), design, names
+
+
+def assemble_valid(targets,
+                   features: list,
+                   valid: list = None,
+                   merge_on: list = None,
+                   cache: AlignmentCache = None):
+    """
+    targets 的每一行在组装设计矩阵后是否没有缺失值。结果与检查assemble_design 的结果中的NaN 相同，
+    但只需按对齐位置取出各feature 的有效位图并相与，不需要检查设计矩阵
+
+    Parameters:
+    -----------
+    targets, features, merge_on, cache:
+        见assemble_design
+    valid:
+        list, default None
+        与features 一一对应的有效位图（feature 每一行是否没有NaN 的bool ndarray，
+        如FeatureResolver.valid 的结果），
+        DummyInteraction 对应(features 的位图, dummy 的位图)。
+        为None 或其中某项为None 时由feature 的值计算
+
+    Return:
+    -------
+        np.ndarray
+        长度为len(targets) 的bool 数组
+    """
+    if merge_on is None:
+        merge_on = [None] * len(features)
+    if valid is None:
+        valid = [None] * len(features)
+    positions_of = _position_finder(targets.index, cache)
+
+    def gather(values, fea_valid, index, on):
+        if fea_valid is None:
+            fea_valid = finite_rows(_as_2d_values(values))
+        positions, missing = positions_of(index, on)
+        return np.take(fea_valid, positions, mode='clip') & ~missing
+
+    row_valid = np.isfinite(target_values(targets))
+    for fea, fea_valid, on in zip(features, valid, merge_on):
+        if isinstance(fea, DummyInteraction):
+            fea_valid, dum_valid = fea_valid if fea_valid is not None else (
+                None, None)
+            fea_on, dum_on = _interaction_keys(fea, on)
+            row_valid &= gather(fea.features, fea_valid, fea.features.index,
+                                fea_on)
+            row_valid &= gather(fea.dummy, dum_valid, fea.dummy.index, dum_on)
+        else:
+            row_valid &= gather(fea, fea_valid, fea.index, on)
+    return row_valid
+
+
+def drop_invalid(group_rows: dict, valid: np.ndarray):
+    """
+    删除每组中无效的行
+
+    Parameters:
+    -----------
+    group_rows:
+        dict
+        以组别为key，组内行位置为value，见group_positions
+    valid:
+        np.ndarray
+        每一行是否有效，见assemble_valid
+
+    Return:
+    -------
+    tuple:
+        (clean_rows, dropped)。clean_rows 为与group_rows 相同结构、只含有效行的dict，
+        dropped 为以组别为key、删除的行数为value 的dict
+    """
+    clean_rows, dropped = {}, {}
+    for group, rows in group_rows.items():
+        clean_rows[group] = rows[valid[rows]]
+        dropped[group] = len(rows) - len(clean_rows[group])
+    return clean_rows, dropped
+
+
+def target_values(targets):
+    """targets 的值，为DataFrame 时只使用第一列"""
+    if isinstance(targets, pd.DataFrame):
+        targets = targets.iloc[:, 0]
+    return targets.to_numpy().astype(float, copy=False)
+
+
+def group_positions(target_index: pd.Index, groupby_col):
+    """
+    返回按groupby_col 分组后每组在targets 中的行位置
+
+    Parameters:
+    -----------
+    target_index:
+        pd.MultiIndex
+        targets 的index
+    groupby_col:
+        str or list of str
+        分组依据的index level 名
+
+    Return:
+    -------
+        dict
+        以组别为key，行位置ndarray 为value，按组别排序
+    """
+    grouper = pd.Series(np.arange(len(target_index)), index=target_index)
+    return grouper.groupby(level=groupby_col).indices
+
+
+def date_level_key(features: list,
+                   target_index: pd.Index,
+                   groupby_col,
+                   merge_on: list = None):
+    """
+    判断一组features 是否只随日期变化：每个feature 都是Series 或DataFrame（没有交互项），
+    且都只按targets index 中同一个不属于groupby_col 的level 合并
+
+    Parameters:
+    -----------
+    features:
+        list of pd.Series, pd.DataFrame or DummyInteraction
+    target_index:
+        pd.MultiIndex
+        targets 的index
+    groupby_col:
+        str or list of str
+        分组依据的index level 名
+    merge_on:
+        list, default None
+        与features 一一对应的合并依据
+
+    Return:
+    -------
+        str or None
+        是时返回合并依据的level 名（通常为'Trddt'），否则返回None
+    """
+    if merge_on is None:
+        merge_on = [None] * len(features)
+    if isinstance(groupby_col, str):
+        groupby_col = [groupby_col]
+
+    keys = set()
+    for fea, on in zip(features, merge_on):
+        if not isinstance(fea, (pd.Series, pd.DataFrame)):
+            return None
+        fea_keys = _merge_keys(fea.index, on)
+        if len(fea_keys) != 1:
+            return None
+        keys.add(fea_keys[0])
+    if len(keys) != 1:
+        return None
+    key = keys.pop()
+    if key not in target_index.names or key in groupby_col:
+        return None
+    return key
+
+
+def assemble_date_design(features: list,
+                         target_index: pd.Index,
+                         key: str,
+                         merge_on: list = None,
+                         cache: AlignmentCache = None):
+    """
+    只随日期变化的features 在每个日期只组装一次设计矩阵，targets 的每一行通过date_codes 对应到其中一行
+
+    Parameters:
+    -----------
+    features:
+        list of pd.Series or pd.DataFrame
+    target_index:
+        pd.MultiIndex
+        targets 的index
+    key:
+        str
+        date_level_key 返回的level 名
+    merge_on:
+        list, default None
+        与features 一一对应的合并依据
+    cache:
+        AlignmentCache, default None
+        提供时使用其中缓存的targets 整数编码
+
+    Return:
+    -------
+    tuple:
+        (date_design, date_codes, names)。
+        date_design 为(m, k) 的ndarray，每行对应targets 中的一个日期
+        （按首次出现的顺序）；date_codes 为长度n 的ndarray，为targets 每一行所在日期的行号
+    """
+    target_codes = (TargetCodes(target_index)
+                    if cache is None else cache.target_codes(target_index))
+    level = target_codes.names.index(key)
+    # 交易日的整数编码按首次出现的顺序重新编号
+    date_codes, first_seen = pd.factorize(target_codes.level_codes[level])
+    unique_dates = target_codes.level_values[level].take(first_seen)
+    date_targets = pd.Series(np.nan, index=unique_dates.rename(key))
+    _, date_design, names = assemble_design(date_targets,
+                                            features,
+                                            merge_on=merge_on)
+    return date_design, date_codes, names
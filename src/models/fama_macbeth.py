@@ -0,0 +1,298 @@
+"""
+个股层面的Fama-MacBeth 回归。对股票面板（见stock_panel.py）的每个交易日做一次截面回归，
+再对各日的系数做时间序列平均，以Newey-West 标准误计算t 值。
+面板按日期排序后，每个日期的X'X 和X'y 由分段求和一次得到，一批日期的截面回归批量求解；
+日期按行数分批，分配到多个工作进程，数据通过共享内存传递。
+"""
+import multiprocessing as mp
+import os
+import numpy as np
+import pandas as pd
+import click
+from scipy import stats
+from src.features import stock_panel
+from src.models import hac
+from src.models import parallel_ols
+
+# 每批截面回归的最大行数，限制x·x' 占用的内存
+_CHUNK_ROWS = 200000
+
+# 工作进程中由_init_worker 设定的数据
+_WORKER_STATE = {}
+
+# 工作进程的启动方式与parallel_ols 相同
+_MP_CONTEXT = mp.get_context('spawn')
+
+
+def _date_chunks(bounds: np.ndarray, chunk_rows: int = _CHUNK_ROWS):
+    """
+    将日期按行数分批，返回每批的(起始日期, 结束日期)，结束日期不包含在内
+
+    Parameters:
+    -----------
+    bounds:
+        np.ndarray
+        长度为日期数加1，第d 个日期的行为bounds[d]:bounds[d + 1]
+    """
+    chunks, start = [], 0
+    n_dates = len(bounds) - 1
+    while start < n_dates:
+        end = int(np.searchsorted(bounds, bounds[start] + chunk_rows,
+                                  side='right')) - 1
+        end = min(max(end, start + 1), n_dates)
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def cross_section_solve(endog: np.ndarray, exog: np.ndarray,
+                        bounds: np.ndarray, min_nobs: int = None):
+    """
+    批量求解一批日期的截面回归，行已经按日期排序
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray, (n, )
+    exog:
+        np.ndarray, (n, k)，已经包含常数项
+    bounds:
+        np.ndarray
+        每个日期的起始行，最后一项为n
+    min_nobs:
+        int, default None
+        截面回归至少需要的股票数，为None 时为k + 1。不足的日期结果为NaN
+
+    Return:
+    -------
+    tuple:
+        (params, rsquared, nobs)，分别为(D, k)、(D, ) 和(D, ) 的ndarray
+    """
+    n_cols = exog.shape[1]
+    if min_nobs is None:
+        min_nobs = n_cols + 1
+    starts = bounds[:-1] - bounds[0]
+    nobs = np.diff(bounds)
+    # 个股的特征量级相差很大（如amihud 约为1e-10），X'X 的条件数是X 的平方，
+    # pinv 会舍去真实的方向。先将每列除以其均方根，求解后再换算回原来的量级
+    col_scale = np.sqrt(np.mean(exog**2, axis=0))
+    col_scale[~(np.isfinite(col_scale) & (col_scale > 0))] = 1.0
+    exog = exog / col_scale
+
+    xx = np.add.reduceat(exog[:, :, None] * exog[:, None, :], starts, axis=0)
+    xy = np.add.reduceat(exog * endog[:, None], starts, axis=0)
+    yy = np.add.reduceat(endog**2, starts)
+    y_sum = np.add.reduceat(endog, starts)
+
+    params = np.full((len(nobs), n_cols), np.nan)
+    rsquared = np.full(len(nobs), np.nan)
+    fitted = np.flatnonzero(nobs >= min_nobs)
+    if len(fitted) == 0:
+        return params, rsquared, nobs
+    beta = (np.linalg.pinv(xx[fitted]) @ xy[fitted, :, None])[:, :, 0]
+    ssr = (yy[fitted] - 2 * np.einsum('dk,dk->d', beta, xy[fitted]) +
+           np.einsum('dk,dkl,dl->d', beta, xx[fitted], beta))
+    centered_tss = yy[fitted] - y_sum[fitted]**2 / nobs[fitted]
+    params[fitted] = beta / col_scale
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsquared[fitted] = 1 - ssr / centered_tss
+    return params, rsquared, nobs
+
+
+def _init_worker(endog, exog, bounds, shapes, min_nobs):
+    _WORKER_STATE.update(endog=parallel_ols.shared_array(endog, shapes[0]),
+                         exog=parallel_ols.shared_array(exog, shapes[1]),
+                         bounds=bounds,
+                         min_nobs=min_nobs)
+
+
+def _solve_chunk(start: int, end: int):
+    """在工作进程中求解第start 到end 个日期的截面回归"""
+    bounds = _WORKER_STATE['bounds'][start:end + 1]
+    rows = slice(bounds[0], bounds[-1])
+    return cross_section_solve(_WORKER_STATE['endog'][rows],
+                               _WORKER_STATE['exog'][rows], bounds,
+                               _WORKER_STATE['min_nobs'])
+
+
+def newey_west_mean(series: np.ndarray, maxlags: int,
+                    kernel: str = 'bartlett'):
+    """
+    各列时间序列均值的Newey-West 标准误，与statsmodels 中对常数项回归、cov_type='HAC' 的结果相同
+
+    Parameters:
+    -----------
+    series:
+        np.ndarray, (T, k)
+    maxlags:
+        int
+    kernel:
+        str, default 'bartlett'
+
+    Return:
+    -------
+        np.ndarray, (k, )
+    """
+    n_periods, n_cols = series.shape
+    resid = (series - series.mean(axis=0)).T
+    ones = np.ones((n_cols, n_periods, 1))
+    pinv = ones.transpose(0, 2, 1) / n_periods
+    cov = hac.hac_covariance(ones, resid, pinv, maxlags, kernel=kernel)
+    return np.sqrt(cov[:, 0, 0])
+
+
+class FamaMacBethResults(object):
+    """
+    Fama-MacBeth 回归的结果。gammas 为以日期为index、系数名为列的各日截面回归系数，
+    params、bse、tvalues、pvalues 为以系数名为index 的Series
+    """
+    __slots__ = ('gammas', 'rsquared', 'nobs', 'bse', 'maxlags', 'kernel')
+
+    def __init__(self, gammas, rsquared, nobs, bse, maxlags, kernel):
+        self.gammas = gammas
+        self.rsquared = rsquared
+        self.nobs = nobs
+        self.bse = bse
+        self.maxlags = maxlags
+        self.kernel = kernel
+
+    @property
+    def params(self):
+        return self.gammas.mean()
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        # 与statsmodels 使用稳健协方差时相同，p 值基于正态分布
+        return pd.Series(2 * stats.norm.sf(np.abs(self.tvalues)),
+                         index=self.params.index)
+
+    @property
+    def n_periods(self):
+        return len(self.gammas)
+
+    def summary(self):
+        """
+        以系数名为index，系数均值、Newey-West 标准误、t 值和p 值为列的DataFrame
+        """
+        return pd.DataFrame({
+            'param': self.params,
+            'bse': self.bse,
+            'tvalue': self.tvalues,
+            'pvalue': self.pvalues
+        })
+
+
+def fama_macbeth(panel: pd.DataFrame,
+                 endog: str,
+                 exog: list,
+                 date_level: str = 'Trddt',
+                 add_const: bool = True,
+                 maxlags: int = 5,
+                 kernel: str = 'bartlett',
+                 min_nobs: int = None,
+                 workers: int = None):
+    """
+    对个股面板进行Fama-MacBeth 回归
+
+    Parameters:
+    -----------
+    panel:
+        pd.DataFrame
+        个股面板，index 中含有date_level，含有endog 和exog 列
+    endog:
+        str
+        被解释变量的列名，如'forward_ret'
+    exog:
+        list of str
+        解释变量的列名，如['norm_ret', 'turnover', 'amihud', 'size']
+    date_level:
+        str, default 'Trddt'
+        index 中日期的level 名
+    add_const:
+        bool, default True
+        截面回归是否加入常数项
+    maxlags:
+        int, default 5
+        Newey-West 标准误的滞后阶数，一般取持有期长度
+    kernel:
+        str, default 'bartlett'
+        见hac.KERNELS
+    min_nobs:
+        int, default None
+        截面回归至少需要的股票数，见cross_section_solve
+    workers:
+        int, default None
+        工作进程数，为None 时使用CPU 核数；为1 时在当前进程中计算
+
+    Return:
+    -------
+        FamaMacBethResults
+    """
+    exog = list(exog)
+    values = panel[[endog] + exog].to_numpy(dtype=float)
+    valid = np.isfinite(values).all(axis=1)
+    dates = panel.index.get_level_values(date_level)[valid]
+    values = values[valid]
+
+    # 按日期排序，每个日期的行连续排列
+    date_index, date_codes = np.unique(dates.to_numpy(), return_inverse=True)
+    date_codes = date_codes.ravel()
+    order = np.argsort(date_codes, kind='stable')
+    bounds = np.searchsorted(date_codes[order], np.arange(len(date_index) + 1))
+    y = values[order, 0]
+    X = values[order, 1:]
+    names = exog
+    if add_const:
+        X = np.column_stack([np.ones(len(y)), X])
+        names = ['const'] + exog
+
+    chunks = _date_chunks(bounds)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1 or len(chunks) <= 1:
+        _WORKER_STATE.update(endog=y, exog=X, bounds=bounds, min_nobs=min_nobs)
+        solved = [_solve_chunk(*chunk) for chunk in chunks]
+    else:
+        initargs = (parallel_ols.share_array(y), parallel_ols.share_array(X),
+                    bounds, (y.shape, X.shape), min_nobs)
+        with _MP_CONTEXT.Pool(processes=min(workers, len(chunks)),
+                              initializer=_init_worker,
+                              initargs=initargs) as pool:
+            solved = pool.starmap(_solve_chunk, chunks)
+
+    params, rsquared, nobs = (np.concatenate(parts) for parts in zip(*solved))
+    date_index = pd.Index(date_index, name=date_level)
+    gammas = pd.DataFrame(params, index=date_index, columns=names).dropna()
+    bse = pd.Series(newey_west_mean(gammas.to_numpy(), maxlags, kernel),
+                    index=names)
+    return FamaMacBethResults(gammas,
+                              pd.Series(rsquared, index=date_index),
+                              pd.Series(nobs, index=date_index),
+                              bse,
+                              maxlags=maxlags,
+                              kernel=kernel)
+
+
+@click.command()
+@click.option('--maxlags', type=int, default=5, help='Newey-West lags.')
+@click.argument('input_file', type=click.Path(exists=True, readable=True))
+@click.argument('output_file', type=click.Path(writable=True))
+def main(maxlags, input_file, output_file):
+    """
+    读取个股面板，以未来收益率对排序期标准化收益率、换手率、amihud 和规模进行Fama-MacBeth 回归，
+    保存各系数的均值、标准误、t 值和p 值
+    """
+    panel: pd.DataFrame = pd.read_pickle(input_file)
+    results = fama_macbeth(panel,
+                           endog='forward_ret',
+                           exog=stock_panel.CHARACTERISTICS,
+                           maxlags=maxlags)
+    results.summary().to_pickle(output_file)
+
+
+if __name__ == "__main__":
+    main()
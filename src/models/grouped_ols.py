@@ -1,10 +1,18 @@
 """分组计算OLS 的对象化接口，定义了分组OLS 的对象类"""
+import numpy as np
 import pandas as pd
 from src.features import process_data_api as proda
 from src.features.process_data_api import ProcessedType
+from src.features.feature_registry import (FeatureResolver, shared_resolver,
+                                           windows_from_dir)
+from src.models import design_matrix as dm
+from src.models import batched_ols as bols
+from src.models import bootstrap_ols
+from src.models import hac
+from src.models import pooled_ols
+from src.models import rolling_ols
 from statsmodels import api as sm
 from enum import Enum
-import re
 import warnings
 
 
@@ -33,6 +41,14 @@ class OLSFeatures(Enum):
     delta_std_full_sign = 'delta_std_full/ret_sign'
     delta_std_full_sign_rm = 'delta_std_full/ret_sign/market_ret'
 
+    # 其他流动性指标
+    roll_spread = 'roll_spread'
+    amivest = 'amivest'
+    zero_ret = 'zero_ret'
+    ps_gamma = 'ps_gamma'
+    liquidity = 'roll_spread&amivest&zero_ret&ps_gamma'
+    liquidity_sign = 'roll_spread&amivest&zero_ret&ps_gamma/ret_sign'
+
     # 同时有vol 和liquid 的部分
     std_amihudBack = 'rolling_std_log&amihud_back'
     std_amihudBack_sign = 'rolling_std_log&amihud_back/ret_sign'
@@ -40,18 +56,89 @@ class OLSFeatures(Enum):
     std_amihudBack_sign_3f = 'rolling_std_log&amihud_back/ret_sign/three_fac'
 
 
+def spec_parts(spec):
+    """
+    将main/dummy/control 格式的设定拆分为三个feature 名称的list
+
+    Parameters:
+    -----------
+    spec:
+        OLSFeatures or str
+        如'delta_std_full/ret_sign'
+        或'rolling_std_log&amihud_back/ret_sign/market_ret'
+
+    Return:
+    -------
+    tuple:
+        (main_list, dummy_list, control_list)，缺省的部分为空list
+    """
+    feas_str: str = spec.value if isinstance(spec, OLSFeatures) else spec
+    # 如果feas_str 中'/' 不足两个，则为其增加数量，使其有两个
+    if feas_str.count('/') < 2:
+        feas_str += '/' * (2 - feas_str.count('/'))
+    return tuple([name for name in part.split('&') if name != '']
+                 for part in feas_str.split('/')[:3])
+
+
+def combine_features(main: list, dummy: list, control: list,
+                     interaction=None):
+    """
+    按照设定的规则组合features：main 与每个dummy 相乘，control 则不会
+
+    Parameters:
+    -----------
+    main, dummy, control:
+        list
+        三种features，每一项为pd.Series 或pd.DataFrame
+    interaction:
+        function, default None
+        以(main 中的一项, dummy 中的一项) 为参数返回交互项的函数，
+        为None 时使用惰性的proda.features_mul_dummy
+
+    Return:
+    -------
+        list, 用于OLS 的features，顺序为dummy、main 和交互项（按name 排序）、control
+    """
+    if interaction is None:
+
+        def interaction(fea, dum):
+            return proda.features_mul_dummy(features=fea, dummy=dum, lazy=True)
+
+    if len(dummy) == 0:
+        # 没有dummy 时，直接组合main 和control
+        return list(main) + list(control)
+
+    # 交互项只记录(main, dummy) 对，在ols_in_group 组装设计矩阵时才相乘
+    main_mul_dummy_list = [
+        interaction(fea, dum) for fea in main for dum in dummy
+    ]
+    # 按照features 的name 排序，使输出顺序尽量可控。
+    # 但只能保证main 和dummy 都是Sereis 的时候有效
+    try:
+        main_and_mutiplied = sorted((list(main) + main_mul_dummy_list),
+                                    key=lambda x: x.name)
+        return list(dummy) + main_and_mutiplied + list(control)
+    except AttributeError:
+        # 如果main 或main_mul_dummy 中有DataFrame，
+        # 则不执行按name 排序，直接返回如下的顺序
+        return list(dummy) + list(main) + main_mul_dummy_list + list(control)
+
+
 class GroupedOLS(object):
     _ols_dframe = None
+    # 以(组别, 约束) 为key 缓存的检验结果，以及数组形式的结果，重新拟合时清空
+    _contrasts = None
+    _compact = None
+    # 以feature 对象的id 为key 的有效位图（见FeatureResolver.valid），以及最近一次拟合每组删除的行数
+    _feature_valid = None
+    _dropped_rows = None
 
     @property
     def forward_window(self):
-        if self._processed_dir == 'data/processed/':
-            self._forward_window = 5
-            return self._forward_window
-        else:
-            self._forward_window = int(
-                re.compile(r'(?<=f)\d').search(self._processed_dir).group())
-            return self._forward_window
+        # 从文件夹的元数据或文件夹名（如b40_f10）中读取持有期长度
+        self._forward_window = windows_from_dir(
+            self._processed_dir)['forward_window']
+        return self._forward_window
 
     # @forward_window.setter
     # def forward_window(self, value):
@@ -77,6 +164,11 @@ class GroupedOLS(object):
     def ols_dframe(self):
         return self._ols_dframe
 
+    @property
+    def dropped_rows(self):
+        """最近一次ols_in_group 中每组因含有NaN 而删除的行数，以组别为index 的Series"""
+        return self._dropped_rows
+
     # @ols_features.setter
     # def ols_features(self, value):
     #     if not isinstance(value, (pd.Series, pd.DataFrame)):
@@ -88,7 +180,8 @@ class GroupedOLS(object):
                  processed_dir: str = None,
                  ols_features=None,
                  targets=None,
-                 forward_window=None):
+                 forward_window=None,
+                 resolver: FeatureResolver = None):
         """
         一个用于分组回归的对象。
         支持的两种调用方式：
@@ -112,6 +205,11 @@ class GroupedOLS(object):
         forward_window:
             int
             持有期的长度
+        resolver:
+            FeatureResolver, default None
+            按名称求解features 的FeatureResolver，为None 时使用processed_dir 共用的
+            FeatureResolver（见feature_registry.shared_resolver）。
+            传入已经预先载入features 的resolver 可以避免重复读取
 
         Return:
         -------
@@ -131,6 +229,8 @@ class GroupedOLS(object):
             except TypeError as error:
                 raise error
 
+        self._resolver = resolver
+
         # 判定ols_features 参数
         if isinstance(ols_features, OLSFeatures):
             # 如果是OLSFeatures，则使用select_features 方法
@@ -154,9 +254,32 @@ class GroupedOLS(object):
                 raise TypeError('targets must be pd.DataFrame or pd.Series!')
             self._targets = targets
 
+    def _feature_resolver(self):
+        """
+        返回按名称求解features 的FeatureResolver，只读取或计算用到的features。
+        同一processed_dir 的GroupedOLS 共用一个（见shared_resolver），
+        未指定processed_dir 时使用'data/processed/'
+        """
+        if getattr(self, '_resolver', None) is not None:
+            return self._resolver
+        processed_dir = getattr(self, '_processed_dir', 'data/processed/')
+        params = None
+        if getattr(self, '_forward_window', None) is not None:
+            params = {'forward_window': self._forward_window}
+        return shared_resolver(processed_dir=processed_dir, params=params)
+
+    def _alignment_cache(self):
+        """
+        返回processed_dir 对应的targets 与features 对齐结果的缓存，未指定processed_dir 时为None
+        """
+        processed_dir = getattr(self, '_processed_dir', None)
+        if processed_dir is None:
+            return None
+        return dm.alignment_cache(processed_dir)
+
     def _get_proc_data(self, pro_data_type):
-        return proda.get_processed(from_dir=self._processed_dir,
-                                   which=pro_data_type)
+        return shared_resolver(processed_dir=self._processed_dir).get(
+            pro_data_type.name)
 
     def select_features(self, features_type: OLSFeatures):
         """
@@ -172,74 +295,44 @@ class GroupedOLS(object):
         将_ols_features 指定为features_type 对应的类型
         """
 
-        feas_str: str = features_type.value
-        # 如果feas_str 中'/' 不足两个，则为其增加数量，使其有两个
-        if feas_str.count('/') < 2:
-            feas_str += '/' * (2 - feas_str.count('/'))
-
-        # 分离出每个属性，大类分为main dummy 和control，每个里面为具体的ProcessedType.name
-        try:
-            main_list = feas_str.split('/')[0].split('&')
-            dummy_list = feas_str.split('/')[1].split('&')
-            control_list = feas_str.split('/')[2].split('&')
-        except Exception:
-            pass
-
-        # 三种features 分别按照str 取出来，
-        # list_three_type 中0, 1, 2 位置分别存储main, dummy 和control 三个list
-        list_three_type = []
-        for fea_str_list in [main_list, dummy_list, control_list]:
-            # 对每个存有ProcessedType name 的list 循环，按照其中的每个name 读取相应features
-            feas_a_type = list(
-                map(
-                    lambda x: None
-                    if x == '' else proda.get_processed(ProcessedType[x]),
-                    fea_str_list))
-            list_three_type.append(feas_a_type)
-
-        if list_three_type[1][0] is not None:
-            # 对于dummy list，如果不是None（这里以第一个项目为标准即可），则与main 相乘
-            main_mul_dummy_list = [
-                proda.features_mul_dummy(features=fea, dummy=dum)
-                for fea in list_three_type[0] for dum in list_three_type[1]
-            ]
-
-            # 按照features 的name 排序，使输出顺序尽量可控。
-            # 但只能保证main 和dummy 都是Sereis 的时候有效
-            try:
-                main_and_mutiplied = sorted(
-                    (list_three_type[0] + main_mul_dummy_list),
-                    key=lambda x: x.name)
-
-                features = list_three_type[
-                    1] + main_and_mutiplied + list_three_type[2]
-            except AttributeError:
-                # 如果main 或main_mul_dummy 中有DataFrame，
-                # 则不执行按name 排序，直接返回如下的顺序
-                features = list_three_type[1] + list_three_type[
-                    0] + main_mul_dummy_list + list_three_type[2]
-        else:
-            # 没有dummy 时，直接组合main 和control
-            features = list_three_type[0] + list_three_type[2]
-
-        # 去掉features 里的None
-        features = list(filter(None.__ne__, features))
+        main_list, dummy_list, control_list = spec_parts(features_type)
+
+        # 三种features 分别按照名称向注册表请求
+        resolver = self._feature_resolver()
+        values = {
+            name: resolver.get(name)
+            for name in main_list + dummy_list + control_list
+        }
+        features = combine_features([values[x] for x in main_list],
+                                    [values[x] for x in dummy_list],
+                                    [values[x] for x in control_list])
         self._ols_features = features
+        # 各feature 的有效位图由resolver 按名称缓存，不同设定共用
+        self._feature_valid = {
+            id(value): resolver.valid(name)
+            for name, value in values.items()
+        }
 
     # 用于单组内的OLS 回归设定，在在每组内apply
-    def __each_group_ols_setting(self, targets: pd.DataFrame,
-                                 features: pd.DataFrame):
+    def __each_group_ols_setting(self,
+                                 targets: pd.DataFrame,
+                                 features: pd.DataFrame,
+                                 add_const: bool = True):
         """
         根据一个targets 和一组features，设定一个OLS model 类
         Parameters:
         -----------
         targets:
             pd.DataFrame
-            用于OLS 模型设定的targets（Y 值）
+            用于OLS 模型设定的targets（Y 值），已经删除了含有NaN 的行
 
         features:
             pd.DataFrame
-            用于OLS 模型设定的features（X 值）
+            用于OLS 模型设定的features（X 值），已经删除了含有NaN 的行
+
+        add_const:
+            bool, default True
+            是否加入常数项。与sm.add_constant 相同，应按删除NaN 之前组内是否已有常数列判断
 
         Results:
         --------
@@ -247,34 +340,52 @@ class GroupedOLS(object):
             一个statsmodels 下的OLS 类
         """
 
-        features = sm.add_constant(features)
-        ols_model = sm.OLS(endog=targets, exog=features, missing='drop')
+        if add_const:
+            features = sm.add_constant(features, has_constant='add')
+        # 传入的数据已经删除了含有NaN 的行，不需要statsmodels 再检查
+        ols_model = sm.OLS(endog=targets, exog=features, missing='none')
         return ols_model
 
-    def __each_ols_train(self, model: sm.OLS):
+    def __each_ols_train(self,
+                         model: sm.OLS,
+                         maxlags: int = None,
+                         kernel: str = 'bartlett'):
         """
         对输入的OLS model 进行拟合，返回拟合的结果。
-        默认使用修正了异方差、自相关、多重共线性后的协方差矩阵，滞后阶数为5
+        默认使用修正了异方差、自相关、多重共线性后的协方差矩阵，滞后阶数为持有期长度
 
         Parameters:
         -----------
         model:
             statsmodels.regression.linear_models.OLS
             一个statsmodels 下的OLS 类
+        maxlags:
+            int, default None
+            HAC 的滞后阶数，为None 时使用forward_window
+        kernel:
+            str, default 'bartlett'
+            HAC 的核函数，见hac.KERNELS
 
         Results:
         --------
         statsmodels.regression.linear_models.OLSResults
             statsmodels 下的OLSResults，即OLS 拟合后的结果类
         """
+        if maxlags is None:
+            maxlags = self._forward_window
         fit = model.fit(cov_type='HAC',
-                        cov_kwds={'maxlags': self._forward_window})
+                        cov_kwds=hac.hac_cov_kwds(maxlags,
+                                                  kernel=kernel,
+                                                  nobs=model.nobs))
         return fit
 
     # 用于将target 与features 组合后进行分组设定回归模型的函数
     def ols_in_group(self,
                      merge_on: list = None,
-                     groupby_col=['cap_group', 'rev_group']):
+                     groupby_col=['cap_group', 'rev_group'],
+                     backend: str = 'statsmodels',
+                     maxlags=None,
+                     hac_kernel: str = 'bartlett'):
         """
         为一个target 和一个或一组features 进行分组ols 拟合。结果返回按照groupby_col 为index 的DataFrame
 
@@ -289,72 +400,427 @@ class GroupedOLS(object):
             str, list of str, default ['cap_group', 'rev_group']
             用于分组进行OLS 回归时的组别列
 
+        backend:
+            str, default 'statsmodels'
+            'statsmodels' 时每组构建一个statsmodels 的OLS 对象拟合；
+            'batched' 时使用batched_ols 一次求解所有组，结果与前者一致。
+            features 只随日期变化时，设计矩阵只在日期上组装一次，所有组共用其伪逆
+
+        maxlags:
+            int or dict, default None
+            HAC 的滞后阶数，为dict 时以组别为key 为每组指定。为None 或dict 中缺少的组使用forward_window
+
+        hac_kernel:
+            str, default 'bartlett'
+            HAC 的核函数，'bartlett'、'parzen' 或'qs'
+
         Return:
         -------
         pd.DataFrame
             分组回归后，以groupby_col 为index（或mutiIndex）为index 的DataFrame
-            每一项都为statsmodels 下的OLSResult 对象
+            每一项都为statsmodels 下的OLSResult 对象，
+            backend='batched' 时为GroupOLSResult 对象
+
+        """
+
+        if backend not in ('statsmodels', 'batched'):
+            raise ValueError(
+                "backend must be 'statsmodels' or 'batched', got {}.".format(
+                    backend))
+
+        combine_list = self.__combine_list(merge_on)
+
+        target_index = self._targets.index
+        cache = self._alignment_cache()
+        group_rows: dict = dm.group_positions(target_index, groupby_col)
+        group_lags = self.__group_lags(group_rows, maxlags)
+
+        # 合并各feature 的有效位图得到需要删除的行，求解时只使用有效的行
+        valid = dm.assemble_valid(self._targets,
+                                  combine_list,
+                                  valid=self.__valid_list(combine_list),
+                                  merge_on=merge_on,
+                                  cache=cache)
+        clean_rows, dropped = dm.drop_invalid(group_rows, valid)
+        self._dropped_rows = pd.Series(dropped)
+        self._dropped_rows.index.names = (groupby_col if isinstance(
+            groupby_col, list) else [groupby_col])
+
+        date_key = dm.date_level_key(combine_list, target_index, groupby_col,
+                                     merge_on)
+        if backend == 'batched' and date_key is not None:
+            # features 只随日期变化，在日期上组装一次设计矩阵，各组作为多个因变量一次求解
+            date_design, date_codes, names = dm.assemble_date_design(
+                combine_list,
+                target_index,
+                date_key,
+                merge_on=merge_on,
+                cache=cache)
+            ols_trained: pd.Series = bols.fit_shared_design(
+                dm.target_values(self._targets),
+                date_design,
+                date_codes,
+                group_rows,
+                names,
+                maxlags=list(group_lags.values()),
+                kernel=hac_kernel,
+                valid=valid).to_series()
+            self.__set_ols_dframe(ols_trained, groupby_col)
+            return self
+
+        # 按targets 的行顺序将所有features（包括交互项）直接写入一个设计矩阵
+        endog, design, names = dm.assemble_design(self._targets,
+                                                  combine_list,
+                                                  merge_on=merge_on,
+                                                  cache=cache)
+        endog_name = (self._targets.columns[0] if isinstance(
+            self._targets, pd.DataFrame) else self._targets.name)
+        if endog_name is None:
+            endog_name = 0
+
+        # 使用传入的分组参数groupby_col 对设计矩阵分组，每组内设定OLS 模型对象并拟合
+        if backend == 'batched':
+            # 堆叠所有组的设计矩阵，一次求解
+            ols_trained: pd.Series = bols.fit_batched(
+                endog,
+                design,
+                group_rows,
+                names,
+                maxlags=list(group_lags.values()),
+                kernel=hac_kernel,
+                valid=valid).to_series()
+        else:
+            ols_trained = {}
+            for group, rows in group_rows.items():
+                kept = clean_rows[group]
+                group_index = target_index[kept]
+                ols_model = self.__each_group_ols_setting(
+                    pd.Series(endog[kept], index=group_index,
+                              name=endog_name),
+                    pd.DataFrame(design[kept],
+                                 index=group_index,
+                                 columns=names),
+                    add_const=bols._has_const(design[rows]))
+                ols_trained[group] = self.__each_ols_train(
+                    ols_model, maxlags=group_lags[group], kernel=hac_kernel)
+            ols_trained: pd.Series = pd.Series(ols_trained)
+        self.__set_ols_dframe(ols_trained, groupby_col)
 
+        return self
+
+    def rolling_in_group(self,
+                         window: int = None,
+                         min_nobs: int = None,
+                         merge_on: list = None,
+                         groupby_col=['cap_group', 'rev_group'],
+                         date_level: str = 'Trddt',
+                         use_hac: bool = False,
+                         maxlags=None,
+                         hac_kernel: str = 'bartlett'):
+        """
+        分组进行滚动窗口或扩展窗口的OLS，观察系数随时间的变化。
+        每组按日期递推地更新X'X 和X'y，不对每个窗口重新拟合，见rolling_ols.py
+
+        Parameter:
+        ----------
+        window:
+            int, default None
+            滚动窗口包含的交易日数，为None 时使用扩展窗口
+
+        min_nobs:
+            int, default None
+            窗口中至少需要的有效观测数，为None 时为系数个数加1
+
+        merge_on, groupby_col:
+            与ols_in_group 相同
+
+        date_level:
+            str, default 'Trddt'
+            targets 的index 中日期的level 名
+
+        use_hac:
+            bool, default False
+            是否计算滚动窗口的HAC 标准误，为False 时使用普通OLS 的标准误。只能用于滚动窗口
+
+        maxlags, hac_kernel:
+            与ols_in_group 相同，只在use_hac 为True 时使用
+
+        Return:
+        -------
+        rolling_ols.RollingOLSResults
+            params、bse、tvalues 和pvalues 均为以日期为index、
+            (cap_group, rev_group, 系数名) 为列
+            的DataFrame
+        """
+        combine_list = self.__combine_list(merge_on)
+        target_index = self._targets.index
+        endog, design, names = dm.assemble_design(
+            self._targets,
+            combine_list,
+            merge_on=merge_on,
+            cache=self._alignment_cache())
+        group_rows: dict = dm.group_positions(target_index, groupby_col)
+        group_lags = (list(self.__group_lags(group_rows, maxlags).values())
+                      if use_hac else None)
+        results = rolling_ols.rolling_in_group(endog,
+                                               design,
+                                               names,
+                                               target_index,
+                                               group_rows,
+                                               groupby_col=groupby_col,
+                                               date_level=date_level,
+                                               window=window,
+                                               min_nobs=min_nobs,
+                                               maxlags=group_lags,
+                                               kernel=hac_kernel)
+
+        # 与ols_dframe 相同，规模分组按从小到大排列
+        for attr in ('params', 'bse', 'nobs'):
+            setattr(
+                results, attr,
+                getattr(results, attr).reindex(
+                    columns=['Small', '2', '3', '4', 'Big'], level=0))
+        return results
+
+    def bootstrap(self,
+                  n_reps: int = 1000,
+                  block_length: int = None,
+                  method: str = 'stationary',
+                  seed=None,
+                  workers: int = None,
+                  merge_on: list = None,
+                  groupby_col=['cap_group', 'rev_group'],
+                  date_level: str = 'Trddt'):
+        """
+        分组OLS 系数的块自助法推断。每次重抽样中所有组使用同一组按块抽取的日期，
+        保留组合之间的截面相关，见bootstrap_ols.py
+
+        Parameter:
+        ----------
+        n_reps:
+            int, default 1000
+            重抽样次数
+
+        block_length:
+            int, default None
+            块长度（'stationary' 时为其期望），为None 时使用forward_window
+
+        method:
+            str, default 'stationary'
+            'moving' 或'stationary'
+
+        seed:
+            int, default None
+            随机数种子，相同的种子得到相同的结果
+
+        workers:
+            int, default None
+            工作进程数，为None 时使用CPU 核数
+
+        merge_on, groupby_col:
+            与ols_in_group 相同
+
+        date_level:
+            str, default 'Trddt'
+            targets 的index 中日期的level 名
+
+        Return:
+        -------
+        bootstrap_ols.BootstrapResults
+            bse()、conf_int() 和pvalues() 返回以(cap_group, rev_group) 为index、
+            系数名为列的DataFrame
+        """
+        combine_list = self.__combine_list(merge_on)
+        target_index = self._targets.index
+        endog, design, names = dm.assemble_design(
+            self._targets,
+            combine_list,
+            merge_on=merge_on,
+            cache=self._alignment_cache())
+        group_rows = self.__cap_ordered_rows(target_index, groupby_col)
+        # 日期按先后顺序编码，块由相邻的日期组成
+        date_codes = self.__date_codes(target_index, date_level)
+        if block_length is None:
+            block_length = self._forward_window
+        return bootstrap_ols.block_bootstrap(
+            endog,
+            design,
+            names,
+            date_codes,
+            group_rows,
+            n_reps=n_reps,
+            block_length=block_length,
+            method=method,
+            seed=seed,
+            workers=workers,
+            group_names=(groupby_col if isinstance(groupby_col, list) else
+                         [groupby_col]))
+
+    def pooled_in_group(self,
+                        common: list = None,
+                        cov_type: str = 'cluster',
+                        maxlags: int = None,
+                        hac_kernel: str = 'bartlett',
+                        merge_on: list = None,
+                        groupby_col=['cap_group', 'rev_group'],
+                        date_level: str = 'Trddt'):
         """
+        将所有组合堆叠为一个面板回归一次求解，每组有自己的常数项和斜率，见pooled_ols.py。
+        各组的系数与ols_in_group 相同，但标准误按日期聚类（或为Driscoll-Kraay 标准误），
+        估计了不同组系数之间的协方差，可以直接检验组间的系数是否相等
 
+        Parameter:
+        ----------
+        common:
+            list of str, default None
+            所有组使用共同斜率的features 列名，如['rm_exc_t_1']
+
+        cov_type:
+            str, default 'cluster'
+            'cluster' 为按日期聚类的标准误，'driscoll-kraay' 为Driscoll-Kraay 标准误
+
+        maxlags:
+            int, default None
+            Driscoll-Kraay 标准误的滞后阶数，为None 时使用forward_window
+
+        hac_kernel:
+            str, default 'bartlett'
+            Driscoll-Kraay 标准误的核函数
+
+        merge_on, groupby_col:
+            与ols_in_group 相同
+
+        date_level:
+            str, default 'Trddt'
+            targets 的index 中日期的level 名
+
+        Return:
+        -------
+        pooled_ols.PooledOLSResults
+            params 等为以(cap_group, rev_group, 系数名) 为index 的Series，
+            如results.equality_test(
+                'delta_std_full', groups=[('Small', 'Lo-Hi'), ('Big', 'Lo-Hi')])
+        """
+        combine_list = self.__combine_list(merge_on)
+        target_index = self._targets.index
+        endog, design, names = dm.assemble_design(
+            self._targets,
+            combine_list,
+            merge_on=merge_on,
+            cache=self._alignment_cache())
+        if maxlags is None:
+            maxlags = self._forward_window
+        return pooled_ols.pooled_ols(
+            endog,
+            design,
+            names,
+            self.__date_codes(target_index, date_level),
+            self.__cap_ordered_rows(target_index, groupby_col),
+            common=[] if common is None else list(common),
+            cov_type=cov_type,
+            maxlags=maxlags,
+            kernel=hac_kernel,
+            group_names=(groupby_col if isinstance(groupby_col, list) else
+                         [groupby_col]))
+
+    @staticmethod
+    def __cap_ordered_rows(target_index: pd.Index, groupby_col):
+        """每组的行位置，与ols_dframe 相同，规模分组按从小到大排列"""
+        cap_order = ['Small', '2', '3', '4', 'Big']
+        return dict(
+            sorted(dm.group_positions(target_index, groupby_col).items(),
+                   key=lambda item: cap_order.index(item[0][0])
+                   if item[0][0] in cap_order else len(cap_order)))
+
+    @staticmethod
+    def __date_codes(target_index: pd.Index, date_level: str):
+        """targets 每一行的日期按先后顺序的编码"""
+        _, date_codes = np.unique(
+            target_index.get_level_values(date_level).to_numpy(),
+            return_inverse=True)
+        return date_codes.ravel()
+
+    def __valid_list(self, combine_list: list):
+        """
+        与combine_list 一一对应的有效位图，DummyInteraction 为(features 的, dummy 的)。
+        不是由select_features 得到的feature 为None，组装时由其值计算
+        """
+        known = self._feature_valid or {}
+        valid = []
+        for fea in combine_list:
+            if isinstance(fea, proda.DummyInteraction):
+                valid.append((known.get(id(fea.features)),
+                              known.get(id(fea.dummy))))
+            else:
+                valid.append(known.get(id(fea)))
+        return valid
+
+    def __combine_list(self, merge_on):
+        """检查features 和merge_on，返回features 组成的list"""
         # 输入的merge_on 如果不是None，则应该与features 序列的长度相同
         assert (
             merge_on is None or len(merge_on) == len(self._ols_features)
         ), "Parameter 'merge_on' must be None or as long as '_ols_features'"
 
-        # 判定输入的类型，统一转置为DataFrame 然后合并
+        # 判定输入的类型，统一为list 后组装设计矩阵
         if isinstance(self._ols_features, (list, tuple)):
             combine_list = list(self._ols_features)
-        elif isinstance(self._ols_features, pd.DataFrame) or isinstance(
-                self._ols_features, pd.Series):
+        elif isinstance(self._ols_features,
+                        (pd.DataFrame, pd.Series, proda.DummyInteraction)):
             combine_list = [self._ols_features]
         else:
             raise TypeError(
                 'features type must be DataFrame, Series or list of them.')
-        combine_list.insert(0, self._targets)
 
-        combine_df_list = [
-            pd.DataFrame(item) if not isinstance(item, pd.DataFrame) else item
-            for item in combine_list
-        ]
+        # 如果传入的merge_on 为空值，那么使用features 的index 的name 合并
+        if merge_on is None or None in merge_on:
+            warnings.warn('Did not specify on which to merge Y and X, \
+                using X\'s index instead.')
+        return combine_list
 
-        # 依次将features 数据框合并进用于ols 回归的总数据框中，用于下一步的回归。
-        df_for_ols = combine_df_list[0]
-        for i, feature_df in enumerate(combine_df_list[1:]):
-            # 如果传入的merge_on 为空值，那么将其设定为features 的index 的name
-            if merge_on is None or merge_on[i] is None:
-                warnings.warn('Did not specify on which to merge Y and X, \
-                    using X\'s index instead.')
-                perhap_index_name = [
-                    feature_df.index.name, feature_df.index.names
-                ]
-                merger = [
-                    item for item in perhap_index_name if item is not None
-                ][0]
-            else:
-                merger = merge_on[i]
+    @classmethod
+    def from_ols_results(cls, ols_results: pd.Series):
+        """
+        由已经拟合好的一组结果构造只用于查看结果的GroupedOLS，如parallel_ols.fit_all 返回结果中的一个spec
 
-            # 将targets 与features 合并为一个数据框，用于下一步分组OLS
-            df_for_ols = df_for_ols.join(feature_df,
-                                         how='left',
-                                         on=merger,
-                                         lsuffix='target')
+        Parameters:
+        -----------
+        ols_results:
+            pd.Series
+            以组别为index（或MultiIndex），每组的OLS 结果为值
 
-        # 使用传入的分组参数groupby_col 对组合完的数据框分组，每组内应用前面的函数设定OLS 模型对象
-        ols_setted: pd.DataFrame = df_for_ols.groupby(
-            groupby_col).apply(lambda df: self.__each_group_ols_setting(
-                df.iloc[:, 0], df.iloc[:, 1:]))
+        Return:
+        -------
+            GroupedOLS
+        """
+        obj = cls.__new__(cls)
+        obj._ols_features = None
+        obj._targets = None
+        obj.__set_ols_dframe(ols_results, list(ols_results.index.names))
+        return obj
 
-        # 对上面设定完的每个OLS 对象进行拟合
-        ols_trained: pd.Series = ols_setted.apply(self.__each_ols_train)
+    def __set_ols_dframe(self, ols_trained: pd.Series, groupby_col):
+        """将以组别为index 的结果整理为规模分组为index、反转分组为列的DataFrame"""
+        ols_trained.index.names = (groupby_col if isinstance(
+            groupby_col, list) else [groupby_col])
 
         # reindex the Series for the ols results
         ols_frame_reindexed = ols_trained.reindex(
             index=['Small', '2', '3', '4', 'Big'], level=0).unstack()
 
         self._ols_dframe = ols_frame_reindexed
-
-        return self
+        self._contrasts = {}
+        self._compact = None
+
+    def __group_lags(self, group_rows: dict, maxlags=None):
+        """返回每组HAC 的滞后阶数，顺序与group_rows 相同"""
+        if not isinstance(maxlags, dict):
+            default = self._forward_window if maxlags is None else maxlags
+            return {group: default for group in group_rows}
+        return {
+            group: maxlags.get(group, self._forward_window)
+            for group in group_rows
+        }
 
     def __star_df(self, pvalue):
         """
@@ -370,6 +836,93 @@ class GroupedOLS(object):
         else:
             return ''
 
+    def compact_results(self):
+        """
+        以数组保存的所有组的结果，用于对所有组一次进行检验，重新拟合时重新生成
+
+        Return:
+        -------
+            BatchedOLSResults
+        """
+        if self._ols_dframe is None:
+            self.ols_in_group()
+        if self._compact is None:
+            self._compact = bols.BatchedOLSResults.from_results(
+                self._ols_dframe)
+        return self._compact
+
+    def t_test(self, restriction):
+        """
+        对所有组一次进行线性约束的t 检验，见BatchedOLSResults.t_test
+
+        Parameters:
+        -----------
+        restriction:
+            str, list of str, dict or np.ndarray
+            约束公式如'delta_std_t_1 + delta_std_t_2 = 0'，或系数名称的list（检验其和为0）
+
+        Return:
+        -------
+        pd.DataFrame
+            以组别为index，列为effect、sd、tvalue 和pvalue
+        """
+        return self.compact_results().t_test(restriction)
+
+    def wald_test(self, restriction, use_f: bool = False):
+        """
+        对所有组一次进行所有约束同时成立的联合检验，见BatchedOLSResults.wald_test
+
+        Return:
+        -------
+        pd.DataFrame
+            以组别为index，列为statistic、df_num 和pvalue
+        """
+        return self.compact_results().wald_test(restriction, use_f=use_f)
+
+    def __contrast(self, group, column):
+        """返回一组中某个系数的(系数, t 值, p 值)，每组每个系数只取一次"""
+        key = (group, column)
+        if key not in self._contrasts:
+            ols_result = self._ols_dframe.loc[group]
+            self._contrasts[key] = (ols_result.params[column],
+                                    ols_result.tvalues[column],
+                                    ols_result.pvalues[column])
+        return self._contrasts[key]
+
+    def __contrast_frames(self, restriction):
+        """
+        返回restriction 在各组的系数、t 值和p 值三个DataFrame，形状与_ols_dframe 相同。
+        restriction 为约束公式时对所有组一次检验，为int 或系数名时直接取该系数的结果，
+        结果都以(组别, restriction) 为key 缓存
+        """
+        rows, cols = self._ols_dframe.index, self._ols_dframe.columns
+        groups = [(row, col) for row in rows for col in cols]
+        if restriction is None:
+            raise ValueError('restriction must not be None.')
+        is_formula = (isinstance(restriction, str) and restriction
+                      not in self._ols_dframe.iloc[0, 0].params.index)
+        if is_formula and any((group, restriction) not in self._contrasts
+                              for group in groups):
+            tested = self.t_test(restriction)
+            if len(tested) != len(self.compact_results()):
+                raise ValueError('t_test_str must be a single restriction.')
+            for group, contrast in zip(
+                    tested.index,
+                    tested[['effect', 'tvalue', 'pvalue']].to_numpy()):
+                self._contrasts[(group, restriction)] = tuple(contrast)
+
+        contrasts = [[
+            self._contrasts[((row, col), restriction)]
+            if is_formula else self.__contrast((row, col), restriction)
+            for col in cols
+        ] for row in rows]
+        return [
+            pd.DataFrame([[contrast[i] for contrast in row_contrasts]
+                          for row_contrasts in contrasts],
+                         index=rows,
+                         columns=cols) for i in range(3)
+        ]
+
     def look_up_ols_detail(self, detail, column=None, t_test_str=None):
         """
         返回一个OLSRsults 对象组成的DataFrame 的系数、pvalue、tvalue 等细节
@@ -420,39 +973,19 @@ class GroupedOLS(object):
             return self._ols_dframe.iloc[0, 0].params.index.tolist()
         # 返回系数
         elif detail == 'param':
-            result_df = self._ols_dframe.applymap(
-                lambda ols_result: ols_result.params[column].round(4))
-
-        # 判定是否需要计算p_value df
-        if detail.startswith('pvalue') or detail.endswith('star'):
-            # 如果计算pvalue 或是需要计算star，那么计算pvalue_df
-            try:
-                # 首先尝试用t_test_str 获取t 检验后的t 值
-                pvalue_df = self._ols_dframe.applymap(
-                    lambda ols_result: ols_result.t_test(t_test_str
-                                                         ).pvalue.item())
-            except ValueError:
-                try:
-                    # 尝试使用column 找到t 值
-                    pvalue_df = self._ols_dframe.applymap(
-                        lambda ols_result: ols_result.pvalues[column].round(4))
-                except KeyError:
-                    raise ValueError("Must provide a int for column or a str"
-                                     "for t_test_str if is a t test.")
+            result_df = self.__contrast_frames(column)[0].round(4)
 
-        # 判定是否需要计算tvalue df
-        if detail.startswith('t_test'):
-            # 如果是t 检验相关
+        # 判定是否需要计算p_value df 或tvalue df，两者由同一次检验得到
+        if detail.startswith('pvalue') or detail.startswith('t_test'):
             try:
-                # 先尝试使用t_test_str 进行t 检验并返回t 值
-                tvalue_df = self._ols_dframe.applymap(
-                    lambda ols_result: ols_result.t_test(t_test_str
-                                                         ).tvalue.item())
+                # 首先尝试用t_test_str 进行t 检验
+                _, tvalue_df, pvalue_df = self.__contrast_frames(t_test_str)
             except ValueError:
                 try:
-                    # 再尝试使用column 找到t 值
-                    tvalue_df = self._ols_dframe.applymap(
-                        lambda ols_result: ols_result.tvalues[column].round(4))
+                    # 再尝试使用column 找到t 值和p 值
+                    _, tvalue_df, pvalue_df = self.__contrast_frames(column)
+                    tvalue_df, pvalue_df = tvalue_df.round(4), pvalue_df.round(
+                        4)
                 except KeyError:
                     raise ValueError("Must provide a column or a t_test_str "
                                      "for t test.")
@@ -0,0 +1,205 @@
+"""
+Newey-West 类的HAC 协方差矩阵。一次对多组回归计算sandwich 协方差，支持Bartlett、Parzen 和
+Quadratic Spectral（QS）三种核，每组可以使用不同的滞后阶数。
+grouped_ols.py 的批量求解直接调用hac_covariance；逐组使用statsmodels 拟合时，
+hac_cov_kwds 生成相应的cov_kwds，两者的结果一致。
+"""
+import numpy as np
+
+KERNELS = ('bartlett', 'parzen', 'qs')
+
+# 直接逐阶累加自协方差的最大滞后阶数，超过时（QS 核）使用FFT 计算
+_DIRECT_MAX_LAG = 64
+
+
+def _check_kernel(kernel: str):
+    if kernel not in KERNELS:
+        raise ValueError('kernel must be one of {}, got {}.'.format(
+            KERNELS, kernel))
+
+
+def kernel_weights(kernel: str, lags, n_lags: int):
+    """
+    计算0,...,n_lags 阶自协方差的核权重。x = j / (lags + 1)，
+    Bartlett 核与statsmodels 的weights_bartlett 相同，QS 核以lags + 1 为带宽，不截断
+
+    Parameters:
+    -----------
+    kernel:
+        str
+        'bartlett', 'parzen' 或'qs'
+    lags:
+        int or np.ndarray
+        每组的滞后阶数（QS 核为带宽减1），为ndarray 时返回每组一行的权重
+    n_lags:
+        int
+        需要计算权重的最大阶数
+
+    Return:
+    -------
+        np.ndarray，形状为(n_lags + 1,)，lags 为ndarray 时为(len(lags), n_lags + 1)
+    """
+    _check_kernel(kernel)
+    lags = np.asarray(lags, dtype=float)
+    x = np.arange(n_lags + 1) / (lags[..., None] + 1.0)
+
+    if kernel == 'bartlett':
+        weights = np.clip(1 - x, 0, None)
+    elif kernel == 'parzen':
+        weights = np.where(x <= 0.5, 1 - 6 * x**2 + 6 * x**3,
+                           2 * np.clip(1 - x, 0, None)**3)
+    else:
+        z = 6 * np.pi * x / 5
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = 25 / (12 * np.pi**2 * x**2) * (np.sin(z) / z -
+                                                      np.cos(z))
+        weights[..., 0] = 1.0
+    return weights
+
+
+def effective_max_lag(kernel: str, lags, nobs: int):
+    """给定观测数时，核权重不为0 的最大滞后阶数"""
+    _check_kernel(kernel)
+    if kernel == 'qs':
+        return max(int(nobs) - 1, 0)
+    return min(int(np.max(lags)), max(int(nobs) - 1, 0))
+
+
+def weights_func(kernel: str, bandwidth: int = None):
+    """
+    返回可以传给statsmodels cov_kwds['weights_func'] 的函数
+
+    Parameters:
+    -----------
+    kernel:
+        str
+    bandwidth:
+        int, default None
+        QS 核的lags（带宽减1）。为None 时与Bartlett 和Parzen 一样，使用statsmodels 传入的nlags
+    """
+    _check_kernel(kernel)
+
+    def _weights(nlags):
+        lags = nlags if bandwidth is None else bandwidth
+        return kernel_weights(kernel, lags, nlags)
+
+    return _weights
+
+
+def hac_cov_kwds(maxlags: int, kernel: str = 'bartlett', nobs: int = None):
+    """
+    返回statsmodels 中model.fit(cov_type='HAC', cov_kwds=...) 所需的cov_kwds
+
+    Parameters:
+    -----------
+    maxlags:
+        int
+        滞后阶数（QS 核为带宽减1）
+    kernel:
+        str, default 'bartlett'
+    nobs:
+        int, default None
+        回归的观测数，kernel 为'qs' 时必须提供
+
+    Return:
+    -------
+        dict
+    """
+    _check_kernel(kernel)
+    if kernel == 'bartlett':
+        return {'maxlags': maxlags}
+    elif kernel == 'parzen':
+        return {'maxlags': maxlags, 'weights_func': weights_func('parzen')}
+    if nobs is None:
+        raise ValueError("nobs is needed for the 'qs' kernel.")
+    return {
+        'maxlags': effective_max_lag('qs', maxlags, nobs),
+        'weights_func': weights_func('qs', bandwidth=maxlags)
+    }
+
+
+def _lagged_cross_products(scores: np.ndarray, n_lags: int):
+    """
+    用FFT 计算0,...,n_lags 阶的交叉乘积和gamma[g, j] = scores[g, j:].T @ scores[g, :-j]
+
+    Return:
+    -------
+        np.ndarray, (G, n_lags + 1, k, k)
+    """
+    n_rows = scores.shape[1]
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_rows)))
+    spectrum = np.fft.rfft(scores, n=n_fft, axis=1)
+    cross = np.einsum('gfi,gfj->gfij', spectrum, spectrum.conj())
+    return np.fft.irfft(cross, n=n_fft, axis=1)[:, :n_lags + 1]
+
+
+def hac_meat(scores: np.ndarray, lags, kernel: str = 'bartlett'):
+    """
+    对所有组一次计算HAC 的meat，即核加权的各阶自协方差之和
+
+    Parameters:
+    -----------
+    scores:
+        np.ndarray, (G, m, k)
+        每组每一行的x * resid，末尾可以补0
+    lags:
+        int or array like of int
+        滞后阶数，为array like 时每组一个（QS 核为带宽减1）
+    kernel:
+        str, default 'bartlett'
+
+    Return:
+    -------
+        np.ndarray, (G, k, k)
+    """
+    _check_kernel(kernel)
+    n_groups, n_rows = scores.shape[:2]
+    lags = np.broadcast_to(np.asarray(lags), (n_groups, ))
+    n_lags = effective_max_lag(kernel, lags, n_rows)
+    weights = kernel_weights(kernel, lags, n_lags)
+
+    if n_lags <= _DIRECT_MAX_LAG:
+        sigma = np.einsum('gni,gnj->gij', scores, scores)
+        for lag in range(1, n_lags + 1):
+            lagged = np.einsum('gni,gnj->gij', scores[:, lag:],
+                               scores[:, :-lag])
+            sigma += weights[:, lag, None, None] * (
+                lagged + lagged.transpose(0, 2, 1))
+    else:
+        gamma = _lagged_cross_products(scores, n_lags)
+        sigma = gamma[:, 0] + np.einsum('gj,gjik->gik', weights[:, 1:],
+                                        gamma[:, 1:] +
+                                        gamma[:, 1:].transpose(0, 1, 3, 2))
+    return sigma
+
+
+def hac_covariance(X: np.ndarray,
+                   resid: np.ndarray,
+                   pinv: np.ndarray,
+                   lags,
+                   kernel: str = 'bartlett'):
+    """
+    对所有组一次计算HAC 协方差矩阵，与statsmodels 的cov_type='HAC' 相同（不做小样本修正）。
+    各组的行可以在末尾补0，补0 的行X * resid 为0，不影响结果。
+
+    Parameters:
+    -----------
+    X:
+        np.ndarray, (G, m, k)
+    resid:
+        np.ndarray, (G, m)
+    pinv:
+        np.ndarray, (G, k, m)，X 的伪逆
+    lags:
+        int or array like of int
+        滞后阶数，为array like 时每组一个（QS 核为带宽减1）
+    kernel:
+        str, default 'bartlett'
+
+    Return:
+    -------
+        np.ndarray, (G, k, k)
+    """
+    sigma = hac_meat(X * resid[:, :, None], lags, kernel=kernel)
+    bread = pinv @ pinv.transpose(0, 2, 1)
+    return bread @ sigma @ bread.transpose(0, 2, 1)
@@ -1,9 +1,14 @@
 """一些进行OLS 线性回归的函数和方法"""
 
+import os
 import pandas as pd
 from src.features import process_data_api as proda
 import statsmodels.api as sm
 import click
+from src.models import design_matrix as dm
+from src.models import hac
+from src.models import batched_ols as bols
+from src.models.batched_ols import BatchedOLSResults
 from src.models.grouped_ols import OLSFeatures
 
 
@@ -100,7 +105,7 @@ def _each_group_ols_setting(targets: pd.DataFrame, features: pd.DataFrame):
     return ols_model
 
 
-def _each_ols_train(model: sm.OLS):
+def _each_ols_train(model: sm.OLS, maxlags: int = 5, kernel='bartlett'):
     """
     对输入的OLS model 进行拟合，返回拟合的结果。
     默认使用修正了异方差、自相关、多重共线性后的协方差矩阵，滞后阶数为5
@@ -110,13 +115,22 @@ def _each_ols_train(model: sm.OLS):
     model:
         statsmodels.regression.linear_models.OLS
         一个statsmodels 下的OLS 类
+    maxlags:
+        int, default 5
+        HAC 的滞后阶数
+    kernel:
+        str, default 'bartlett'
+        HAC 的核函数，见hac.KERNELS
 
     Results:
     --------
     statsmodels.regression.linear_models.OLSResults
         statsmodels 下的OLSResults，即OLS 拟合后的结果类
     """
-    fit = model.fit(cov_type='HAC', cov_kwds={'maxlags': 5})
+    fit = model.fit(cov_type='HAC',
+                    cov_kwds=hac.hac_cov_kwds(maxlags,
+                                              kernel=kernel,
+                                              nobs=model.nobs))
     return fit
 
 
@@ -124,9 +138,14 @@ def _each_ols_train(model: sm.OLS):
 def ols_in_group(target: pd.Series,
                  features: list,
                  merge_on: list = None,
-                 groupby_col=['cap_group', 'rev_group']):
+                 groupby_col=['cap_group', 'rev_group'],
+                 maxlags: int = 5,
+                 hac_kernel: str = 'bartlett',
+                 processed_dir: str = None,
+                 backend: str = 'statsmodels'):
     """
     为一个target 和一个或一组features 进行分组ols 拟合。结果返回按照groupby_col 为index 的DataFrame
+    targets 与features 按整数编码的交易日和组合对齐，设计矩阵由对齐的行位置直接取值得到
 
     Parameter:
     ----------
@@ -147,19 +166,41 @@ def ols_in_group(target: pd.Series,
         str, list of str, default ['cap_group', 'rev_group']
         用于分组进行OLS 回归时的组别列
 
+    maxlags:
+        int, default 5
+        HAC 的滞后阶数
+
+    hac_kernel:
+        str, default 'bartlett'
+        HAC 的核函数，'bartlett'、'parzen' 或'qs'
+
+    processed_dir:
+        str, default None
+        target 和features 所在的processed 文件夹。指定时对齐结果按该文件夹缓存，
+        同一文件夹的多次回归不再重复对齐
+
+    backend:
+        str, default 'statsmodels'
+        'statsmodels' 时每组构建一个statsmodels 的OLS 对象拟合；
+        'batched' 时与GroupedOLS.ols_in_group 相同，使用batched_ols 一次求解所有组及其HAC 协方差
+
     Return:
     -------
     pd.DataFrame
         分组回归后，以groupby_col 为index（或mutiIndex）为index 的DataFrame
-        每一项都为statsmodels 下的OLSResult 对象
+        每一项都为statsmodels 下的OLSResult 对象，backend='batched' 时为GroupOLSResult 对象
 
     """
+    if backend not in ('statsmodels', 'batched'):
+        raise ValueError(
+            "backend must be 'statsmodels' or 'batched', got {}.".format(
+                backend))
 
     # 输入的merge_on 如果不是None，则应该与features 序列的长度相同
     assert (merge_on is None or len(merge_on) == len(features)
             ), 'Parameter \'merge_on\' must be None or as long as \'features\''
 
-    # 判定输入的类型，统一转置为DataFrame 然后合并
+    # 判定输入的类型，统一为list
     if isinstance(features, (list, tuple)):
         combine_list = list(features)
     elif isinstance(features, pd.DataFrame) or isinstance(features, pd.Series):
@@ -167,38 +208,46 @@ def ols_in_group(target: pd.Series,
     else:
         raise TypeError(
             'features type must be DataFrame, Series or list of them.')
-    combine_list.insert(0, target)
-
-    combine_df_list = [
-        pd.DataFrame(item) if not isinstance(item, pd.DataFrame) else item
-        for item in combine_list
-    ]
-
-    # 依次将features 数据框合并进用于ols 回归的总数据框中，用于下一步的回归。
-    df_for_ols = combine_df_list[0]
-    for i, feature_df in enumerate(combine_df_list[1:]):
-        # 如果传入的merge_on 为空值，那么将其设定为features 的index 的name
-        if merge_on is None or merge_on[i] is None:
-            print('Did not specify on which to merge Y and X, \
-                using X\'s index instead.')
-            perhap_index_name = [feature_df.index.name, feature_df.index.names]
-            merger = [item for item in perhap_index_name
-                      if item is not None][0]
-        else:
-            merger = merge_on[i]
-
-        # 将targets 与features 合并为一个数据框，用于下一步分组OLS
-        df_for_ols = df_for_ols.join(feature_df,
-                                     how='left',
-                                     on=merger,
-                                     lsuffix='target')
-
-    # 使用传入的分组参数groupby_col 对组合完的数据框分组，每组内应用前面的函数设定OLS 模型对象
-    ols_setted: pd.DataFrame = df_for_ols.groupby(groupby_col).apply(
-        lambda df: _each_group_ols_setting(df.iloc[:, 0], df.iloc[:, 1:]))
-
-    # 对上面设定完的每个OLS 对象进行拟合
-    ols_trained: pd.Series = ols_setted.apply(_each_ols_train)
+
+    # 如果传入的merge_on 为空值，那么使用features 的index 的name 合并
+    if merge_on is None or None in merge_on:
+        print('Did not specify on which to merge Y and X, \
+            using X\'s index instead.')
+
+    # 按target 的行顺序，由对齐的行位置将所有features 写入一个设计矩阵
+    cache = (None if processed_dir is None else
+             dm.alignment_cache(processed_dir))
+    endog, design, names = dm.assemble_design(target,
+                                              combine_list,
+                                              merge_on=merge_on,
+                                              cache=cache)
+    endog_name = (target.columns[0]
+                  if isinstance(target, pd.DataFrame) else target.name)
+
+    # 使用传入的分组参数groupby_col 对设计矩阵分组，每组内设定OLS 模型对象并拟合
+    group_rows = dm.group_positions(target.index, groupby_col)
+    if backend == 'batched':
+        # 堆叠所有组的设计矩阵，一次求解
+        ols_trained: pd.Series = bols.fit_batched(
+            endog,
+            design,
+            group_rows,
+            names,
+            maxlags=maxlags,
+            kernel=hac_kernel).to_series()
+    else:
+        ols_trained = {}
+        for group, rows in group_rows.items():
+            group_index = target.index[rows]
+            ols_model = _each_group_ols_setting(
+                pd.Series(endog[rows], index=group_index, name=endog_name),
+                pd.DataFrame(design[rows], index=group_index, columns=names))
+            ols_trained[group] = _each_ols_train(ols_model,
+                                                 maxlags=maxlags,
+                                                 kernel=hac_kernel)
+        ols_trained: pd.Series = pd.Series(ols_trained)
+    ols_trained.index.names = (groupby_col if isinstance(groupby_col, list)
+                               else [groupby_col])
 
     # reindex the Series for the ols results
     ols_series_reindexed = ols_trained.reindex(
@@ -226,7 +275,8 @@ def read_ols_results_df(ols_features_type: OLSFeatures,
     Results:
     --------
     pandas.DataFrame:
-        相应的ols_features_type 生成的一组OLS Results 数据框
+        相应的ols_features_type 生成的一组OLS Results 数据框。
+        每一项为GroupOLSResult，可以通过to_statsmodels() 还原为statsmodels 的OLSResults
     """
 
     # 确定返回的模式在需要的两种之一
@@ -235,9 +285,13 @@ def read_ols_results_df(ols_features_type: OLSFeatures,
             style)
         raise ValueError(msg)
 
-    # 从保存的文件中读取ols_results DataFrame
-    file_path = 'models/ols_on_' + ols_features_type.value + '.pickle'
-    ols_results_df: pd.DataFrame = pd.read_pickle(file_path)
+    # 从保存的文件中读取ols_results，旧的pickle 文件仍然可以读取
+    file_path = 'models/ols_on_' + ols_features_type.value
+    if os.path.exists(file_path + '.npz'):
+        ols_results_df: pd.Series = BatchedOLSResults.load(
+            file_path + '.npz').to_series()
+    else:
+        ols_results_df: pd.DataFrame = pd.read_pickle(file_path + '.pickle')
 
     # 根据style 的要求，返回所需的表格样式
     if style == 'portrait':
@@ -350,7 +404,9 @@ def look_up_ols_detail(ols_result_df: pd.DataFrame,
     return result_df.rename_axis(index=None, columns=None)
 
 
-def ols_quick(features_type: OLSFeatures, targets=None):
+def ols_quick(features_type: OLSFeatures,
+              targets=None,
+              backend: str = 'statsmodels'):
     """
     使用不同的features，对超额收益率计算的反转组合收益，进行OLS 回归。
     最终将不同组（规模 * 反转策略）的OLS 回归结果组成的pd.DataFrame 保存，
@@ -366,6 +422,9 @@ def ols_quick(features_type: OLSFeatures, targets=None):
         FeaturesType
         进行OLS 模型设定时，使用的features 的类型
         如[market_ret, rolling_std_log, delta_std, delta_std_and_rm]
+    backend:
+        str, default 'statsmodels'
+        见ols_in_group
 
     Returns:
     --------
@@ -380,7 +439,8 @@ def ols_quick(features_type: OLSFeatures, targets=None):
     features: pd.DataFrame = select_features(features_type)
 
     # 对targets 和features 进行回归。其中，merger_on_col 为None，默认使用features 的index
-    ols_results_series: pd.Series = ols_in_group(targets, features)
+    ols_results_series: pd.Series = ols_in_group(
+        targets, features, processed_dir='data/processed/', backend=backend)
 
     return ols_results_series
 
@@ -389,8 +449,13 @@ def ols_quick(features_type: OLSFeatures, targets=None):
 @click.option('--featurestype',
               type=click.Choice([e.name for e in OLSFeatures]),
               help='select the features\' type being to use')
+@click.option('--backend',
+              type=click.Choice(['statsmodels', 'batched']),
+              default='batched',
+              show_default=True,
+              help='fit each group with statsmodels or all groups at once')
 @click.argument('output_file', type=click.Path(writable=True))
-def main(featurestype, output_file):
+def main(featurestype, backend, output_file):
     """
     调用ols_quick() 计算分组ols 的结果
 
@@ -400,14 +465,17 @@ def main(featurestype, output_file):
         str
         进行OLS 模型设定时，使用的features 的类型
         如[market_ret, rolling_std_log, delta_std, delta_std_and_rm]
+    backend:
+        str
+        见ols_in_group，默认一次求解所有组
     """
 
     # 使用ols_quick 进行回归。
     ols_results_series = ols_quick(
-        features_type=getattr(OLSFeatures, featurestype))
+        features_type=getattr(OLSFeatures, featurestype), backend=backend)
 
-    # 保存结果
-    ols_results_series.to_pickle(output_file)
+    # 只保存系数、协方差等数组，不保存statsmodels 对象中的数据
+    BatchedOLSResults.from_results(ols_results_series).save(output_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,158 @@
+"""
+并行拟合多个OLSFeatures 设定的分组OLS。所有设定用到的features 和targets 只在主进程中读取一次，
+其值复制到共享内存后由各个工作进程直接引用，不再各自读取或序列化传输。
+每个工作进程返回数组形式的BatchedOLSResults，最后合并为一个以设定名为第一层index 的表。
+"""
+import multiprocessing as mp
+import os
+import numpy as np
+import pandas as pd
+from src.features.feature_registry import FeatureResolver, shared_resolver
+from src.models.batched_ols import BatchedOLSResults
+from src.models.grouped_ols import GroupedOLS, OLSFeatures
+
+# 工作进程中由_init_worker 设定的共享数据
+_WORKER_STATE = {}
+
+# numba 的并行核函数启动线程后再fork 会使工作进程死锁，因此使用spawn 启动工作进程
+_MP_CONTEXT = mp.get_context('spawn')
+
+
+def spec_feature_names(spec: OLSFeatures):
+    """
+    返回一个OLSFeatures 设定中用到的feature 名称
+
+    Parameters:
+    -----------
+    spec:
+        OLSFeatures
+
+    Return:
+    -------
+        list of str
+    """
+    return [
+        name for part in spec.value.split('/') for name in part.split('&')
+        if name != ''
+    ]
+
+
+def share_array(values: np.ndarray):
+    """
+    将数值数组以float64 复制到共享内存中，返回可以作为工作进程initializer 参数传递的RawArray。
+    工作进程中用shared_array 得到直接引用共享内存的数组
+    """
+    shared = _MP_CONTEXT.RawArray('d', values.size)
+    np.frombuffer(shared).reshape(values.shape)[...] = values
+    return shared
+
+
+def shared_array(shared, shape: tuple):
+    """由share_array 的结果得到形状为shape 的数组，不复制数据"""
+    return np.frombuffer(shared).reshape(shape)
+
+
+def _to_shared(value):
+    """
+    将Series 或DataFrame 的值复制到共享内存中，返回可以传给工作进程的(values, 其余部分)。
+    非数值的数据不放入共享内存，直接传递
+    """
+    values = value.to_numpy()
+    if not np.issubdtype(values.dtype, np.number):
+        return None, value
+    shared = share_array(values)
+    if isinstance(value, pd.DataFrame):
+        meta = ('frame', values.shape, value.index, value.columns)
+    else:
+        meta = ('series', values.shape, value.index, value.name)
+    return shared, meta
+
+
+def _from_shared(shared, meta):
+    """由_to_shared 的结果得到直接引用共享内存的Series 或DataFrame"""
+    if shared is None:
+        return meta
+    kind, shape, index, labels = meta
+    values = shared_array(shared, shape)
+    if kind == 'frame':
+        return pd.DataFrame(values, index=index, columns=labels, copy=False)
+    return pd.Series(values, index=index, name=labels, copy=False)
+
+
+def _init_worker(shared_data: dict, processed_dir: str):
+    """工作进程的initializer，由共享内存重建features 和targets"""
+    values = {
+        name: _from_shared(*payload)
+        for name, payload in shared_data.items()
+    }
+    resolver = FeatureResolver(processed_dir=processed_dir)
+    resolver.preload(values)
+    _WORKER_STATE['resolver'] = resolver
+    _WORKER_STATE['processed_dir'] = processed_dir
+
+
+def _fit_spec(spec_name: str, ols_kwargs: dict):
+    """在工作进程中拟合一个设定，返回(设定名, BatchedOLSResults)"""
+    resolver = _WORKER_STATE['resolver']
+    obj = GroupedOLS(processed_dir=_WORKER_STATE['processed_dir'],
+                     ols_features=OLSFeatures[spec_name],
+                     targets=resolver.get('targets'),
+                     resolver=resolver)
+    obj.ols_in_group(**ols_kwargs)
+    return spec_name, BatchedOLSResults.from_results(obj.ols_dframe)
+
+
+def fit_all(specs=None,
+            processed_dir: str = 'data/processed/',
+            workers: int = None,
+            **ols_kwargs):
+    """
+    使用进程池并行拟合多个OLSFeatures 设定的分组OLS
+
+    Parameters:
+    -----------
+    specs:
+        list of OLSFeatures, default None
+        需要拟合的设定，为None 时拟合OLSFeatures 中的所有设定
+    processed_dir:
+        str, default 'data/processed/'
+        保存processed data 的文件夹
+    workers:
+        int, default None
+        工作进程数，为None 时使用CPU 核数；为1 时在当前进程中依次拟合
+    **ols_kwargs:
+        传给GroupedOLS.ols_in_group 的参数，如backend、maxlags、hac_kernel
+
+    Return:
+    -------
+    pd.Series
+        以(spec, cap_group, rev_group) 为index 的结果表，每一项为GroupOLSResult。
+        results.loc[spec] 即为该设定按组别排列的结果
+    """
+    specs = list(OLSFeatures) if specs is None else list(specs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # 所有设定用到的features 只读取一次
+    resolver = shared_resolver(processed_dir=processed_dir)
+    names = ['targets'] + sorted(
+        {name
+         for spec in specs for name in spec_feature_names(spec)})
+    shared_data = {name: _to_shared(resolver.get(name)) for name in names}
+
+    spec_names = [spec.name for spec in specs]
+    if workers == 1:
+        _init_worker(shared_data, processed_dir)
+        fitted = dict(_fit_spec(name, ols_kwargs) for name in spec_names)
+    else:
+        with _MP_CONTEXT.Pool(processes=min(workers, len(spec_names)),
+                              initializer=_init_worker,
+                              initargs=(shared_data, processed_dir)) as pool:
+            fitted = dict(
+                pool.starmap(_fit_spec,
+                             [(name, ols_kwargs) for name in spec_names]))
+
+    results = [fitted[name].to_series() for name in spec_names]
+    return pd.concat(results,
+                     keys=spec_names,
+                     names=['spec'] + list(results[0].index.names))
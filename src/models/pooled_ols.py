@@ -0,0 +1,291 @@
+"""
+将所有组合堆叠为一个面板回归一次求解。每组有自己的常数项（组固定效应）和自己的斜率，
+也可以指定部分features 使用所有组共同的斜率。设计矩阵以稀疏矩阵保存，由稀疏的正规方程求解。
+标准误按日期聚类，或为Driscoll-Kraay 标准误（每个日期所有组的得分之和做HAC），
+因此不同组的系数之间的协方差也被估计，组间系数是否相等的检验即为一个Wald 检验。
+"""
+import numpy as np
+import pandas as pd
+from scipy import sparse, stats
+from scipy.sparse.linalg import splu
+from src.models import batched_ols as bols
+from src.models import contrast
+from src.models import hac
+
+COV_TYPES = ('cluster', 'driscoll-kraay')
+
+# 所有组共同的系数在index 中组别的位置上使用的标记
+COMMON = 'all'
+
+
+class PooledOLSResults(object):
+    """
+    面板回归的结果。params、bse、tvalues 和pvalues 为以(组别..., 系数名) 为index 的Series，
+    共同斜率的组别记为COMMON；cov_params 为所有系数的协方差矩阵
+    """
+    __slots__ = ('params', 'cov_params', 'nobs', 'n_dates', 'cov_type',
+                 'maxlags')
+
+    def __init__(self,
+                 params,
+                 cov_params,
+                 nobs,
+                 n_dates,
+                 cov_type='cluster',
+                 maxlags=None):
+        self.params = params
+        self.cov_params = cov_params
+        self.nobs = nobs
+        self.n_dates = n_dates
+        self.cov_type = cov_type
+        self.maxlags = maxlags
+
+    @property
+    def bse(self):
+        return pd.Series(np.sqrt(np.diag(self.cov_params.to_numpy())),
+                         index=self.params.index)
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        # 与statsmodels 使用稳健协方差时相同，p 值基于正态分布
+        return pd.Series(2 * stats.norm.sf(np.abs(self.tvalues)),
+                         index=self.params.index)
+
+    def coef(self, name: str, detail: str = 'params'):
+        """
+        一个系数在所有组的值，以组别为index
+
+        Parameters:
+        -----------
+        name:
+            str
+            系数名，如'delta_std_full'
+        detail:
+            str, default 'params'
+            'params', 'bse', 'tvalues' 或'pvalues'
+        """
+        return getattr(self, detail).xs(name, level=-1)
+
+    def wald_test(self, restriction):
+        """
+        对所有系数的线性约束进行一个联合的Wald 检验
+
+        Parameters:
+        -----------
+        restriction:
+            dict, list or np.ndarray
+            dict 时以params 的index（(组别..., 系数名) 的tuple）为key、权重为value，检验加权和为0；
+            list 时检验这些系数之和为0；np.ndarray 时为约束矩阵R
+
+        Return:
+        -------
+            pd.Series, 含有statistic、df_num 和pvalue
+        """
+        r_mat, q = contrast.restriction_matrix(list(self.params.index),
+                                               restriction)
+        statistic, pvalue = contrast.wald_contrast(
+            self.params.to_numpy()[None], self.cov_params.to_numpy()[None],
+            r_mat, q)
+        return pd.Series({
+            'statistic': statistic[0],
+            'df_num': r_mat.shape[0],
+            'pvalue': pvalue[0]
+        })
+
+    def equality_test(self, name: str, groups: list = None):
+        """
+        检验一个系数在多个组中都相等，如'delta_std_full' 在Small 和Big 的各组中是否相同
+
+        Parameters:
+        -----------
+        name:
+            str
+            系数名
+        groups:
+            list, default None
+            参与比较的组别，为None 时比较所有有该系数的组
+
+        Return:
+        -------
+            pd.Series, 含有statistic、df_num 和pvalue
+        """
+        keys = list(self.params.index)
+        if groups is None:
+            groups = [key[:-1] for key in keys if key[-1] == name]
+        groups = [group if isinstance(group, tuple) else (group, )
+                  for group in groups]
+        if len(groups) < 2:
+            raise ValueError('At least two groups are needed, got {}.'.format(
+                len(groups)))
+        first = keys.index(groups[0] + (name, ))
+        r_mat = np.zeros((len(groups) - 1, len(keys)))
+        for row, group in enumerate(groups[1:]):
+            r_mat[row, first] = 1.0
+            r_mat[row, keys.index(group + (name, ))] = -1.0
+        return self.wald_test(r_mat)
+
+
+def pooled_design(endog: np.ndarray,
+                  design: np.ndarray,
+                  names: list,
+                  group_rows: dict,
+                  common: list = ()):
+    """
+    将所有组堆叠为一个稀疏的设计矩阵。每组的常数项（组内已有非零常数列时没有）和斜率各占一组列，
+    common 中的features 在最后占据所有组共同的列。含NaN 的行被删除
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, k) 的设计矩阵，不含常数项
+    names:
+        list of str
+        design 各列的名称
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+    common:
+        list of str, default ()
+        所有组使用共同斜率的features
+
+    Return:
+    -------
+    tuple:
+        (y, X, rows, keys)。y 为堆叠后的targets，X 为scipy.sparse 的csr 矩阵，
+        rows 为y 每一行在targets 中的位置，keys 为X 每一列的(组别..., 系数名)
+    """
+    names = list(names)
+    unknown = [name for name in common if name not in names]
+    if unknown:
+        raise ValueError('Unknown common features: {}.'.format(unknown))
+    common_cols = [names.index(name) for name in common]
+    group_cols = [col for col in range(len(names)) if col not in common_cols]
+
+    valid = np.isfinite(endog) & np.isfinite(design).all(axis=1)
+    blocks, keys, stacked_rows = [], [], []
+    n_stacked, n_cols = 0, 0
+    for group, rows in group_rows.items():
+        group_key = group if isinstance(group, tuple) else (group, )
+        has_const = bols._has_const(design[rows][:, group_cols])
+        rows = rows[valid[rows]]
+        values = design[rows][:, group_cols]
+        group_names = [names[col] for col in group_cols]
+        if has_const:
+            values = np.column_stack([np.ones(len(rows)), values])
+            group_names = ['const'] + group_names
+        width = values.shape[1]
+        blocks.append((np.repeat(np.arange(n_stacked, n_stacked + len(rows)),
+                                 width),
+                       np.tile(np.arange(n_cols, n_cols + width),
+                               len(rows)), values.ravel()))
+        keys.extend(group_key + (name, ) for name in group_names)
+        stacked_rows.append(rows)
+        n_stacked += len(rows)
+        n_cols += width
+
+    rows = (np.concatenate(stacked_rows)
+            if stacked_rows else np.array([], dtype=int))
+    if common_cols:
+        n_levels = len(keys[0]) - 1 if keys else 1
+        values = design[rows][:, common_cols]
+        blocks.append((np.repeat(np.arange(n_stacked), len(common_cols)),
+                       np.tile(np.arange(n_cols, n_cols + len(common_cols)),
+                               n_stacked), values.ravel()))
+        keys.extend((COMMON, ) * n_levels + (name, ) for name in common)
+        n_cols += len(common_cols)
+
+    row_idx, col_idx, data = (np.concatenate(parts) for parts in zip(*blocks))
+    X = sparse.csr_matrix((data, (row_idx, col_idx)),
+                          shape=(n_stacked, n_cols))
+    return endog[rows], X, rows, keys
+
+
+def pooled_ols(endog: np.ndarray,
+               design: np.ndarray,
+               names: list,
+               date_codes: np.ndarray,
+               group_rows: dict,
+               common: list = (),
+               cov_type: str = 'cluster',
+               maxlags: int = None,
+               kernel: str = 'bartlett',
+               group_names=None,
+               use_correction: bool = True):
+    """
+    所有组一次求解的面板回归
+
+    Parameters:
+    -----------
+    endog, design, names, group_rows, common:
+        见pooled_design
+    date_codes:
+        np.ndarray
+        长度为n，targets 每一行按先后顺序编码的日期
+    cov_type:
+        str, default 'cluster'
+        'cluster' 为按日期聚类的标准误；'driscoll-kraay' 时对每个日期所有行的得分之和做HAC
+    maxlags:
+        int, default None
+        Driscoll-Kraay 标准误的滞后阶数
+    kernel:
+        str, default 'bartlett'
+        Driscoll-Kraay 标准误的核函数，见hac.KERNELS
+    group_names:
+        list of str, default None
+        组别的名称，如['cap_group', 'rev_group']
+    use_correction:
+        bool, default True
+        是否与statsmodels 的cov_type='cluster' 一样进行小样本修正
+
+    Return:
+    -------
+        PooledOLSResults
+    """
+    if cov_type not in COV_TYPES:
+        raise ValueError('cov_type must be one of {}, got {}.'.format(
+            COV_TYPES, cov_type))
+    if cov_type == 'driscoll-kraay' and maxlags is None:
+        raise ValueError('maxlags is needed for Driscoll-Kraay errors.')
+
+    y, X, rows, keys = pooled_design(endog, design, names, group_rows,
+                                     common)
+    n_obs, n_params = X.shape
+    # 各组的列互不重叠，X'X 除了共同斜率所在的行和列之外为分块对角
+    factor = splu((X.T @ X).tocsc())
+    params = factor.solve(X.T @ y)
+    bread = factor.solve(np.eye(n_params))
+
+    # 每个日期所有行（所有组）的得分之和
+    resid = y - X @ params
+    dates = date_codes[rows]
+    n_dates = int(dates.max()) + 1 if n_obs else 0
+    by_date = sparse.csr_matrix((np.ones(n_obs), (dates, np.arange(n_obs))),
+                                shape=(n_dates, n_obs))
+    scores = np.asarray((by_date @ X.multiply(resid[:, None])).todense())
+    scores = scores[np.asarray(by_date.sum(axis=1)).ravel() > 0]
+
+    lags = 0 if cov_type == 'cluster' else maxlags
+    meat = hac.hac_meat(scores[None], lags, kernel=kernel)[0]
+    cov = bread @ meat @ bread.T
+    if use_correction:
+        n_clusters = len(scores)
+        cov *= (n_clusters / (n_clusters - 1.0) * (n_obs - 1.0) /
+                (n_obs - n_params))
+
+    index = pd.MultiIndex.from_tuples(
+        keys, names=(list(group_names) if group_names is not None else
+                     [None] * (len(keys[0]) - 1)) + [None])
+    return PooledOLSResults(pd.Series(params, index=index),
+                            pd.DataFrame(cov, index=index, columns=index),
+                            nobs=n_obs,
+                            n_dates=len(scores),
+                            cov_type=cov_type,
+                            maxlags=maxlags)
@@ -0,0 +1,132 @@
+"""
+稳健性检验的窗口网格。data/robost 下每个文件夹保存一组(向后窗口, 向前窗口) 生成的targets 和features，
+窗口长度从文件夹中的元数据读取（见feature_registry.windows_from_dir）。
+对每个文件夹用parallel_ols.fit_all 并行拟合所有OLSFeatures 设定，
+再将所有文件夹的系数合并为一个
+以(backward, forward, spec, cap_group, rev_group, term) 为index 的表。
+"""
+import os
+import pandas as pd
+import click
+from src.features.feature_registry import windows_from_dir
+from src.models import parallel_ols
+from src.models.grouped_ols import OLSFeatures
+
+# 结果表中每个系数保存的统计量，nobs 和rsquared 为该组回归的值
+COLUMNS = ['params', 'bse', 'tvalues', 'pvalues', 'nobs', 'rsquared']
+
+
+def discover_window_dirs(root: str = 'data/robost/'):
+    """
+    找出root 下所有含有targets.pickle 的文件夹，并读取各自的窗口长度
+
+    Parameters:
+    -----------
+    root:
+        str, default 'data/robost/'
+
+    Return:
+    -------
+        list of tuple
+        按(backward, forward) 排序的(backward, forward, 文件夹路径)
+    """
+    found = {}
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if not os.path.isfile(os.path.join(path, 'targets.pickle')):
+            continue
+        windows = windows_from_dir(path)
+        key = (windows['backward_window'], windows['forward_window'])
+        if key in found:
+            raise ValueError(
+                'Directories {} and {} have the same windows {}.'.format(
+                    found[key], path, key))
+        found[key] = path
+    return [key + (found[key], ) for key in sorted(found)]
+
+
+def coefficient_frame(results: pd.Series):
+    """
+    将fit_all 的结果展开为每个系数一行的表
+
+    Parameters:
+    -----------
+    results:
+        pd.Series
+        parallel_ols.fit_all 的结果，每一项为GroupOLSResult
+
+    Return:
+    -------
+        pd.DataFrame
+        index 为results 的index 加上系数名term，列为COLUMNS
+    """
+    frames = [
+        pd.DataFrame({
+            'params': result.params,
+            'bse': result.bse,
+            'tvalues': result.tvalues,
+            'pvalues': result.pvalues,
+            'nobs': result.nobs,
+            'rsquared': result.rsquared
+        }) for result in results
+    ]
+    frame = pd.concat(frames, keys=list(results.index))
+    frame.index.names = list(results.index.names) + ['term']
+    return frame[COLUMNS]
+
+
+def run_grid(root: str = 'data/robost/',
+             specs=None,
+             workers: int = None,
+             **ols_kwargs):
+    """
+    拟合root 下所有窗口文件夹中的所有设定。文件夹依次处理，每个文件夹内的设定由fit_all 并行拟合，
+    同一时间只有一个文件夹的features 在内存中
+
+    Parameters:
+    -----------
+    root:
+        str, default 'data/robost/'
+    specs:
+        list of OLSFeatures, default None
+        为None 时拟合OLSFeatures 中的所有设定
+    workers:
+        int, default None
+        见parallel_ols.fit_all
+    **ols_kwargs:
+        传给GroupedOLS.ols_in_group 的参数。HAC 的滞后阶数默认为各文件夹的持有期长度
+
+    Return:
+    -------
+        pd.DataFrame
+        以(backward, forward, spec, cap_group, rev_group, term) 为index，列为COLUMNS
+    """
+    window_dirs = discover_window_dirs(root)
+    if not window_dirs:
+        raise FileNotFoundError(
+            'No window directory with targets.pickle under {}.'.format(root))
+    specs = list(OLSFeatures) if specs is None else list(specs)
+
+    frames = []
+    for backward, forward, path in window_dirs:
+        results = parallel_ols.fit_all(specs,
+                                       processed_dir=path + '/',
+                                       workers=workers,
+                                       **ols_kwargs)
+        frames.append(coefficient_frame(results))
+    cube = pd.concat(frames, keys=[window[:2] for window in window_dirs])
+    cube.index.names = ['backward', 'forward'] + list(frames[0].index.names)
+    return cube
+
+
+@click.command()
+@click.option('--workers', type=int, default=None, help='Worker processes.')
+@click.argument('root', type=click.Path(exists=True, file_okay=False))
+@click.argument('output_file', type=click.Path(writable=True))
+def main(workers, root, output_file):
+    cube = run_grid(root, workers=workers, backend='batched')
+    cube.to_pickle(output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+滚动窗口和扩展窗口的分组OLS。每组按日期顺序递推地更新X'X、X'y 和y'y：新的一行加入，
+滚动窗口中离开窗口的一行减去（以累计和之差的形式一次算出所有窗口），不再对每个窗口重新拟合。
+标准误默认为普通OLS 的标准误；指定maxlags 时对每个滚动窗口计算HAC 标准误。
+结果为以日期为index、(组别, 系数名) 为列的系数面板。
+"""
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import as_strided
+from scipy import stats
+from src.models import batched_ols as bols
+from src.models import hac
+
+# 计算滚动HAC 时每次批量处理的窗口数，限制内存的占用
+_HAC_CHUNK = 256
+
+
+def _window_sums(values: np.ndarray, window: int = None):
+    """
+    沿第一维递推求和：扩展窗口为累计和，滚动窗口在累计和中减去离开窗口的部分
+
+    Parameters:
+    -----------
+    values:
+        np.ndarray, (T, ...)
+    window:
+        int, default None
+        滚动窗口的长度，为None 时为扩展窗口
+
+    Return:
+    -------
+        np.ndarray，与values 形状相同
+    """
+    sums = np.cumsum(values, axis=0)
+    if window is not None and window < len(values):
+        sums[window:] = sums[window:] - sums[:-window]
+    return sums
+
+
+def _sliding(values: np.ndarray, window: int):
+    """values 沿第一维长度为window 的所有窗口，(T - window + 1, window, ...) 的只读view"""
+    n_windows = len(values) - window + 1
+    return as_strided(values,
+                      shape=(n_windows, window) + values.shape[1:],
+                      strides=(values.strides[0], ) + values.strides,
+                      writeable=False)
+
+
+def _rolling_hac(X: np.ndarray, y: np.ndarray, valid: np.ndarray,
+                 params: np.ndarray, inv: np.ndarray, ends: np.ndarray,
+                 window: int, maxlags: int, kernel: str):
+    """
+    计算以ends 中各行为结尾的滚动窗口的HAC 协方差矩阵。
+    X 和y 中缺失的行已经置为0，这些行的残差也记为0，对HAC 的各项没有贡献
+    """
+    windows_X = _sliding(X, window)
+    windows_y = _sliding(y, window)
+    windows_valid = _sliding(valid, window)
+    cov = np.empty((len(ends), ) + inv.shape[1:])
+    for start in range(0, len(ends), _HAC_CHUNK):
+        chunk = ends[start:start + _HAC_CHUNK]
+        chunk_X = windows_X[chunk - window + 1]
+        chunk_y = windows_y[chunk - window + 1]
+        resid = np.where(
+            windows_valid[chunk - window + 1],
+            chunk_y - np.einsum('twk,tk->tw', chunk_X, params[chunk]), 0.0)
+        # pinv @ pinv.T 为(X'X)^-1，即hac_covariance 所需的bread
+        pinv = inv[chunk] @ chunk_X.transpose(0, 2, 1)
+        cov[start:start + len(chunk)] = hac.hac_covariance(chunk_X,
+                                                            resid,
+                                                            pinv,
+                                                            maxlags,
+                                                            kernel=kernel)
+    return cov
+
+
+def recursive_ols(endog: np.ndarray,
+                  exog: np.ndarray,
+                  window: int = None,
+                  min_nobs: int = None,
+                  maxlags: int = None,
+                  kernel: str = 'bartlett'):
+    """
+    对一组按日期排列的观测进行滚动或扩展窗口的OLS。含NaN 的行不参与回归，
+    但仍占据滚动窗口中的一个位置（与statsmodels 的RollingOLS(missing='drop') 相同）
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray, (T, )
+    exog:
+        np.ndarray, (T, k)，已经包含常数项
+    window:
+        int, default None
+        滚动窗口的行数。为None 时使用扩展窗口
+    min_nobs:
+        int, default None
+        窗口中至少需要的有效观测数，为None 时为k + 1。不足时结果为NaN
+    maxlags:
+        int, default None
+        为None 时使用普通OLS 的协方差矩阵，否则为HAC 的滞后阶数，只能用于滚动窗口
+    kernel:
+        str, default 'bartlett'
+        HAC 的核函数，见hac.KERNELS
+
+    Return:
+    -------
+    tuple:
+        (params, cov_params, nobs)，分别为(T, k)、(T, k, k) 和(T, ) 的ndarray
+    """
+    if maxlags is not None and window is None:
+        raise ValueError('HAC standard errors need a rolling window.')
+    n_rows, n_cols = exog.shape
+    if min_nobs is None:
+        min_nobs = n_cols + 1
+
+    valid = np.isfinite(endog) & np.isfinite(exog).all(axis=1)
+    X = np.where(valid[:, None], exog, 0.0)
+    y = np.where(valid, endog, 0.0)
+    # 与spec_sweep 相同，各列的量级相差很大（如amivest 与常数项）时X'X 的条件数是X 的平方，
+    # pinv 会舍去真实的方向。先将每列除以其均方根，求解后再换算回原来的量级
+    col_scale = np.sqrt((X**2).sum(axis=0) / max(valid.sum(), 1))
+    col_scale[~(np.isfinite(col_scale) & (col_scale > 0))] = 1.0
+    X = X / col_scale
+
+    xx = _window_sums(X[:, :, None] * X[:, None, :], window)
+    xy = _window_sums(X * y[:, None], window)
+    yy = _window_sums(y**2, window)
+    nobs = _window_sums(valid.astype(float), window)
+
+    fitted = nobs >= min_nobs
+    if window is not None:
+        fitted[:window - 1] = False
+    ends = np.flatnonzero(fitted)
+
+    params = np.full((n_rows, n_cols), np.nan)
+    cov_params = np.full((n_rows, n_cols, n_cols), np.nan)
+    if len(ends) == 0:
+        return params, cov_params, nobs
+
+    inv = np.linalg.pinv(xx[ends], rcond=bols._RCOND)
+    params[ends] = (inv @ xy[ends, :, None])[:, :, 0]
+    if maxlags is None:
+        beta = params[ends]
+        ssr = (yy[ends] - 2 * np.einsum('tk,tk->t', beta, xy[ends]) +
+               np.einsum('tk,tkl,tl->t', beta, xx[ends], beta))
+        scale = ssr / (nobs[ends] - n_cols)
+        cov_params[ends] = scale[:, None, None] * inv
+    else:
+        full_inv = np.empty((n_rows, n_cols, n_cols))
+        full_inv[ends] = inv
+        cov_params[ends] = _rolling_hac(X, y, valid, params, full_inv, ends,
+                                        window, maxlags, kernel)
+    params /= col_scale
+    cov_params /= np.outer(col_scale, col_scale)
+    return params, cov_params, nobs
+
+
+class RollingOLSResults(object):
+    """
+    分组的滚动（扩展）窗口OLS 的结果。params、bse、tvalues 和pvalues 都是以日期为index、
+    (组别..., 系数名) 为列的DataFrame，nobs 以组别为列
+    """
+    __slots__ = ('params', 'bse', 'nobs', 'window', 'robust')
+
+    def __init__(self, params, bse, nobs, window=None, robust=False):
+        self.params = params
+        self.bse = bse
+        self.nobs = nobs
+        self.window = window
+        self.robust = robust
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        tvalues = self.tvalues.to_numpy()
+        if self.robust:
+            # 与statsmodels 使用稳健协方差时相同，p 值基于正态分布
+            pvalues = 2 * stats.norm.sf(np.abs(tvalues))
+        else:
+            n_cols = self.params.columns.get_level_values(-1).nunique()
+            df_resid = self.nobs.reindex(columns=self.params.columns.droplevel(
+                -1)).to_numpy() - n_cols
+            pvalues = 2 * stats.t.sf(np.abs(tvalues), df_resid)
+        return pd.DataFrame(pvalues,
+                            index=self.params.index,
+                            columns=self.params.columns)
+
+    def coef(self, name: str, detail: str = 'params'):
+        """
+        返回一个系数在所有组的时间序列，以日期为index、组别为列
+
+        Parameters:
+        -----------
+        name:
+            str
+            系数名，如'const'
+        detail:
+            str, default 'params'
+            'params', 'bse', 'tvalues' 或'pvalues'
+        """
+        return getattr(self, detail).xs(name, axis=1, level=-1)
+
+
+def rolling_in_group(endog: np.ndarray,
+                     design: np.ndarray,
+                     names: list,
+                     target_index: pd.MultiIndex,
+                     group_rows: dict,
+                     groupby_col=['cap_group', 'rev_group'],
+                     date_level: str = 'Trddt',
+                     window: int = None,
+                     min_nobs: int = None,
+                     maxlags=None,
+                     kernel: str = 'bartlett'):
+    """
+    对每组分别进行滚动或扩展窗口的OLS，组合为一个系数面板
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, k) 的设计矩阵，不含常数项
+    names:
+        list of str
+        design 各列的名称
+    target_index:
+        pd.MultiIndex
+        targets 的index
+    group_rows:
+        dict
+        以组别为key，组内行位置为value，见design_matrix.group_positions
+    groupby_col:
+        str or list of str, default ['cap_group', 'rev_group']
+        分组依据的index level 名
+    date_level:
+        str, default 'Trddt'
+        target_index 中日期的level 名
+    window, min_nobs, kernel:
+        见recursive_ols
+    maxlags:
+        int, list or None, default None
+        HAC 的滞后阶数，为list 时与group_rows 的顺序对应。为None 时使用普通OLS 的标准误
+
+    Return:
+    -------
+        RollingOLSResults
+    """
+    group_names = (list(groupby_col) if isinstance(groupby_col,
+                                                   (list, tuple)) else
+                   [groupby_col])
+    dates = target_index.get_level_values(date_level)
+    if maxlags is None or np.ndim(maxlags) == 0:
+        maxlags = [maxlags] * len(group_rows)
+
+    params, bse, nobs = {}, {}, {}
+    for (group, rows), group_lags in zip(group_rows.items(), maxlags):
+        # 组内按日期排序
+        rows = rows[np.argsort(dates[rows], kind='stable')]
+        group_design = design[rows]
+        has_const = bols._has_const(group_design)
+        exog = np.column_stack(
+            [np.full(len(rows), float(has_const)), group_design])
+        group_params, group_cov, group_nobs = recursive_ols(endog[rows],
+                                                            exog,
+                                                            window=window,
+                                                            min_nobs=min_nobs,
+                                                            maxlags=group_lags,
+                                                            kernel=kernel)
+        if not has_const:
+            # 没有常数项的组，常数列全为0，不报告其系数
+            group_params[:, 0] = np.nan
+        group_dates = dates[rows]
+        columns = ['const'] + list(names)
+        params[group] = pd.DataFrame(group_params,
+                                     index=group_dates,
+                                     columns=columns)
+        bse[group] = pd.DataFrame(np.sqrt(
+            np.diagonal(group_cov, axis1=1, axis2=2)),
+                                  index=group_dates,
+                                  columns=columns)
+        nobs[group] = pd.Series(group_nobs, index=group_dates)
+
+    keys = list(group_rows)
+    params = pd.concat([params[key] for key in keys], axis=1, keys=keys)
+    bse = pd.concat([bse[key] for key in keys], axis=1, keys=keys)
+    nobs = pd.concat([nobs[key] for key in keys], axis=1, keys=keys)
+    params.columns.names = group_names + [None]
+    bse.columns.names = group_names + [None]
+    nobs.columns.names = group_names
+    for frame in (params, bse, nobs):
+        frame.index.name = date_level
+    return RollingOLSResults(params,
+                             bse,
+                             nobs,
+                             window=window,
+                             robust=any(lags is not None for lags in maxlags))
@@ -0,0 +1,341 @@
+"""
+设定扫描：对main、dummy、control 三类features 的候选集合，枚举所有符合main/dummy/control
+格式的设定并一次拟合。所有设定用到的features（包括交互项）组成一个超集设计矩阵，只组装一次；
+每组按各行的缺失模式（哪些列有值）分别计算一次X'X、X'y，
+每个设定的X'X、X'y 即为覆盖其所有列的缺失模式之和中对应的子矩阵，
+与statsmodels 的missing='drop' 删除的行完全相同。上百个设定的代价与一次较大的回归相当。
+"""
+from itertools import combinations
+import numpy as np
+import pandas as pd
+from src.features import process_data_api as proda
+from src.features.feature_registry import shared_resolver, windows_from_dir
+from src.models import batched_ols as bols
+from src.models import design_matrix as dm
+from src.models import hac
+from src.models.batched_ols import BatchedOLSResults
+from src.models.grouped_ols import OLSFeatures, combine_features, spec_parts
+
+
+def _subsets(pool: list, min_size: int, max_size: int = None):
+    """pool 中大小在min_size 到max_size 之间的所有子集，保持pool 中的顺序"""
+    max_size = len(pool) if max_size is None else min(max_size, len(pool))
+    return [
+        list(subset) for size in range(min_size, max_size + 1)
+        for subset in combinations(pool, size)
+    ]
+
+
+def enumerate_specs(main: list,
+                    dummy: list = (),
+                    control: list = (),
+                    max_main: int = None,
+                    max_dummy: int = None,
+                    max_control: int = None):
+    """
+    枚举三类features 候选集合的所有组合，返回OLSFeatures 格式的设定字符串
+
+    Parameters:
+    -----------
+    main:
+        list of str
+        main features 的候选，每个设定至少包含一个
+    dummy, control:
+        list of str, default ()
+        dummy 和control 的候选，每个设定可以不包含
+    max_main, max_dummy, max_control:
+        int, default None
+        每个设定中各类features 的最大个数，为None 时不限制
+
+    Return:
+        list of str, 如['delta_std_full', 'delta_std_full/ret_sign',
+        'delta_std_full//market_ret', ...]
+    """
+    specs = []
+    for main_set in _subsets(list(main), 1, max_main):
+        for dummy_set in _subsets(list(dummy), 0, max_dummy):
+            for control_set in _subsets(list(control), 0, max_control):
+                parts = ['&'.join(main_set), '&'.join(dummy_set)]
+                if control_set:
+                    parts.append('&'.join(control_set))
+                specs.append('/'.join(parts).rstrip('/'))
+    return specs
+
+
+class _Superset(object):
+    """
+    所有设定用到的features 组成的超集。同一个feature 或交互项在所有设定中是同一个对象，
+    按对象记录其在超集设计矩阵中的列位置
+    """
+    def __init__(self, resolver):
+        self._resolver = resolver
+        self.features = []
+        self._spans = {}
+        self._named = {}
+        self._interactions = {}
+        self._width = 0
+
+    def _add(self, feature):
+        if id(feature) not in self._spans:
+            width = len(dm.feature_columns(feature))
+            self._spans[id(feature)] = list(
+                range(self._width, self._width + width))
+            self.features.append(feature)
+            self._width += width
+        return feature
+
+    def get(self, name: str):
+        if name not in self._named:
+            self._named[name] = self._add(self._resolver.get(name))
+        return self._named[name]
+
+    def interaction(self, fea, dum):
+        key = (id(fea), id(dum))
+        if key not in self._interactions:
+            self._interactions[key] = self._add(
+                proda.features_mul_dummy(features=fea, dummy=dum, lazy=True))
+        return self._interactions[key]
+
+    def spec_columns(self, spec):
+        """设定的features 按ols_in_group 中的顺序，在超集设计矩阵中的列位置和列名"""
+        main, dummy, control = spec_parts(spec)
+        features = combine_features([self.get(x) for x in main],
+                                    [self.get(x) for x in dummy],
+                                    [self.get(x) for x in control],
+                                    interaction=self.interaction)
+        cols = [col for fea in features for col in self._spans[id(fea)]]
+        names = [name for fea in features for name in dm.feature_columns(fea)]
+        return np.array(cols, dtype=int), names
+
+
+def pattern_moments(endog: np.ndarray, design: np.ndarray, group_rows: dict):
+    """
+    按组和缺失模式计算加入常数项后的X'X、X'y、y'y、y 的和与行数。targets 缺失的行不计入，
+    features 缺失的值记为0，只有覆盖设定所有列的缺失模式才计入该设定
+
+    Parameters:
+    -----------
+    endog:
+        np.ndarray
+        长度为n 的targets
+    design:
+        np.ndarray
+        (n, K) 的超集设计矩阵，不含常数项
+    group_rows:
+        dict
+        以组别为key，组内行位置为value
+
+    Return:
+    -------
+    tuple:
+        (available, xx, xy, yy, y_sum, counts)。available 为(P, K) 的bool 数组，
+        第p 个缺失模式中有值的列；xx 为(G, P, K + 1, K + 1)，xy 为(G, P, K + 1)，
+        yy、y_sum、counts 为(G, P)
+    """
+    n_groups, n_cols = len(group_rows), design.shape[1] + 1
+    group_codes = np.full(len(endog), -1)
+    for pos, rows in enumerate(group_rows.values()):
+        group_codes[rows] = pos
+    used = np.flatnonzero(np.isfinite(endog) & (group_codes >= 0))
+    finite = np.isfinite(design[used])
+    # 每行的缺失模式按位压缩为一个定长的bytes 后再去重，比按行去重bool 数组快得多
+    packed = np.ascontiguousarray(np.packbits(finite, axis=1))
+    _, first, pattern_codes = np.unique(packed.view(
+        np.dtype((np.void, packed.shape[1]))).ravel(),
+                                        return_index=True,
+                                        return_inverse=True)
+    available = finite[first]
+    pattern_codes = pattern_codes.ravel()
+    n_patterns = len(available)
+
+    # 按(组别, 缺失模式) 排序后，每一块的行连续，逐块计算矩阵乘积
+    codes = group_codes[used] * n_patterns + pattern_codes
+    order = np.argsort(codes, kind='stable')
+    rows, codes = used[order], codes[order]
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(rows)]])
+
+    xx = np.zeros((n_groups * n_patterns, n_cols, n_cols))
+    xy = np.zeros((n_groups * n_patterns, n_cols))
+    yy = np.zeros(n_groups * n_patterns)
+    y_sum = np.zeros(n_groups * n_patterns)
+    counts = np.zeros(n_groups * n_patterns)
+    for start, end in zip(starts, ends):
+        block = rows[start:end]
+        X = np.empty((len(block), n_cols))
+        X[:, 0] = 1.0
+        values = design[block]
+        X[:, 1:] = np.where(np.isfinite(values), values, 0.0)
+        y = endog[block]
+        code = codes[start]
+        xx[code] = X.T @ X
+        xy[code] = X.T @ y
+        yy[code] = y @ y
+        y_sum[code] = y.sum()
+        counts[code] = len(block)
+    return (available, xx.reshape(n_groups, n_patterns, n_cols, n_cols),
+            xy.reshape(n_groups, n_patterns, n_cols),
+            yy.reshape(n_groups, n_patterns),
+            y_sum.reshape(n_groups, n_patterns),
+            counts.reshape(n_groups, n_patterns))
+
+
+def constant_columns(design: np.ndarray, group_rows: dict):
+    """
+    每组中为非零常数的列，(G, K) 的bool 数组。
+    设定中有这样的列时，与sm.add_constant 相同，该组不再加入常数项
+    """
+    constant = np.zeros((len(group_rows), design.shape[1]), dtype=bool)
+    for pos, rows in enumerate(group_rows.values()):
+        group_design = design[rows]
+        with np.errstate(invalid='ignore'):
+            constant[pos] = (np.ptp(group_design, axis=0) == 0) & np.any(
+                group_design != 0, axis=0)
+    return constant
+
+
+def solve_spec(moments: tuple, constant: np.ndarray, cols: np.ndarray):
+    """
+    由pattern_moments 的结果求解一个设定在所有组的OLS，协方差为普通OLS 的协方差
+
+    Parameters:
+    -----------
+    moments:
+        tuple
+        pattern_moments 的返回值
+    constant:
+        np.ndarray
+        constant_columns 的返回值
+    cols:
+        np.ndarray
+        设定的各列在超集设计矩阵中的列位置
+
+    Return:
+    -------
+    tuple:
+        (params, inv, cov_params, nobs, rsquared, has_const)。
+        params 为(G, k + 1)，
+        inv 为(X'X)^-1，与cov_params 都为(G, k + 1, k + 1)，其余的长度为G
+    """
+    available, xx, xy, yy, y_sum, counts = moments
+    covered = available[:, cols].all(axis=1).astype(float)
+    keep = np.concatenate([[0], cols + 1])
+
+    xtx = np.einsum('p,gpij->gij', covered, xx[:, :, keep][:, :, :, keep])
+    xty = np.einsum('p,gpi->gi', covered, xy[:, :, keep])
+    yty = yy @ covered
+    y_total = y_sum @ covered
+    nobs = (counts @ covered).astype(int)
+    has_const = ~constant[:, cols].any(axis=1)
+
+    # 没有常数项的组，常数列记为0，在对角线上补1 使X'X 可逆，其系数和协方差为0
+    xtx[~has_const, 0, :] = 0.0
+    xtx[~has_const, :, 0] = 0.0
+    xtx[~has_const, 0, 0] = 1.0
+    xty[~has_const, 0] = 0.0
+    try:
+        inv = np.linalg.inv(xtx)
+    except np.linalg.LinAlgError:
+        inv = np.linalg.pinv(xtx, rcond=bols._RCOND)
+    inv[~has_const, 0, 0] = 0.0
+    params = (inv @ xty[:, :, None])[:, :, 0]
+
+    ssr = (yty - 2 * np.einsum('gk,gk->g', params, xty) +
+           np.einsum('gk,gkl,gl->g', params, xtx, params))
+    df_resid = nobs - (len(cols) + has_const)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov_params = (ssr / df_resid)[:, None, None] * inv
+        rsquared = 1 - ssr / (yty - y_total**2 / nobs)
+    return params, inv, cov_params, nobs, rsquared, has_const
+
+
+def sweep(specs: list,
+          processed_dir: str = 'data/processed/',
+          groupby_col=['cap_group', 'rev_group'],
+          use_hac: bool = False,
+          maxlags: int = None,
+          hac_kernel: str = 'bartlett'):
+    """
+    一次拟合多个设定的分组OLS。所有设定的features 组成一个超集设计矩阵，只组装一次，
+    每个设定的X'X、X'y 由超集的X'X、X'y 中选取子矩阵得到
+
+    Parameters:
+    -----------
+    specs:
+        list of str or OLSFeatures
+        需要拟合的设定，如enumerate_specs 的返回值
+    processed_dir:
+        str, default 'data/processed/'
+        保存processed data 的文件夹
+    groupby_col:
+        str, list of str, default ['cap_group', 'rev_group']
+        分组依据的index level 名
+    use_hac:
+        bool, default False
+        是否计算HAC 标准误，为False 时只使用X'X、X'y，为普通OLS 的标准误。
+        为True 时每个设定需要由超集设计矩阵的列计算残差
+    maxlags:
+        int, default None
+        HAC 的滞后阶数，为None 时使用processed_dir 的持有期长度
+    hac_kernel:
+        str, default 'bartlett'
+        HAC 的核函数，见hac.KERNELS
+
+    Return:
+    -------
+    pd.Series
+        与parallel_ols.fit_all 相同，以(spec, cap_group, rev_group) 为index 的结果表，
+        每一项为GroupOLSResult。
+        p 值与其他批量的结果相同，基于正态分布
+    """
+    specs = [
+        spec.value if isinstance(spec, OLSFeatures) else spec for spec in specs
+    ]
+    resolver = shared_resolver(processed_dir=processed_dir)
+    targets = resolver.get('targets')
+    superset = _Superset(resolver)
+    spec_columns = [superset.spec_columns(spec) for spec in specs]
+
+    endog, design, _ = dm.assemble_design(
+        targets, superset.features, cache=dm.alignment_cache(processed_dir))
+    group_rows: dict = dm.group_positions(targets.index, groupby_col)
+    group_names = (list(groupby_col) if isinstance(groupby_col,
+                                                   (list, tuple)) else
+                   [groupby_col])
+    constant = constant_columns(design, group_rows)
+    # 各列的量级相差很大（如amivest 与收益率），X'X 的条件数是X 的平方，
+    # 先将每列除以其均方根再计算X'X，求解后再换算回原来的量级
+    with np.errstate(invalid='ignore'):
+        scale = np.sqrt(np.nanmean(design**2, axis=0))
+    scale[~(np.isfinite(scale) & (scale > 0))] = 1.0
+    design = design / scale
+    moments = pattern_moments(endog, design, group_rows)
+    if use_hac and maxlags is None:
+        maxlags = windows_from_dir(processed_dir)['forward_window']
+
+    results = []
+    for cols, names in spec_columns:
+        params, inv, cov_params, nobs, rsquared, has_const = solve_spec(
+            moments, constant, cols)
+        if use_hac:
+            y, X, _, _ = bols.stack_groups(endog, design[:, cols], group_rows)
+            resid = y - (X @ params[:, :, None])[:, :, 0]
+            cov_params = hac.hac_covariance(X,
+                                            resid,
+                                            inv @ X.transpose(0, 2, 1),
+                                            maxlags,
+                                            kernel=hac_kernel)
+        col_scale = np.concatenate([[1.0], scale[cols]])
+        params = params / col_scale
+        cov_params = cov_params / np.outer(col_scale, col_scale)
+        results.append(
+            BatchedOLSResults(group_rows.keys(),
+                              ['const'] + names,
+                              params,
+                              cov_params,
+                              nobs,
+                              rsquared,
+                              has_const,
+                              group_names=group_names).to_series())
+    return pd.concat(results, keys=specs, names=['spec'] + group_names)
@@ -3,6 +3,7 @@
 """
 # %%
 from src.models.grouped_ols import GroupedOLS, OLSFeatures
+from src.models.parallel_ols import fit_all
 from IPython.display import display, HTML, Markdown
 import warnings
 import sys
@@ -17,11 +18,13 @@ else:
     proc_data_in = 'data/processed/'
 
 # %%
-all_GroupedOLS_obj = dict.fromkeys([e.name for e in OLSFeatures])
-
-for fea_type in list(OLSFeatures):
-    obj = GroupedOLS(processed_dir=proc_data_in, ols_features=fea_type)
-    all_GroupedOLS_obj[fea_type.name] = obj
+# 所有设定的features 只读取一次，使用进程池并行拟合
+all_ols_results = fit_all(processed_dir=proc_data_in)
+all_GroupedOLS_obj = {
+    fea_type.name:
+    GroupedOLS.from_ols_results(all_ols_results.loc[fea_type.name])
+    for fea_type in OLSFeatures
+}
 
 
 # %%
@@ -0,0 +1,342 @@
+"""
+不依赖Jupyter 的OLS 结果报告，内容与view_result.py 相同，由SECTIONS 声明。
+需要的设定由parallel_ols.fit_all 并行拟合（或从保存的fit_all 结果中读取），
+系数、t 值和星号的表格渲染为一个静态的HTML 或Markdown 文件。
+每一节渲染后的内容按其输入的哈希缓存：本节设定用到的features 和targets 的内容、本节的声明、
+回归和渲染的代码以及参数都没有变化时直接读取缓存，只有需要重新渲染的节所用的设定才会被拟合。
+"""
+import html
+import os
+import sys
+import pandas as pd
+import click
+from src.data import artifact_cache as acache
+from src.features.feature_registry import shared_resolver
+from src.models import batched_ols
+from src.models import contrast
+from src.models import design_matrix
+from src.models import grouped_ols
+from src.models import hac
+from src.models import parallel_ols
+from src.models.grouped_ols import GroupedOLS, OLSFeatures
+
+FORMATS = ('html', 'md')
+
+# 渲染后各节的缓存文件夹
+CACHE_DIR = os.path.join(acache.CACHE_ROOT, 'report')
+
+
+def single(specs: list, column, param: bool = False):
+    """
+    报告中的一项：specs 中每个设定某一列系数的t 检验
+
+    Parameters:
+    -----------
+    specs:
+        list of str
+        OLSFeatures 的名称
+    column:
+        str or int
+        系数名，或其在回归结果中的位置
+    param:
+        bool, default False
+        是否同时列出系数
+    """
+    return {'kind': 'single', 'specs': list(specs), 'column': column,
+            'param': param}
+
+
+def multi(specs: list, cols: tuple):
+    """
+    报告中的一项：specs 中每个设定第cols[0] 到cols[1]（不含）个系数之和为0 的t 检验
+    """
+    return {'kind': 'multi', 'specs': list(specs), 'cols': list(cols)}
+
+
+# 报告的各节：(标题, 项目的list)，与view_result.py 中的内容相同
+SECTIONS = [
+    ('rm and rolling_std_log', [single(['market_ret'], 'const', param=True)]),
+    ('rolling_std_log', [single(['rolling_std_log'], 'rolling_std_log')]),
+    ('delta_std and with rm', [multi(['delta_std', 'delta_std_and_rm'],
+                                     (1, 6))]),
+    ('delta_std_full and with rm, amihud_back and amihud_for, turnover', [
+        single([
+            'delta_std_full', 'delta_std_full_rm', 'amihud_back', 'amihud_for',
+            'turnover'
+        ], 1)
+    ]),
+    ('std_with_sign, amihudBack_with_sign, turnover_with_sign', [
+        item for spec in
+        ['std_with_sign', 'amihudBack_with_sign', 'turnover_with_sign']
+        for item in [single([spec], 2), multi([spec], (2, 4))]
+    ]),
+    ('std_amihudBack', [single(['std_amihudBack'], 1),
+                        single(['std_amihudBack'], 2)]),
+    ('All in with Sign', [
+        item for spec in [
+            'std_amihudBack_sign', 'std_amihudBack_sign_rm',
+            'std_amihudBack_sign_3f'
+        ] for item in [
+            single([spec], 4),
+            multi([spec], (4, 6)),
+            single([spec], 2),
+            multi([spec], (2, 4))
+        ]
+    ]),
+]
+
+# 结果和渲染所依赖的代码，其改变时所有节的缓存失效
+_CODE = [grouped_ols, batched_ols, contrast, design_matrix, hac]
+
+
+def section_specs(items: list):
+    """一节中用到的设定名，按出现的顺序"""
+    specs = []
+    for item in items:
+        specs.extend(spec for spec in item['specs'] if spec not in specs)
+    return specs
+
+
+def _markdown_table(frame: pd.DataFrame):
+    """不依赖tabulate，将DataFrame 渲染为Markdown 表格"""
+    index_name = ' / '.join(str(name) for name in frame.index.names
+                            if name is not None)
+    header = [index_name] + [str(col) for col in frame.columns]
+    lines = [
+        '| ' + ' | '.join(header) + ' |',
+        '|' + '---|' * len(header)
+    ]
+    for label, row in frame.iterrows():
+        lines.append('| ' + ' | '.join([str(label)] +
+                                       [str(value)
+                                        for value in row]) + ' |')
+    return '\n'.join(lines)
+
+
+def _render_table(caption: str, frame: pd.DataFrame, fmt: str):
+    if fmt == 'html':
+        return '<p>{}</p>\n{}'.format(html.escape(caption), frame.to_html())
+    return '{}\n\n{}'.format(caption, _markdown_table(frame))
+
+
+def _heading(text: str, level: int, fmt: str):
+    if fmt == 'html':
+        return '<h{0}>{1}</h{0}>'.format(level, html.escape(text))
+    return '#' * level + ' ' + text
+
+
+def render_item(item: dict, objs: dict, fmt: str):
+    """
+    渲染报告中的一项
+
+    Parameters:
+    -----------
+    item:
+        dict
+        single 或multi 的结果
+    objs:
+        dict
+        以设定名为key、GroupedOLS 为value
+    fmt:
+        str
+        'html' 或'md'
+
+    Return:
+    -------
+        list of str，每一段内容
+    """
+    parts = []
+    for spec in item['specs']:
+        obj: GroupedOLS = objs[spec]
+        parts.append(_heading(spec, 3, fmt))
+        names = obj.look_up_ols_detail(detail='params_name')
+        if item['kind'] == 'single':
+            column = item['column']
+            col_name = column if isinstance(column, str) else names[column]
+            if item['param']:
+                parts.append(
+                    _render_table(
+                        "{}: param for '{}'".format(spec, col_name),
+                        obj.look_up_ols_detail(detail='param', column=column),
+                        fmt))
+            parts.append(
+                _render_table(
+                    "{}: t_value for '{}'".format(spec, col_name),
+                    obj.look_up_ols_detail(detail='t_test_star',
+                                           column=column), fmt))
+        else:
+            start, end = item['cols']
+            test_str = ' + '.join(names[start:end]) + ' = 0'
+            parts.append(
+                _render_table(
+                    '{}: {}'.format(spec, test_str),
+                    obj.look_up_ols_detail(detail='t_test_star',
+                                           t_test_str=test_str), fmt))
+    return parts
+
+
+def render_section(title: str, items: list, objs: dict, fmt: str):
+    """渲染一节，返回该节的文本"""
+    parts = [_heading(title, 2, fmt)]
+    for item in items:
+        parts.extend(render_item(item, objs, fmt))
+    return '\n\n'.join(parts)
+
+
+def _section_key(title, items, fmt, input_digests, ols_kwargs):
+    code = acache.code_digest(
+        _CODE + [render_item, render_section, _render_table, _markdown_table])
+    return acache.stage_key('report_section', code, {
+        'title': title,
+        'items': items,
+        'fmt': fmt,
+        'ols_kwargs': ols_kwargs
+    }, input_digests)
+
+
+def _spec_digests(processed_dir: str, specs: list):
+    """设定用到的features 和targets 的内容哈希"""
+    resolver = shared_resolver(processed_dir=processed_dir)
+    names = ['targets']
+    for spec in specs:
+        names.extend(
+            name
+            for name in parallel_ols.spec_feature_names(OLSFeatures[spec])
+            if name not in names)
+    return [resolver.digest(name) for name in names]
+
+
+def _wrap(body: str, fmt: str, title: str):
+    if fmt == 'md':
+        return '# {}\n\n{}\n'.format(title, body)
+    return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>{0}</title>\n</head>\n<body>\n<h1>{0}</h1>\n{1}\n'
+            '</body>\n</html>\n').format(html.escape(title), body)
+
+
+def build_report(processed_dir: str = 'data/processed/',
+                 fmt: str = 'html',
+                 sections: list = None,
+                 results: pd.Series = None,
+                 workers: int = None,
+                 cache_dir: str = CACHE_DIR,
+                 **ols_kwargs):
+    """
+    生成报告的文本，并返回重新渲染的节数
+
+    Parameters:
+    -----------
+    processed_dir:
+        str, default 'data/processed/'
+        保存processed data 的文件夹
+    fmt:
+        str, default 'html'
+        'html' 或'md'
+    sections:
+        list, default None
+        (标题, 项目的list) 的list，为None 时使用SECTIONS
+    results:
+        pd.Series, default None
+        已经拟合好的fit_all 结果。为None 时并行拟合需要重新渲染的节所用的设定
+    workers:
+        int, default None
+        见parallel_ols.fit_all
+    cache_dir:
+        str, default CACHE_DIR
+        各节渲染结果的缓存文件夹，为None 时不使用缓存
+    **ols_kwargs:
+        传给fit_all 的参数，如backend、hac_kernel
+
+    Return:
+    -------
+    tuple:
+        (text, n_rendered)
+    """
+    if fmt not in FORMATS:
+        raise ValueError('fmt must be one of {}, got {}.'.format(
+            FORMATS, fmt))
+    if sections is None:
+        sections = SECTIONS
+
+    # 以读取的结果生成报告时，输入为结果本身，否则为用到的features 和targets
+    results_digest = (None if results is None else acache.object_digest(
+        (list(results.index), results.to_list())))
+    texts, missing = {}, []
+    for pos, (title, items) in enumerate(sections):
+        if cache_dir is None:
+            missing.append((pos, None))
+            continue
+        digests = ([results_digest] if results is not None else
+                   _spec_digests(processed_dir, section_specs(items)))
+        cache_path = os.path.join(
+            cache_dir, '{}.{}'.format(
+                _section_key(title, items, fmt, digests, ols_kwargs), fmt))
+        if os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as cache_file:
+                texts[pos] = cache_file.read()
+        else:
+            missing.append((pos, cache_path))
+
+    if missing:
+        specs = section_specs(
+            [item for pos, _ in missing for item in sections[pos][1]])
+        if results is None:
+            # 只拟合需要重新渲染的节用到的设定
+            results = parallel_ols.fit_all(
+                [OLSFeatures[spec] for spec in specs],
+                processed_dir=processed_dir,
+                workers=workers,
+                **ols_kwargs)
+        objs = {
+            spec: GroupedOLS.from_ols_results(results.loc[spec])
+            for spec in specs
+        }
+        for pos, cache_path in missing:
+            title, items = sections[pos]
+            texts[pos] = render_section(title, items, objs, fmt)
+            if cache_path is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+                    cache_file.write(texts[pos])
+                os.replace(tmp_path, cache_path)
+
+    body = '\n\n'.join(texts[pos] for pos in range(len(sections)))
+    return _wrap(body, fmt, 'OLS results: {}'.format(processed_dir)), len(
+        missing)
+
+
+@click.command()
+@click.option('--fmt',
+              type=click.Choice(FORMATS),
+              default=None,
+              help='Output format, inferred from OUTPUT_FILE by default.')
+@click.option('--workers', type=int, default=None, help='Worker processes.')
+@click.option('--results',
+              type=click.Path(exists=True, dir_okay=False),
+              default=None,
+              help='Pickled fit_all results to use instead of fitting.')
+@click.option('--no-cache', is_flag=True, help='Re-render every section.')
+@click.argument('processed_dir', type=click.Path(exists=True,
+                                                 file_okay=False))
+@click.argument('output_file', type=click.Path(writable=True))
+def main(fmt, workers, results, no_cache, processed_dir, output_file):
+    if fmt is None:
+        fmt = 'md' if output_file.endswith('.md') else 'html'
+    if processed_dir[-1] != '/':
+        processed_dir = processed_dir + '/'
+    text, n_rendered = build_report(
+        processed_dir,
+        fmt=fmt,
+        results=None if results is None else pd.read_pickle(results),
+        workers=workers,
+        cache_dir=None if no_cache else CACHE_DIR,
+        backend='batched')
+    with open(output_file, 'w', encoding='utf-8') as output:
+        output.write(text)
+    print('Rendered {} of {} sections.'.format(n_rendered, len(SECTIONS)),
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,17 @@
+import os
 import pytest
+import shutil
 import pandas as pd
 import numpy as np
 from src.features import process_data_api as proda
+from src.features import feature_store as fstore
+from src.features import feature_registry as freg
+from src.features import process_features as prof
+from src.features import liquidity as liq
+from src.features import reverse_port_ret as rpt
+from src.features import stock_panel
 from src.data import preparing_data as preda
+from src.data import artifact_cache as acache
 
 targets: pd.Series = pd.read_pickle('data/processed/targets.pickle')
 
@@ -59,6 +68,160 @@ class Test_std_features(object):
         proda.get_delta_std_forward_interval()
 
 
+class Test_multi_window_stds(object):
+    @pytest.fixture()
+    def market_index(self):
+        rng = np.random.RandomState(0)
+        log_index = np.cumsum(rng.normal(0, 0.015, 500))
+        return pd.Series(3000 * np.exp(log_index),
+                         index=pd.bdate_range('2010-01-01', periods=500))
+
+    def test_level_std_same_as_rolling(self, market_index):
+        """累积和计算的各窗口标准差及其变动与pandas 滚动计算的结果一致"""
+        multi_std = proda.calculate_multi_window_stds(
+            windows=[20, 60], diff_horizons=[1, 5], market_index=market_index)
+        for window in [20, 60]:
+            rolling_std = market_index.rolling(window).std()
+            assert np.allclose(multi_std['std_w{}'.format(window)],
+                               rolling_std,
+                               equal_nan=True)
+            assert np.allclose(multi_std['std_log_w{}'.format(window)],
+                               np.log(rolling_std),
+                               equal_nan=True)
+            assert np.allclose(multi_std['delta_std_w{}_d5'.format(window)],
+                               rolling_std.diff(5),
+                               atol=1e-8,
+                               equal_nan=True)
+
+    def test_return_based_std(self, market_index):
+        """method='return' 时为对数收益率的滚动标准差"""
+        multi_std = proda.calculate_multi_window_stds(
+            windows=[20], diff_horizons=[1], method='return',
+            market_index=market_index)
+        realized = np.log(market_index).diff().rolling(20).std()
+        assert np.allclose(multi_std['rv_w20'], realized, equal_nan=True)
+        assert multi_std.index.equals(market_index.index)
+
+
+class Test_liquidity(object):
+    @pytest.fixture()
+    def panel(self):
+        """一个随机生成的小型股票面板，部分交易日缺失、部分收益为零"""
+        rng = np.random.default_rng(0)
+        dates = pd.bdate_range('2012-01-02', periods=80, name='Trddt')
+        index = pd.MultiIndex.from_product([range(1, 9), dates],
+                                           names=['Stkcd', 'Trddt'])
+        ret = rng.normal(0, 0.02, len(index))
+        ret[rng.random(len(index)) < 0.1] = 0.0
+        panel = pd.DataFrame(
+            {
+                'Dretwd': ret,
+                'Clsprc': rng.uniform(5, 50, len(index)),
+                'Dnshrtrd': rng.uniform(1e5, 1e7, len(index))
+            },
+            index=index)
+        market_ret = pd.Series(rng.normal(0, 0.01, len(dates)), index=dates)
+        return panel.drop(index[rng.random(len(index)) < 0.05]), market_ret
+
+    def test_same_as_rolling(self, panel):
+        """各项指标与直接在一只股票上按窗口计算的结果一致"""
+        panel, market_ret = panel
+        window = 20
+        measures = liq.stock_liquidity(panel, window, market_ret=market_ret)
+
+        stock = panel.xs(3, level='Stkcd').reindex(market_ret.index)
+        ret, volume = stock['Dretwd'], stock['Clsprc'] * stock['Dnshrtrd']
+        ret_exc = ret - market_ret
+        # 包括窗口已经移动多次之后的日期，检查滚动更新的和没有累积误差
+        for date in stock.dropna().index[window:]:
+            in_window = ret.index[ret.index.get_loc(date) - window +
+                                  1:ret.index.get_loc(date) + 1]
+            result = measures.loc[(3, date)]
+
+            pairs = pd.concat([ret, ret.shift()], axis=1).loc[in_window]
+            cov = pairs.dropna().cov().iloc[0, 1]
+            assert result['roll_spread'] == pytest.approx(
+                2 * np.sqrt(-cov) if cov < 0 else 0)
+
+            nonzero = ret.loc[in_window].dropna()
+            nonzero = nonzero[nonzero != 0]
+            assert result['amivest'] == pytest.approx(
+                volume[nonzero.index].sum() / nonzero.abs().sum())
+            assert result['zero_ret'] == pytest.approx(
+                (ret.loc[in_window].dropna() == 0).mean())
+
+            design = pd.DataFrame({
+                'y': ret_exc,
+                'const': 1.0,
+                'lag_ret': ret.shift(),
+                'signed_volume': np.sign(ret_exc.shift()) * volume.shift() *
+                1e-6
+            }).loc[in_window].dropna()
+            coef = np.linalg.lstsq(design.iloc[:, 1:], design['y'],
+                                   rcond=None)[0]
+            assert result['ps_gamma'] == pytest.approx(coef[2])
+
+    def test_weighted_average_columns(self):
+        """每列只使用自身有值的行加权平均"""
+        dframe = pd.DataFrame({
+            'group': ['a', 'a', 'b'],
+            'x': [1.0, np.nan, 3.0],
+            'y': [1.0, 3.0, 3.0],
+            'weight': [1.0, 3.0, 2.0]
+        })
+        result = rpt.weighted_average_by_group(dframe,
+                                               groupby_columns=['group'],
+                                               calcu_column=['x', 'y'],
+                                               weights_column='weight')
+        assert result.loc['a', 'x'] == 1.0
+        assert result.loc['a', 'y'] == 2.5
+        assert result.loc['b', 'x'] == 3.0
+
+
+class Test_stock_panel(object):
+    def test_columns_and_timing(self):
+        """持有期收益从排序后的下一天开始，排序期特征只使用当日及之前的数据"""
+        rng = np.random.default_rng(0)
+        dates = pd.bdate_range('2012-01-02', periods=30, name='Trddt')
+        index = pd.MultiIndex.from_product([range(1, 4), dates],
+                                           names=['Stkcd', 'Trddt'])
+        prepared = pd.DataFrame(
+            {
+                'Dretwd': rng.normal(0, 0.02, len(index)),
+                'Clsprc': rng.uniform(5, 50, len(index)),
+                'Dnshrtrd': rng.uniform(1e5, 1e7, len(index)),
+                'Dsmvosd': rng.uniform(1e5, 1e7, len(index))
+            },
+            index=index)
+        rf_series = pd.Series(0.0001, index=dates)
+        turnover_df = pd.DataFrame(
+            {'turnOver': rng.uniform(0, 0.05, len(index))}, index=index)
+        norm_ret = pd.Series(rng.normal(size=len(index)), index=index)
+        panel = stock_panel.build_stock_panel(6,
+                                              3,
+                                              prepared_data=prepared,
+                                              norm_ret=norm_ret,
+                                              rf_series=rf_series,
+                                              turnover_df=turnover_df)
+        assert list(panel.columns) == ['forward_ret'
+                                       ] + stock_panel.CHARACTERISTICS
+        assert 'exc_ret' not in prepared.columns
+
+        stock = prepared.xs(2, level='Stkcd')
+        date = dates[10]
+        # t + 1 期收盘时买入，持有期收益为t + 2 到t + 4 期的收益率
+        held = stock['Dretwd'].iloc[12:15] - 0.0001
+        result = panel.loc[(2, date)]
+        assert result['forward_ret'] == pytest.approx((held + 1).prod() - 1)
+        assert result['turnover'] == pytest.approx(
+            turnover_df.xs(2, level='Stkcd')['turnOver'].iloc[5:11].mean())
+        amihud = stock['Dretwd'].abs() / (stock['Clsprc'] * stock['Dnshrtrd'])
+        assert result['amihud'] == pytest.approx(amihud.iloc[5:11].mean())
+        assert result['size'] == pytest.approx(np.log(stock['Dsmvosd'][date]))
+        # 持有期超出样本的日期没有未来收益
+        assert panel.xs(2, level='Stkcd')['forward_ret'].iloc[-4:].isna().all()
+
+
 class Test_ret_sign(object):
     def test_ret_sign(self):
         ret_sign: pd.Series = proda.calculate_ret_sign(targets)
@@ -145,3 +308,266 @@ class Test_ret_sign(object):
             delta_std_features, ret_sign)
         assert std_multiplied.name == 'rolling_std_log_ret_sign'
         assert delta_std_multipied.columns[0] == 'delta_std_t_1_ret_sign'
+
+    def test_lazy_dummy_interaction(self):
+        std_features = proda.get_rolling_std_features()
+        delta_std_features = proda.get_delta_std_features()
+        ret_sign = proda.get_ret_sign()
+
+        std_lazy = proda.features_mul_dummy(std_features, ret_sign, lazy=True)
+        delta_std_lazy = proda.features_mul_dummy(delta_std_features,
+                                                  ret_sign,
+                                                  lazy=True)
+        assert isinstance(std_lazy, proda.DummyInteraction)
+        assert std_lazy.name == 'rolling_std_log_ret_sign'
+        assert delta_std_lazy.columns[0] == 'delta_std_t_1_ret_sign'
+        with pytest.raises(AttributeError):
+            delta_std_lazy.name
+
+        # realize 后与直接相乘的结果一致
+        assert std_lazy.realize().equals(
+            proda.features_mul_dummy(std_features, ret_sign))
+
+
+class Test_feature_store(object):
+    @pytest.fixture()
+    def store_dir(self, tmp_path):
+        """复制processed 的pickle 到临时文件夹中，并建立features 库"""
+        for file_key in fstore.PROCESSED_FILES:
+            pickle_path = 'data/processed/{}.pickle'.format(file_key)
+            if os.path.exists(pickle_path):
+                shutil.copy(pickle_path, str(tmp_path))
+        fstore.write_store(str(tmp_path))
+        return str(tmp_path) + '/'
+
+    def test_same_as_pickle(self, store_dir):
+        """从features 库读取的每种ProcessedType 与读取pickle 的结果相同"""
+        assert fstore.has_store(store_dir)
+        for ftype in list(proda.ProcessedType):
+            from_store = proda.get_processed(which=ftype, from_dir=store_dir)
+            from_pickle = proda.get_processed(which=ftype,
+                                              from_dir='data/processed/')
+            assert type(from_store) == type(from_pickle)
+            assert from_store.index.equals(from_pickle.index)
+            assert from_store.equals(from_pickle)
+
+    def test_read_single_column(self, store_dir):
+        """只读取一列时返回该列"""
+        std_log = fstore.read_columns(store_dir,
+                                      'std_features',
+                                      columns=['rolling_std_log'])
+        assert list(std_log.columns) == ['rolling_std_log']
+        assert std_log['rolling_std_log'].equals(
+            proda.get_rolling_std_features())
+
+    def test_no_copy(self, store_dir):
+        """读取多列时各列仍然引用memory map 的数组，没有被复制"""
+        std_features = fstore.read_columns(store_dir, 'std_features')
+        assert std_features.shape[1] > 1
+        for col in std_features.columns:
+            values = std_features[col].to_numpy()
+            while not isinstance(values, np.memmap) and values is not None:
+                values = values.base
+            assert isinstance(values, np.memmap)
+
+    def test_stale(self, store_dir, monkeypatch):
+        """按内容判断库是否过期：只被touch 过的pickle 不过期，内容改变后读取pickle"""
+        # 大小和修改时间未变时只比较meta，不计算哈希
+        hashed = []
+        file_digest = acache.file_digest
+
+        def counted_digest(path, *args, **kwargs):
+            hashed.append(path)
+            return file_digest(path, *args, **kwargs)
+
+        monkeypatch.setattr(acache, 'file_digest', counted_digest)
+        assert not fstore.is_stale(store_dir, 'std_features')
+        proda.get_processed(proda.ProcessedType.rolling_std_log,
+                            from_dir=store_dir)
+        assert hashed == []
+
+        os.utime(store_dir + 'std_features.pickle')
+        assert not fstore.is_stale(store_dir, 'std_features')
+        assert len(hashed) == 1
+        assert os.listdir(
+            os.path.join(store_dir, fstore.CACHE_DIR, 'digests'))
+        std_features = pd.read_pickle(store_dir + 'std_features.pickle')
+        (std_features * 2).to_pickle(store_dir + 'std_features.pickle')
+        assert fstore.is_stale(store_dir, 'std_features')
+        assert proda.get_processed(
+            proda.ProcessedType.rolling_std_log, from_dir=store_dir).equals(
+                std_features['rolling_std_log'] * 2)
+
+    def test_valid_bitmask(self, store_dir):
+        """库中保存的有效位图与各ProcessedType 的值中是否有NaN 一致"""
+        for ftype in list(proda.ProcessedType):
+            value = proda.get_processed(which=ftype, from_dir=store_dir)
+            np.testing.assert_array_equal(
+                proda.get_processed_valid(ftype, from_dir=store_dir),
+                np.isfinite(value.to_numpy(dtype=float)).reshape(
+                    len(value), -1).all(axis=1))
+
+
+class Test_feature_registry(object):
+    def test_same_as_processed(self):
+        """从processed 文件夹中已有的数据求解时，与get_processed 的结果一致"""
+        resolver = freg.FeatureResolver(processed_dir='data/processed/')
+        for name in ['rolling_std_log', 'delta_std', 'ret_sign']:
+            assert resolver.get(name).equals(
+                proda.get_processed(proda.ProcessedType[name],
+                                    from_dir='data/processed/'))
+            assert resolver.is_cached(name)
+
+    def test_compute_missing(self, tmp_path):
+        """文件夹中缺少的feature 按依赖计算，并缓存到磁盘"""
+        shutil.copy('data/processed/targets.pickle', str(tmp_path))
+        resolver = freg.FeatureResolver(processed_dir=str(tmp_path))
+        ret_sign = resolver.get('ret_sign')
+        assert ret_sign.equals(proda.calculate_ret_sign(targets))
+        assert not resolver.is_cached('rolling_std_log')
+        assert len(os.listdir(str(tmp_path / freg.CACHE_DIR))) > 0
+
+    def test_cache_key(self, tmp_path):
+        """磁盘缓存的key 随参数和输入改变，相同的参数和输入得到相同的key"""
+        shutil.copy('data/processed/targets.pickle', str(tmp_path))
+        digest = freg.FeatureResolver(str(tmp_path)).digest('ret_sign')
+        assert freg.FeatureResolver(str(tmp_path)).digest('ret_sign') == digest
+        assert freg.FeatureResolver(str(tmp_path), params={
+            'forward_window': 10
+        }).digest('ret_sign') != digest
+
+        targets.iloc[:-1].to_pickle(str(tmp_path / 'targets.pickle'))
+        assert freg.FeatureResolver(str(tmp_path)).digest('ret_sign') != digest
+
+    def test_processed_digest(self):
+        """processed 文件夹中已有的feature 按文件内容的哈希计算，不需要读取其值"""
+        resolver = freg.FeatureResolver(processed_dir='data/processed/')
+        digest = resolver.digest('rolling_std_log')
+        assert not resolver.is_cached('rolling_std_log')
+        assert resolver.digest('delta_std') != digest
+        other = freg.FeatureResolver(processed_dir='data/processed/')
+        assert other.digest('rolling_std_log') == digest
+
+    def test_store_digest(self, tmp_path, monkeypatch):
+        """已建库时，读取和计算processed 中feature 的哈希都使用库中记录的哈希，不读取pickle 计算"""
+        for file_key in ['targets', 'std_features']:
+            shutil.copy('data/processed/{}.pickle'.format(file_key),
+                        str(tmp_path))
+        fstore.write_store(str(tmp_path))
+        expected = freg.FeatureResolver(
+            processed_dir='data/processed/').digest('rolling_std_log')
+        hashed = []
+        monkeypatch.setattr(acache, 'file_digest',
+                            lambda path, *args, **kwargs: hashed.append(path))
+        resolver = freg.FeatureResolver(processed_dir=str(tmp_path) + '/')
+        resolver.get('rolling_std_log')
+        assert resolver.digest('rolling_std_log') == expected
+        assert hashed == []
+
+    def test_windows_from_dir(self, tmp_path):
+        """窗口长度优先从元数据读取，其次从文件夹名解析，窗口可以是多位数"""
+        assert freg.windows_from_dir('data/robost/b40_f10/') == {
+            'backward_window': 40,
+            'forward_window': 10
+        }
+        assert freg.windows_from_dir(str(tmp_path)) == freg.DEFAULT_PARAMS
+        window_dir = tmp_path / 'b60_f5'
+        window_dir.mkdir()
+        prof.write_windows(str(window_dir), 120, 20)
+        assert freg.windows_from_dir(str(window_dir)) == {
+            'backward_window': 120,
+            'forward_window': 20
+        }
+
+    def test_valid(self):
+        """有效位图与feature 的值中是否有NaN 一致，同一feature 只计算一次"""
+        resolver = freg.FeatureResolver(processed_dir='data/processed/')
+        for name in ['market_ret', 'rolling_std_log', 'ret_sign']:
+            value = resolver.get(name)
+            valid = resolver.valid(name)
+            np.testing.assert_array_equal(
+                valid,
+                np.isfinite(value.to_numpy(dtype=float)).reshape(
+                    len(value), -1).all(axis=1))
+            assert resolver.valid(name) is valid
+
+    def test_circular_dependency(self):
+        registry = freg.FeatureRegistry()
+        registry.register('a', inputs=['b'])(lambda b: b)
+        registry.register('b', inputs=['a'])(lambda a: a)
+        with pytest.raises(ValueError):
+            registry.dependencies('a')
+
+
+class Test_artifact_cache(object):
+    def test_run(self, tmp_path):
+        """key 不变时跳过，输入内容改变时重新运行，改回后从缓存中取出"""
+        cache = acache.ArtifactCache(str(tmp_path / 'cache'))
+        input_file, output_file = tmp_path / 'in.txt', tmp_path / 'out.txt'
+        input_file.write_text('a')
+        command = [
+            'python3', '-c',
+            'import shutil, sys; shutil.copy(sys.argv[1], sys.argv[2])',
+            str(input_file),
+            str(output_file)
+        ]
+
+        def run():
+            return cache.run('copy', command, [str(input_file)],
+                             [str(output_file)], code=[])
+
+        assert run() == 'built'
+        os.utime(str(input_file))
+        assert run() == 'skipped'
+        input_file.write_text('b')
+        assert run() == 'built'
+        assert output_file.read_text() == 'b'
+        input_file.write_text('a')
+        assert run() == 'restored'
+        assert output_file.read_text() == 'a'
+
+        # 取出的输出与缓存不共用文件，改写输出不会影响缓存
+        output_file.write_text('c')
+        input_file.write_text('b')
+        assert run() == 'restored'
+        assert output_file.read_text() == 'b'
+
+    def test_code_closure(self):
+        """阶段的代码包括入口导入的所有src 中的模块"""
+        closure = acache.code_closure(['src/models/ols_model.py'])
+        assert closure[0] == 'src/models/ols_model.py'
+        for path in [
+                'src/features/feature_registry.py',
+                'src/features/feature_store.py', 'src/models/contrast.py',
+                'src/models/pooled_ols.py', 'src/models/rolling_ols.py',
+                'src/models/bootstrap_ols.py'
+        ]:
+            assert path in closure
+        assert len(closure) == len(set(closure))
+
+    def test_directory_output(self, tmp_path):
+        """输出可以是文件夹，取出时使用当前的修改时间"""
+        cache = acache.ArtifactCache(str(tmp_path / 'cache'))
+        input_file, output_dir = tmp_path / 'in.txt', tmp_path / 'out'
+        command = [
+            'python3', '-c',
+            'import os, shutil, sys; os.makedirs(sys.argv[2]);'
+            'shutil.copy(sys.argv[1], os.path.join(sys.argv[2], "a.txt"))',
+            str(input_file),
+            str(output_dir)
+        ]
+
+        def run():
+            return cache.run('copy_dir', command, [str(input_file)],
+                             [str(output_dir)], code=[])
+
+        input_file.write_text('a')
+        assert run() == 'built'
+        assert run() == 'skipped'
+        input_file.write_text('b')
+        assert run() == 'built'
+        input_file.write_text('a')
+        before = os.path.getmtime(str(input_file))
+        assert run() == 'restored'
+        assert (output_dir / 'a.txt').read_text() == 'a'
+        assert os.path.getmtime(str(output_dir / 'a.txt')) >= before
@@ -1,9 +1,27 @@
+import os
+import shutil
 import pytest
+import numpy as np
 import pandas as pd
 from src.features import process_data_api as proda
 from src.features.process_data_api import ProcessedType
+from src.features.process_features import write_windows
+from src.models import bootstrap_ols
+from src.models import coef_store
+from src.models import contrast
+from src.models import design_matrix as dm
+from src.models import fama_macbeth as fm
+from src.models import hac
 from src.models import ols_model as olm
-from src.models.grouped_ols import OLSFeatures, GroupedOLS
+from src.models import parallel_ols
+from src.models import pooled_ols
+from src.models import robust_grid
+from src.models import rolling_ols
+from src.models import spec_sweep
+from src.visualization import report
+from src.models.batched_ols import BatchedOLSResults
+from src.models.grouped_ols import OLSFeatures, GroupedOLS, spec_parts
+from statsmodels import api as sm
 from statsmodels.regression.linear_model import RegressionResultsWrapper
 import re
 
@@ -51,6 +69,20 @@ class Test_ols_process(object):
                                          features=features)
         assert result_quick[0].params.equals(result_origin[0].params)
 
+    def test_batched_backend(self, target_for_test):
+        """backend='batched' 时的系数和HAC 标准误与逐组使用statsmodels 的结果相同"""
+        features = olm.select_features(
+            features_type=OLSFeatures.delta_std_full_sign)
+        origin = olm.ols_in_group(target_for_test, features)
+        batched = olm.ols_in_group(target_for_test,
+                                   features,
+                                   backend='batched')
+        assert batched.index.equals(origin.index)
+        for result, batched_result in zip(origin, batched):
+            np.testing.assert_allclose(batched_result.params, result.params)
+            np.testing.assert_allclose(batched_result.bse, result.bse)
+            assert batched_result.nobs == result.nobs
+
 
 class Test_read_ols_result(object):
     def test_read_ols_result_success(self):
@@ -230,8 +262,30 @@ class Test_obj_select_fea(object):
 
         obj: GroupedOLS = GroupedOLS(processed_dir='data/processed/',
                                      ols_features=OLSFeatures.std_with_sign)
+        # 交互项为惰性的DummyInteraction，realize 后与直接相乘的结果相同
+        assert isinstance(obj.ols_features[2], proda.DummyInteraction)
+        obj_features = obj.ols_features[:2] + [obj.ols_features[2].realize()]
         for idx, fea in enumerate(features):
-            assert fea.eq(obj.ols_features[idx]).all()
+            assert fea.eq(obj_features[idx]).all()
+
+    def test_lazy_dummy_same_as_eager(self):
+        """测试惰性交互项与预先相乘的交互项拟合出相同的结果"""
+        lazy_obj: GroupedOLS = GroupedOLS(
+            processed_dir='data/processed/',
+            ols_features=OLSFeatures.delta_std_full_sign)
+        eager_features = [
+            fea.realize() if isinstance(fea, proda.DummyInteraction) else fea
+            for fea in lazy_obj.ols_features
+        ]
+        eager_obj = GroupedOLS(ols_features=eager_features,
+                               targets=lazy_obj.targets,
+                               forward_window=5)
+
+        lazy_result = lazy_obj.ols_in_group().ols_dframe.iloc[0, 0]
+        eager_result = eager_obj.ols_in_group().ols_dframe.iloc[0, 0]
+        assert lazy_result.params.index.equals(eager_result.params.index)
+        assert lazy_result.params.values == pytest.approx(
+            eager_result.params.values)
 
 
 class Test_obj_look_detail(object):
@@ -310,3 +364,885 @@ class Test_obj_look_detail(object):
     def test_both_column_and_testStr(self, gols_obj):
         with pytest.raises(ValueError):
             gols_obj.look_up_ols_detail('pvalue')
+
+
+class Test_batched_ols(object):
+    @pytest.fixture
+    def both_backends(self):
+        """分别使用两种backend 拟合同一个设定"""
+        return [
+            GroupedOLS(processed_dir='data/processed/',
+                       ols_features=OLSFeatures.std_amihudBack_sign_rm).
+            ols_in_group(backend=backend).ols_dframe
+            for backend in ('statsmodels', 'batched')
+        ]
+
+    def test_same_as_statsmodels(self, both_backends):
+        """批量求解的结果与逐组使用statsmodels 拟合的结果一致"""
+        sm_dframe, batched_dframe = both_backends
+        assert batched_dframe.shape == sm_dframe.shape
+        for sm_result, batched_result in zip(sm_dframe.values.ravel(),
+                                             batched_dframe.values.ravel()):
+            assert batched_result.params.index.equals(sm_result.params.index)
+            for attr in ['params', 'bse', 'tvalues', 'pvalues']:
+                assert getattr(batched_result, attr).values == pytest.approx(
+                    getattr(sm_result, attr).values, rel=1e-8)
+            assert batched_result.nobs == sm_result.nobs
+            assert batched_result.rsquared == pytest.approx(
+                sm_result.rsquared)
+            test_str = 'rolling_std_log + amihud_back = 0'
+            assert batched_result.t_test(
+                test_str).tvalue.item() == pytest.approx(
+                    sm_result.t_test(test_str).tvalue.item(), rel=1e-8)
+
+    def test_look_up_detail(self):
+        """look_up_ols_detail 对两种backend 的结果一致"""
+        sm_obj, batched_obj = [
+            GroupedOLS(processed_dir='data/processed/',
+                       ols_features=OLSFeatures.std_with_sign).ols_in_group(
+                           backend=backend)
+            for backend in ('statsmodels', 'batched')
+        ]
+        for detail in ['pvalue_star', 't_test_star']:
+            assert batched_obj.look_up_ols_detail(detail, column=1).equals(
+                sm_obj.look_up_ols_detail(detail, column=1))
+
+    def test_wrong_backend(self):
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.rolling_std_log)
+        with pytest.raises(ValueError):
+            obj.ols_in_group(backend='numpy')
+
+
+class Test_hac(object):
+    def test_bartlett_weights(self):
+        """Bartlett 核的权重与statsmodels 的weights_bartlett 相同"""
+        from statsmodels.stats.sandwich_covariance import weights_bartlett
+        assert hac.kernel_weights('bartlett', 5,
+                                  5) == pytest.approx(weights_bartlett(5))
+
+    @pytest.mark.parametrize('hac_kernel', ['parzen', 'qs'])
+    def test_kernel_same_as_statsmodels(self, hac_kernel):
+        """其他核下批量求解与逐组使用statsmodels 拟合的结果一致"""
+        sm_dframe, batched_dframe = [
+            GroupedOLS(processed_dir='data/processed/',
+                       ols_features=OLSFeatures.std_with_sign).ols_in_group(
+                           backend=backend, hac_kernel=hac_kernel).ols_dframe
+            for backend in ('statsmodels', 'batched')
+        ]
+        for sm_result, batched_result in zip(sm_dframe.values.ravel(),
+                                             batched_dframe.values.ravel()):
+            assert batched_result.bse.values == pytest.approx(
+                sm_result.bse.values, rel=1e-8)
+
+    def test_group_lags(self):
+        """每组可以使用不同的滞后阶数，未指定的组使用forward_window"""
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.std_with_sign)
+        default = obj.ols_in_group().ols_dframe
+        group = default.stack().index[0]
+        sm_dframe, batched_dframe = [
+            obj.ols_in_group(backend=backend, maxlags={
+                group: 10
+            }).ols_dframe for backend in ('statsmodels', 'batched')
+        ]
+        for sm_result, batched_result in zip(sm_dframe.values.ravel(),
+                                             batched_dframe.values.ravel()):
+            assert batched_result.bse.values == pytest.approx(
+                sm_result.bse.values, rel=1e-8)
+        assert sm_dframe.loc[group].bse.values != pytest.approx(
+            default.loc[group].bse.values)
+        other = default.stack().index[1]
+        assert sm_dframe.loc[other].bse.values == pytest.approx(
+            default.loc[other].bse.values)
+
+    def test_wrong_kernel(self):
+        with pytest.raises(ValueError):
+            hac.hac_cov_kwds(5, kernel='tukey')
+
+
+class Test_compact_results(object):
+    @pytest.fixture
+    def sm_results(self):
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.std_with_sign)
+        return obj.ols_in_group().ols_dframe.stack()
+
+    def test_save_and_load(self, sm_results, tmp_path):
+        """保存后读取的结果与statsmodels 的结果一致"""
+        path = str(tmp_path / 'ols_on_std_with_sign.npz')
+        BatchedOLSResults.from_results(sm_results).save(path)
+        loaded = BatchedOLSResults.load(path).to_series()
+        assert loaded.index.equals(sm_results.index)
+        assert loaded.index.names == sm_results.index.names
+        for sm_result, loaded_result in zip(sm_results, loaded):
+            assert loaded_result.params.equals(sm_result.params)
+            assert loaded_result.bse.values == pytest.approx(
+                sm_result.bse.values)
+            assert loaded_result.nobs == sm_result.nobs
+            assert loaded_result.rsquared == sm_result.rsquared
+
+    def test_to_statsmodels(self, sm_results):
+        """还原得到的statsmodels 结果与原来的结果一致"""
+        compact = BatchedOLSResults.from_results(sm_results).to_series()
+        test_str = 'const = 0'
+        for sm_result, compact_result in zip(sm_results, compact):
+            rehydrated = compact_result.to_statsmodels()
+            assert isinstance(rehydrated, RegressionResultsWrapper)
+            for attr in ['params', 'bse', 'pvalues', 'rsquared', 'nobs']:
+                expected = np.asarray(getattr(sm_result, attr))
+                assert np.asarray(getattr(
+                    rehydrated, attr)) == pytest.approx(expected)
+            assert rehydrated.t_test(test_str).tvalue.item() == pytest.approx(
+                sm_result.t_test(test_str).tvalue.item())
+
+
+class Test_shared_design(object):
+    @pytest.fixture
+    def full_targets(self):
+        """每组覆盖所有日期的targets，除第一组缺少一天外，各组删除缺失值后使用的日期相同"""
+        targets = proda.get_targets()
+        targets = targets.unstack(['cap_group', 'rev_group']).fillna(0).stack(
+            ['cap_group', 'rev_group'])
+        return targets.drop(targets.index[0])
+
+    def test_date_level_key(self):
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.delta_std_and_rm)
+        groupby_col = ['cap_group', 'rev_group']
+        assert dm.date_level_key(obj.ols_features, obj.targets.index,
+                                 groupby_col) == 'Trddt'
+        obj.select_features(OLSFeatures.std_with_sign)
+        assert dm.date_level_key(obj.ols_features, obj.targets.index,
+                                 groupby_col) is None
+
+    @pytest.mark.parametrize(
+        'ols_features', [OLSFeatures.market_ret, OLSFeatures.delta_std_and_rm])
+    def test_same_as_statsmodels(self, full_targets, ols_features):
+        """共用设计矩阵求解的结果与逐组使用statsmodels 拟合的结果一致"""
+        sm_dframe, batched_dframe = [
+            GroupedOLS(processed_dir='data/processed/',
+                       ols_features=ols_features,
+                       targets=full_targets).ols_in_group(
+                           backend=backend).ols_dframe
+            for backend in ('statsmodels', 'batched')
+        ]
+        for sm_result, batched_result in zip(sm_dframe.values.ravel(),
+                                             batched_dframe.values.ravel()):
+            assert batched_result.params.index.equals(sm_result.params.index)
+            for attr in ['params', 'bse', 'pvalues']:
+                assert getattr(batched_result, attr).values == pytest.approx(
+                    getattr(sm_result, attr).values, rel=1e-8)
+            assert batched_result.nobs == sm_result.nobs
+            assert batched_result.rsquared == pytest.approx(
+                sm_result.rsquared)
+
+
+class Test_alignment(object):
+    @pytest.fixture
+    def targets(self):
+        return proda.get_targets()
+
+    @pytest.mark.parametrize('which', [
+        ProcessedType.market_ret, ProcessedType.rolling_std_log,
+        ProcessedType.ret_sign
+    ])
+    def test_same_as_join(self, targets, which):
+        """整数编码对齐的结果与targets.join 的结果相同"""
+        fea = pd.DataFrame(proda.get_processed(which=which))
+        on = fea.index.name or list(fea.index.names)
+        joined = pd.DataFrame(targets).join(fea, how='left', on=on)
+        _, design, names = dm.assemble_design(targets, [fea])
+        assert names == list(fea.columns)
+        np.testing.assert_array_equal(design,
+                                      joined[names].to_numpy(dtype=float))
+
+    def test_broadcast_level(self, targets):
+        """交互项中的dummy 按broadcast_level 对齐，与直接相乘的结果相同"""
+        ret_sign = proda.get_processed(which=ProcessedType.ret_sign)
+        std_log = proda.get_processed(which=ProcessedType.rolling_std_log)
+        # 以日期为index 但index 名不同的dummy
+        high_std = std_log.gt(std_log.median()).astype(float).rename_axis(
+            'date')
+        eager = proda.features_mul_dummy(ret_sign,
+                                         high_std,
+                                         broadcast_level='Trddt')
+        lazy = proda.features_mul_dummy(ret_sign,
+                                        high_std,
+                                        broadcast_level='Trddt',
+                                        lazy=True)
+        _, eager_design, _ = dm.assemble_design(targets, [eager])
+        _, lazy_design, _ = dm.assemble_design(targets, [lazy])
+        np.testing.assert_array_equal(lazy_design, eager_design)
+        np.testing.assert_array_equal(
+            dm.assemble_valid(targets, [lazy]),
+            dm.assemble_valid(targets, [eager]))
+
+    def test_cache(self, targets):
+        """同一processed 文件夹中相同的index 只对齐一次"""
+        cache = dm.alignment_cache('data/processed/')
+        assert cache is dm.alignment_cache('data/processed')
+        fea = proda.get_processed(which=ProcessedType.rolling_std_log)
+        positions = cache.positions(fea.index, targets.index)
+        assert cache.positions(fea.index.copy(deep=True),
+                               targets.index.copy(deep=True)) is positions
+        np.testing.assert_array_equal(
+            positions, dm.align_positions(fea.index, targets.index))
+
+    def test_ols_in_group(self, targets):
+        """ols_model.ols_in_group 使用缓存时结果不变"""
+        features = olm.select_features(OLSFeatures.delta_std_full_sign)
+        origin = olm.ols_in_group(targets, features)
+        cached = olm.ols_in_group(targets,
+                                  features,
+                                  processed_dir='data/processed/')
+        for result, cached_result in zip(origin, cached):
+            assert cached_result.params.equals(result.params)
+
+
+class Test_valid_rows(object):
+    def test_same_as_design(self):
+        """合并有效位图得到的行与组装后设计矩阵中没有NaN 的行相同"""
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.delta_std_full_sign_rm)
+        endog, design, _ = dm.assemble_design(obj.targets, obj.ols_features)
+        expected = np.isfinite(endog) & np.isfinite(design).all(axis=1)
+        np.testing.assert_array_equal(
+            dm.assemble_valid(obj.targets, obj.ols_features), expected)
+
+    @pytest.mark.parametrize('backend', ['statsmodels', 'batched'])
+    def test_dropped_rows(self, backend):
+        """每组删除的行数与观测数之和为组内的行数"""
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.std_with_sign)
+        obj.ols_in_group(backend=backend)
+        sizes = obj.targets.groupby(level=['cap_group', 'rev_group']).size()
+        nobs = obj.ols_dframe.stack().map(lambda result: result.nobs)
+        dropped = obj.dropped_rows
+        assert dropped.index.names == ['cap_group', 'rev_group']
+        assert (dropped > 0).all()
+        assert (dropped + nobs.reindex(dropped.index)).equals(
+            sizes.reindex(dropped.index).astype(float))
+
+
+class Test_shared_resolver(object):
+    def test_shared_between_objects(self):
+        """同一processed 文件夹的GroupedOLS 共用读取过的features"""
+        objs = [
+            GroupedOLS(processed_dir='data/processed/',
+                       ols_features=OLSFeatures.std_with_sign)
+            for _ in range(2)
+        ]
+        for fea, other in zip(objs[0].ols_features, objs[1].ols_features):
+            if isinstance(fea, (pd.Series, pd.DataFrame)):
+                assert fea.index is other.index
+        assert objs[0].targets.index is objs[1].targets.index
+
+    def test_read_only(self):
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.rolling_std_log)
+        fea = obj.ols_features[0]
+        assert fea.equals(
+            proda.get_processed(which=ProcessedType.rolling_std_log))
+        with pytest.raises(ValueError):
+            fea.iloc[0] = 0
+
+
+class Test_rolling(object):
+    @pytest.fixture
+    def data(self):
+        rng = np.random.RandomState(0)
+        exog = np.column_stack([np.ones(200), rng.normal(size=(200, 2))])
+        endog = exog @ np.array([1.0, 2.0, 3.0]) + rng.normal(size=200)
+        endog[[10, 50, 51]] = np.nan
+        return endog, exog
+
+    @pytest.mark.parametrize('window', [40, None])
+    def test_same_as_statsmodels(self, data, window):
+        """递推的结果与statsmodels 的RollingOLS 相同"""
+        from statsmodels.regression.rolling import RollingOLS
+        endog, exog = data
+        params, cov_params, _ = rolling_ols.recursive_ols(endog,
+                                                          exog,
+                                                          window=window)
+        expected = RollingOLS(endog,
+                              exog,
+                              window=window or len(endog),
+                              expanding=window is None,
+                              missing='drop',
+                              min_nobs=4).fit()
+        np.testing.assert_allclose(params, expected.params, rtol=1e-8)
+        np.testing.assert_allclose(np.sqrt(
+            np.diagonal(cov_params, axis1=1, axis2=2)),
+                                   expected.bse,
+                                   rtol=1e-8)
+
+    def test_rolling_hac(self, data):
+        endog, exog = data
+        _, cov_params, _ = rolling_ols.recursive_ols(endog,
+                                                     exog,
+                                                     window=40,
+                                                     maxlags=5)
+        window = slice(100, 140)
+        expected = sm.OLS(endog[window], exog[window]).fit(
+            cov_type='HAC', cov_kwds={'maxlags': 5})
+        np.testing.assert_allclose(cov_params[139], expected.cov_params())
+        with pytest.raises(ValueError):
+            rolling_ols.recursive_ols(endog, exog, maxlags=5)
+
+    @pytest.mark.parametrize('maxlags', [None, 5])
+    def test_amivest_scale(self, maxlags):
+        """与amivest 量级相当的特征（约1e10）不会使常数项被pinv 舍去"""
+        rng = np.random.RandomState(0)
+        amivest = rng.lognormal(23, 1, size=300)
+        exog = np.column_stack([np.ones(300), amivest])
+        endog = 4e-3 - 3e-13 * amivest + rng.normal(scale=0.02, size=300)
+        params, cov_params, _ = rolling_ols.recursive_ols(endog,
+                                                          exog,
+                                                          window=120,
+                                                          maxlags=maxlags)
+        for end in (119, 200, 299):
+            window = slice(end - 119, end + 1)
+            expected = (sm.OLS(endog[window], exog[window]).fit()
+                        if maxlags is None else sm.OLS(
+                            endog[window], exog[window]).fit(
+                                cov_type='HAC', cov_kwds={'maxlags': 5}))
+            np.testing.assert_allclose(params[end], expected.params, rtol=1e-6)
+            np.testing.assert_allclose(np.sqrt(np.diag(cov_params[end])),
+                                       expected.bse,
+                                       rtol=1e-6)
+
+    def test_expanding_ends_at_full_sample(self):
+        """扩展窗口最后一期的系数与全样本回归的系数相同"""
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.delta_std_full_sign)
+        panel = obj.rolling_in_group().params
+        full = obj.ols_in_group(backend='batched').ols_dframe
+        for (cap, rev), result in full.stack().items():
+            group_params = panel[(cap, rev)].dropna(how='all').iloc[-1]
+            np.testing.assert_allclose(group_params[result.params.index],
+                                       result.params,
+                                       rtol=1e-6)
+
+
+class Test_bootstrap(object):
+    @pytest.fixture
+    def obj(self):
+        return GroupedOLS(processed_dir='data/processed/',
+                          ols_features=OLSFeatures.delta_std_full_sign)
+
+    @pytest.mark.parametrize('method', ['moving', 'stationary'])
+    def test_block_indices(self, method):
+        rng = np.random.default_rng(0)
+        indices = bootstrap_ols.block_indices(rng, 20, 100, 5, method=method)
+        assert indices.shape == (20, 100)
+        assert indices.min() >= 0 and indices.max() < 100
+        counts = bootstrap_ols.date_counts(indices, 100)
+        assert (counts.sum(axis=1) == 100).all()
+        if method == 'moving':
+            # 每个块内的日期连续
+            assert (np.diff(indices.reshape(20, 20, 5), axis=2) == 1).all()
+
+    def test_weighted_solve(self):
+        """以抽到次数为权重的解，与对重抽样后的行直接回归的结果相同"""
+        rng = np.random.default_rng(0)
+        design = rng.normal(size=(60, 2))
+        endog = design @ np.array([1.0, -1.0]) + rng.normal(size=60)
+        date_codes = np.arange(60)
+        xx, xy, has_const = bootstrap_ols.date_moments(
+            endog, design, date_codes, 60, {'a': np.arange(60)})
+        indices = bootstrap_ols.block_indices(rng, 3, 60, 4)
+        params = bootstrap_ols.solve_weighted(
+            bootstrap_ols.date_counts(indices, 60), xx, xy, has_const)
+        for rep, rows in enumerate(indices):
+            expected = sm.OLS(endog[rows], sm.add_constant(design[rows])).fit()
+            np.testing.assert_allclose(params[rep, 0], expected.params)
+
+    def test_point_estimates(self, obj):
+        """全样本的系数与分组OLS 的系数相同"""
+        results = obj.bootstrap(n_reps=10, seed=0, workers=1)
+        full = obj.ols_in_group(backend='batched').ols_dframe.stack()
+        params = results.params_frame()
+        for group, result in full.items():
+            np.testing.assert_allclose(params.loc[group, result.params.index],
+                                       result.params)
+        assert results.bse().shape == params.shape
+        assert results.conf_int().shape == (25, 2 * params.shape[1])
+
+    def test_reproducible(self, obj):
+        """相同的seed 得到相同的结果，与工作进程数无关"""
+        draws = [
+            obj.bootstrap(n_reps=600, seed=7, workers=workers).draws
+            for workers in (1, 1, 2)
+        ]
+        assert draws[0].shape[0] == 600
+        np.testing.assert_array_equal(draws[0], draws[1])
+        np.testing.assert_array_equal(draws[0], draws[2])
+
+
+class Test_fama_macbeth(object):
+    @pytest.fixture(scope='class')
+    def panel(self):
+        """
+        1000 只股票250 个日期的合成面板，行数超过一批，可以分配到多个进程。
+        amihud 和size 的量级与个股数据相当（约1e-10 和15）
+        """
+        rng = np.random.default_rng(0)
+        index = pd.MultiIndex.from_product(
+            [np.arange(1000),
+             pd.date_range('2010-01-01', periods=250)],
+            names=['Stkcd', 'Trddt'])
+        amihud = rng.lognormal(-23, 1, size=len(index))
+        size = rng.normal(15, 1, size=len(index))
+        endog = (0.01 + 3e7 * amihud - 2e-3 * size +
+                 rng.normal(scale=0.02, size=len(index)))
+        panel = pd.DataFrame({
+            'ret': endog,
+            'amihud': amihud,
+            'size': size
+        },
+                             index=index)
+        panel.iloc[::17, 1] = np.nan
+        return panel
+
+    @pytest.fixture(scope='class')
+    def results(self, panel):
+        return fm.fama_macbeth(panel,
+                               'ret', ['amihud', 'size'],
+                               maxlags=5,
+                               workers=1)
+
+    def test_cross_section(self, panel, results):
+        """每个日期的系数与statsmodels 对当日截面的回归相同"""
+        for date in panel.index.levels[1][[0, 100, 249]]:
+            section = panel.xs(date, level='Trddt').dropna()
+            expected = sm.OLS(section['ret'],
+                              sm.add_constant(section[['amihud',
+                                                       'size']])).fit()
+            np.testing.assert_allclose(results.gammas.loc[date],
+                                       expected.params,
+                                       rtol=1e-5)
+            # 对原始量级的amihud，statsmodels 本身也会损失几位精度，
+            # 将amihud 乘以1e10 后的回归系数作为精确的参照
+            exact = sm.OLS(section['ret'],
+                           sm.add_constant(section[['amihud', 'size']] *
+                                           [1e10, 1])).fit()
+            np.testing.assert_allclose(results.gammas.loc[date],
+                                       exact.params * [1, 1e10, 1])
+            assert results.rsquared[date] == pytest.approx(expected.rsquared)
+            assert results.nobs[date] == expected.nobs
+
+    def test_true_slopes(self, results):
+        assert results.params['amihud'] == pytest.approx(3e7, rel=0.05)
+        assert results.params['size'] == pytest.approx(-2e-3, rel=0.05)
+
+    def test_newey_west(self, results):
+        gammas = results.gammas.to_numpy()
+        for col, name in enumerate(results.gammas.columns):
+            expected = sm.OLS(gammas[:, col], np.ones(len(gammas))).fit(
+                cov_type='HAC', cov_kwds={'maxlags': 5})
+            assert results.params[name] == pytest.approx(expected.params[0])
+            assert results.bse[name] == pytest.approx(expected.bse[0])
+            assert results.pvalues[name] == pytest.approx(
+                expected.pvalues[0])
+        assert list(results.summary().index) == ['const', 'amihud', 'size']
+
+    def test_workers(self, panel, results):
+        parallel = fm.fama_macbeth(panel,
+                                   'ret', ['amihud', 'size'],
+                                   maxlags=5,
+                                   workers=2)
+        pd.testing.assert_frame_equal(parallel.gammas, results.gammas)
+        pd.testing.assert_series_equal(parallel.bse, results.bse)
+
+
+class Test_spec_sweep(object):
+    def test_enumerate_specs(self):
+        specs = spec_sweep.enumerate_specs(['a', 'b'], ['d'], ['c'])
+        assert len(specs) == 3 * 2 * 2
+        assert {'a', 'a/d', 'a//c', 'a&b/d/c'} <= set(specs)
+        assert spec_parts('a&b//c') == (['a', 'b'], [], ['c'])
+        assert spec_parts(OLSFeatures.delta_std_full_sign) == ([
+            'delta_std_full'
+        ], ['ret_sign'], [])
+
+    @pytest.mark.parametrize('spec', [
+        OLSFeatures.delta_std_full_sign_rm, OLSFeatures.std_amihudBack_sign_3f,
+        OLSFeatures.market_ret
+    ])
+    def test_same_as_batched(self, spec):
+        """使用HAC 时，每个设定的结果与单独拟合的分组OLS 相同"""
+        results = spec_sweep.sweep([
+            OLSFeatures.delta_std_full_sign_rm,
+            OLSFeatures.std_amihudBack_sign_3f, OLSFeatures.market_ret
+        ],
+                                   use_hac=True)
+        obj = GroupedOLS(processed_dir='data/processed/', ols_features=spec)
+        full = obj.ols_in_group(backend='batched').ols_dframe.stack()
+        for group, result in full.items():
+            swept = results.loc[(spec.value, ) + group]
+            pd.testing.assert_series_equal(swept.params,
+                                           result.params,
+                                           check_exact=False,
+                                           rtol=1e-7)
+            np.testing.assert_allclose(swept.bse, result.bse, rtol=1e-6)
+            assert swept.nobs == result.nobs
+
+    def test_nonrobust(self):
+        """不使用HAC 时与statsmodels 的普通OLS（missing='drop'）相同"""
+        spec = 'delta_std_full/ret_sign/market_ret'
+        results = spec_sweep.sweep(spec_sweep.enumerate_specs(
+            ['delta_std_full', 'rolling_std_log'], ['ret_sign'],
+            ['market_ret']),
+                                   use_hac=False)
+        assert results.index.get_level_values('spec').nunique() == 3 * 2 * 2
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.delta_std_full_sign_rm)
+        endog, design, names = dm.assemble_design(obj.targets,
+                                                  obj.ols_features)
+        rows = dm.group_positions(
+            obj.targets.index, ['cap_group', 'rev_group'])[('Small', 'Lo-Hi')]
+        expected = sm.OLS(endog[rows],
+                          sm.add_constant(
+                              pd.DataFrame(design[rows], columns=names)),
+                          missing='drop').fit()
+        swept = results.loc[(spec, 'Small', 'Lo-Hi')]
+        np.testing.assert_allclose(swept.params, expected.params)
+        np.testing.assert_allclose(swept.bse, expected.bse)
+        assert swept.rsquared == pytest.approx(expected.rsquared)
+
+
+class Test_pooled(object):
+    @pytest.fixture(scope='class')
+    def obj(self):
+        return GroupedOLS(processed_dir='data/processed/',
+                          ols_features=OLSFeatures.delta_std_full_sign_rm)
+
+    @pytest.fixture(scope='class')
+    def dense(self, obj):
+        """与pooled_ols 堆叠方式相同的稠密设计矩阵和每行的日期编码"""
+        endog, design, names = dm.assemble_design(obj.targets,
+                                                  obj.ols_features)
+        group_rows = dm.group_positions(obj.targets.index,
+                                        ['cap_group', 'rev_group'])
+        y, X, rows, keys = pooled_ols.pooled_design(endog, design, names,
+                                                    group_rows)
+        _, date_codes = np.unique(
+            obj.targets.index.get_level_values('Trddt'), return_inverse=True)
+        return (y, X.toarray(), date_codes.ravel()[rows],
+                pd.MultiIndex.from_tuples(keys))
+
+    def test_params_same_as_groups(self, obj):
+        results = obj.pooled_in_group()
+        full = obj.ols_in_group(backend='batched').ols_dframe.stack()
+        for group, result in full.items():
+            np.testing.assert_allclose(
+                results.params.loc[group].loc[result.params.index],
+                result.params,
+                rtol=1e-7,
+                atol=1e-12)
+
+    @pytest.mark.parametrize('cov_type', ['cluster', 'driscoll-kraay'])
+    def test_cov_same_as_statsmodels(self, obj, dense, cov_type):
+        y, X, dates, keys = dense
+        if cov_type == 'cluster':
+            expected = sm.OLS(y, X).fit(cov_type='cluster',
+                                        cov_kwds={'groups': dates})
+        else:
+            expected = sm.OLS(y, X).fit(cov_type='hac-groupsum',
+                                        cov_kwds={
+                                            'time': dates,
+                                            'maxlags': 5
+                                        })
+        results = obj.pooled_in_group(cov_type=cov_type)
+        np.testing.assert_allclose(results.bse.reindex(keys), expected.bse)
+
+    def test_equality_test(self, obj):
+        results = obj.pooled_in_group(common=['rm_exc_t_1'])
+        assert np.isfinite(results.params[(pooled_ols.COMMON,
+                                           pooled_ols.COMMON, 'rm_exc_t_1')])
+        assert ('Small', 'Lo-Hi', 'rm_exc_t_1') not in results.params.index
+        groups = [('Small', 'Lo-Hi'), ('Big', 'Lo-Hi')]
+        tested = results.equality_test('delta_std_full', groups=groups)
+        expected = results.wald_test({
+            ('Small', 'Lo-Hi', 'delta_std_full'): 1.0,
+            ('Big', 'Lo-Hi', 'delta_std_full'): -1.0
+        })
+        pd.testing.assert_series_equal(tested, expected)
+        # 一个自由度的Wald 检验即为差值t 检验的平方
+        diff = (results.params[groups[0] + ('delta_std_full', )] -
+                results.params[groups[1] + ('delta_std_full', )])
+        assert tested['statistic'] == pytest.approx(diff**2 / (
+            results.bse[groups[0] + ('delta_std_full', )]**2 +
+            results.bse[groups[1] + ('delta_std_full', )]**2 -
+            2 * results.cov_params.loc[groups[0] + ('delta_std_full', ),
+                                       groups[1] + ('delta_std_full', )]))
+        assert results.equality_test('delta_std_full')['df_num'] == 24
+
+
+class Test_fit_all(object):
+    def test_spec_feature_names(self):
+        assert parallel_ols.spec_feature_names(
+            OLSFeatures.std_amihudBack_sign_rm) == [
+                'rolling_std_log', 'amihud_back', 'ret_sign', 'market_ret'
+            ]
+
+    def test_same_as_grouped_ols(self):
+        """并行拟合的结果与逐个设定使用GroupedOLS 拟合的结果一致"""
+        specs = [OLSFeatures.market_ret, OLSFeatures.std_with_sign]
+        results = parallel_ols.fit_all(specs,
+                                       processed_dir='data/processed/',
+                                       workers=2)
+        assert results.index.names == ['spec', 'cap_group', 'rev_group']
+        serial = parallel_ols.fit_all(specs,
+                                      processed_dir='data/processed/',
+                                      workers=1)
+        assert results.index.equals(serial.index)
+        for result, serial_result in zip(results, serial):
+            assert result.params.equals(serial_result.params)
+        for spec in specs:
+            obj = GroupedOLS.from_ols_results(results.loc[spec.name])
+            expected = GroupedOLS(processed_dir='data/processed/',
+                                  ols_features=spec).ols_in_group()
+            assert obj.look_up_ols_detail('param', column=1).equals(
+                expected.look_up_ols_detail('param', column=1))
+            assert obj.look_up_ols_detail('pvalue_star', column=1).equals(
+                expected.look_up_ols_detail('pvalue_star', column=1))
+
+
+class Test_robust_grid(object):
+    @staticmethod
+    def window_root(tmp_path, windows):
+        """以data/processed 中的数据构造几个窗口文件夹"""
+        for backward, forward in windows:
+            window_dir = tmp_path / 'b{}_f{}'.format(backward, forward)
+            window_dir.mkdir()
+            for name in os.listdir('data/processed'):
+                if name.endswith('.pickle'):
+                    shutil.copy(os.path.join('data/processed', name),
+                                str(window_dir))
+            write_windows(str(window_dir), backward, forward)
+        return str(tmp_path)
+
+    def test_forward_window(self, tmp_path):
+        """持有期长度从文件夹的元数据读取，两位数的窗口也能正确解析"""
+        root = self.window_root(tmp_path, [(40, 10)])
+        obj = GroupedOLS(processed_dir=os.path.join(root, 'b40_f10/'),
+                         ols_features=OLSFeatures.market_ret)
+        assert obj.forward_window == 10
+
+    def test_cube(self, tmp_path):
+        """结果表与各窗口文件夹分别使用fit_all 的结果一致"""
+        root = self.window_root(tmp_path, [(60, 5), (40, 10)])
+        assert robust_grid.discover_window_dirs(root) == [
+            (40, 10, os.path.join(root, 'b40_f10')),
+            (60, 5, os.path.join(root, 'b60_f5'))
+        ]
+        specs = [OLSFeatures.market_ret, OLSFeatures.std_with_sign]
+        cube = robust_grid.run_grid(root,
+                                    specs=specs,
+                                    workers=1,
+                                    backend='batched')
+        assert cube.index.names == [
+            'backward', 'forward', 'spec', 'cap_group', 'rev_group', 'term'
+        ]
+        assert list(cube.columns) == robust_grid.COLUMNS
+        results = parallel_ols.fit_all(specs,
+                                       processed_dir=os.path.join(
+                                           root, 'b40_f10/'),
+                                       workers=1,
+                                       backend='batched')
+        result = results.loc[('std_with_sign', 'Small', 'Lo-Hi')]
+        detail = cube.loc[(40, 10, 'std_with_sign', 'Small', 'Lo-Hi')]
+        assert detail['params'].equals(result.params)
+        assert detail['pvalues'].equals(result.pvalues)
+        # 不同的持有期使用不同的HAC 滞后阶数
+        assert not cube.loc[(60, 5), 'bse'].equals(cube.loc[(40, 10), 'bse'])
+
+
+class Test_report(object):
+    SECTIONS = [
+        ('rolling_std_log', [report.single(['rolling_std_log'], 1)]),
+        ('std_with_sign', [
+            report.single(['std_with_sign'], 'const', param=True),
+            report.multi(['std_with_sign'], (2, 4))
+        ]),
+    ]
+
+    def test_tables(self):
+        """报告中的表格与GroupedOLS.look_up_ols_detail 的结果相同"""
+        text, n_rendered = report.build_report('data/processed/',
+                                               fmt='html',
+                                               sections=self.SECTIONS,
+                                               workers=1,
+                                               cache_dir=None)
+        assert n_rendered == 2
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.std_with_sign)
+        params = obj.look_up_ols_detail('param', column='const')
+        assert params.to_html() in text
+        assert obj.look_up_ols_detail(
+            't_test_star',
+            t_test_str='rolling_std_log + rolling_std_log_ret_sign = 0'
+        ).to_html() in text
+
+    def test_cache(self, tmp_path):
+        """输入没有变化的节从缓存读取，只重新渲染改变了的节"""
+        cache_dir = str(tmp_path / 'report')
+        text, n_rendered = report.build_report('data/processed/',
+                                               fmt='md',
+                                               sections=self.SECTIONS,
+                                               workers=1,
+                                               cache_dir=cache_dir)
+        assert n_rendered == 2
+        cached, n_rendered = report.build_report('data/processed/',
+                                                 fmt='md',
+                                                 sections=self.SECTIONS,
+                                                 workers=1,
+                                                 cache_dir=cache_dir)
+        assert n_rendered == 0
+        assert cached == text
+
+        changed = self.SECTIONS[:1] + [
+            ('std_with_sign', [report.single(['std_with_sign'], 2)])
+        ]
+        _, n_rendered = report.build_report('data/processed/',
+                                            fmt='md',
+                                            sections=changed,
+                                            workers=1,
+                                            cache_dir=cache_dir)
+        assert n_rendered == 1
+
+
+class Test_coef_store(object):
+    @pytest.fixture(scope='class')
+    def results(self):
+        return parallel_ols.fit_all(
+            [OLSFeatures.rolling_std_log, OLSFeatures.std_with_sign],
+            processed_dir='data/processed/',
+            workers=1,
+            backend='batched')
+
+    def test_query(self, tmp_path, results):
+        """查询的结果与拟合结果中的系数和t 值相同"""
+        store = coef_store.CoefStore(str(tmp_path / 'store'))
+        store.append(results, 'data/processed/', run_id='first')
+        store.append(results.loc[['std_with_sign']],
+                     'data/robost/b40_f10/',
+                     run_id='second')
+        assert store.run_ids == ['first', 'second']
+
+        # 新打开的系数表能读到所有追加的数据
+        t_values = coef_store.CoefStore(str(tmp_path / 'store')).query(
+            term='rolling_std_log', columns=['t'])
+        assert t_values.index.names == coef_store.INDEX_NAMES
+        assert len(t_values) == 3 * 25
+        result = results.loc[('std_with_sign', 'Small', 'Lo-Hi')]
+        for run_id, processed_dir in [('first', 'data/processed/'),
+                                      ('second', 'data/robost/b40_f10/')]:
+            assert t_values.loc[(run_id, processed_dir, 'std_with_sign',
+                                 'Small', 'Lo-Hi', 'rolling_std_log'),
+                                't'] == result.tvalues['rolling_std_log']
+
+        detail = store.query(spec='rolling_std_log',
+                             run_id='first',
+                             cap_group='Big')
+        expected = robust_grid.coefficient_frame(
+            results.loc[['rolling_std_log']])
+        detail = detail.droplevel(['run_id', 'processed_dir'])
+        expected = expected.loc[detail.index]
+        assert len(detail) == 2 * 5
+        np.testing.assert_array_equal(detail['coef'].to_numpy(),
+                                      expected['params'].to_numpy())
+        np.testing.assert_array_equal(detail['r2'].to_numpy(),
+                                      expected['rsquared'].to_numpy())
+        assert len(store.query(spec='unknown')) == 0
+
+    def test_append_only(self, tmp_path, results):
+        """已有的run_id 不能再次写入"""
+        store = coef_store.CoefStore(str(tmp_path / 'store'))
+        store.append(results, 'data/processed/', run_id='first')
+        with pytest.raises(ValueError):
+            store.append(results, 'data/processed/', run_id='first')
+        assert len(store) == len(robust_grid.coefficient_frame(results))
+
+
+class Test_contrast_cache(object):
+    def test_each_test_once(self, monkeypatch):
+        """同一个检验对所有组只计算一次，重新拟合后重新计算"""
+        calls = []
+        t_contrast = contrast.t_contrast
+
+        def counted_t_contrast(*args):
+            calls.append(args)
+            return t_contrast(*args)
+
+        monkeypatch.setattr(contrast, 't_contrast', counted_t_contrast)
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.std_with_sign).ols_in_group(
+                             backend='batched')
+        test_str = 'const + rolling_std_log = 0'
+        star_df = obj.look_up_ols_detail('t_test_star', t_test_str=test_str)
+        tvalue_df = obj.look_up_ols_detail('t_test', t_test_str=test_str)
+        obj.look_up_ols_detail('pvalue_star', t_test_str=test_str)
+        assert len(calls) == 1
+
+        expected = obj.ols_dframe.applymap(
+            lambda result: result.t_test(test_str).tvalue.item())
+        assert tvalue_df.values == pytest.approx(expected.values, rel=1e-10)
+        assert star_df.applymap(lambda value: value.rstrip('*')).equals(
+            tvalue_df.applymap(lambda value: format(value, '.4f')))
+
+        obj.ols_in_group(backend='batched')
+        obj.look_up_ols_detail('t_test', t_test_str=test_str)
+        assert len(calls) == 2
+
+
+class Test_contrast(object):
+    @pytest.fixture
+    def sm_results(self):
+        obj = GroupedOLS(processed_dir='data/processed/',
+                         ols_features=OLSFeatures.delta_std_and_rm)
+        return obj.ols_in_group()
+
+    def test_restriction_matrix(self):
+        names = ['const', 'a', 'b']
+        r_mat, q = contrast.restriction_matrix(names, 'a + b = 1')
+        assert r_mat.tolist() == [[0, 1, 1]] and q.tolist() == [1]
+        r_mat, q = contrast.restriction_matrix(names, ['a', 'b'])
+        assert r_mat.tolist() == [[0, 1, 1]] and q.tolist() == [0]
+        r_mat, _ = contrast.restriction_matrix(names, {'a': 1, 'b': -1})
+        assert r_mat.tolist() == [[0, 1, -1]]
+        with pytest.raises(ValueError):
+            contrast.restriction_matrix(names, ['c'])
+
+    def test_t_test_same_as_statsmodels(self, sm_results):
+        """所有组一次计算的t 检验与逐组使用statsmodels 的结果一致"""
+        names = ['delta_std_t_{}'.format(i) for i in range(1, 6)]
+        test_str = ' + '.join(names) + ' = 0'
+        tested = sm_results.t_test(names)
+        for group, result in sm_results.ols_dframe.stack().items():
+            expected = result.t_test(test_str)
+            assert tested.loc[group, 'tvalue'] == pytest.approx(
+                expected.tvalue.item())
+            assert tested.loc[group, 'pvalue'] == pytest.approx(
+                expected.pvalue.item())
+
+    @pytest.mark.parametrize('use_f', [False, True])
+    def test_wald_same_as_statsmodels(self, sm_results, use_f):
+        test_str = 'delta_std_t_1 = 0, rm_exc_t_1 = 0'
+        tested = sm_results.wald_test(test_str, use_f=use_f)
+        for group, result in sm_results.ols_dframe.stack().items():
+            expected = result.wald_test(test_str, use_f=use_f, scalar=True)
+            assert tested.loc[group, 'statistic'] == pytest.approx(
+                float(expected.statistic))
+            assert tested.loc[group, 'pvalue'] == pytest.approx(
+                float(expected.pvalue))
+
+    def test_from_stored_results(self, sm_results, tmp_path):
+        """保存后读取的结果可以直接进行检验"""
+        path = str(tmp_path / 'ols_on_delta_std_rm.npz')
+        sm_results.compact_results().save(path)
+        loaded = BatchedOLSResults.load(path)
+        assert loaded.t_test('delta_std_t_1 + delta_std_t_2 = 0').equals(
+            sm_results.t_test('delta_std_t_1 + delta_std_t_2 = 0'))